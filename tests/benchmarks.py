@@ -0,0 +1,269 @@
+"""
+Micro-benchmarks for the per-invocation overhead of the Lambda handler.
+
+These aren't run as part of the test suite. Run them with:
+
+    python -m tests.benchmarks [name ...]
+
+"""
+import base64
+import io
+import logging
+import sys
+import timeit
+import tracemalloc
+
+from werkzeug.wrappers import Response
+
+from zappa.access_log import AccessLogger
+from zappa.handler import LambdaHandler
+from zappa.utilities import merge_headers, titlecase_keys
+from zappa.wsgi import RequestBodyStream, common_log, create_wsgi_request, decode_body, get_wsgi_headers
+
+NUMBER = 20000
+
+SQS_EVENT = {
+    'Records': [{
+        'eventSource': 'aws:sqs',
+        'eventSourceARN': 'arn:aws:sqs:us-east-1:123456789012:queue',
+        'messageId': '059f36b4-87a3-44ab-83d2-661975830a7d',
+        'body': 'hello',
+    }]
+}
+
+API_GATEWAY_EVENT = {
+    'resource': '/{proxy+}',
+    'path': '/catalog/items',
+    'httpMethod': 'GET',
+    'headers': {
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip, deflate, br',
+        'Accept-Language': 'en-US,en;q=0.9',
+        'CloudFront-Forwarded-Proto': 'https',
+        'CloudFront-Is-Desktop-Viewer': 'true',
+        'CloudFront-Is-Mobile-Viewer': 'false',
+        'CloudFront-Is-SmartTV-Viewer': 'false',
+        'CloudFront-Is-Tablet-Viewer': 'false',
+        'CloudFront-Viewer-Country': 'US',
+        'Host': 'example.com',
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36',
+        'Via': '2.0 a3650115c5e21e2b5d133ce84464bea3.cloudfront.net (CloudFront)',
+        'X-Amz-Cf-Id': 'Zk5ZtZ2Dqh0pjbJNcUWNj2jYyHiuG3oEjRdc2XrNxxM1nPd7Mku1Gw==',
+        'X-Amzn-Trace-Id': 'Root=1-5e6e0b24-6f3ed9e0b0c1f8f0a1d5b0a8',
+        'X-Forwarded-For': '203.0.113.7, 70.132.20.68',
+        'X-Forwarded-Port': '443',
+        'X-Forwarded-Proto': 'https',
+    },
+    'multiValueHeaders': {
+        'Accept': ['application/json'],
+        'Accept-Encoding': ['gzip, deflate, br'],
+        'Accept-Language': ['en-US,en;q=0.9'],
+        'CloudFront-Forwarded-Proto': ['https'],
+        'CloudFront-Is-Desktop-Viewer': ['true'],
+        'CloudFront-Is-Mobile-Viewer': ['false'],
+        'CloudFront-Is-SmartTV-Viewer': ['false'],
+        'CloudFront-Is-Tablet-Viewer': ['false'],
+        'CloudFront-Viewer-Country': ['US'],
+        'Host': ['example.com'],
+        'User-Agent': ['Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'],
+        'Via': ['2.0 a3650115c5e21e2b5d133ce84464bea3.cloudfront.net (CloudFront)'],
+        'X-Amz-Cf-Id': ['Zk5ZtZ2Dqh0pjbJNcUWNj2jYyHiuG3oEjRdc2XrNxxM1nPd7Mku1Gw=='],
+        'X-Amzn-Trace-Id': ['Root=1-5e6e0b24-6f3ed9e0b0c1f8f0a1d5b0a8'],
+        'X-Forwarded-For': ['203.0.113.7, 70.132.20.68'],
+        'X-Forwarded-Port': ['443'],
+        'X-Forwarded-Proto': ['https'],
+    },
+    'queryStringParameters': {'page': '2'},
+    'multiValueQueryStringParameters': {'page': ['2']},
+    'pathParameters': {'proxy': 'catalog/items'},
+    'stageVariables': None,
+    'requestContext': {
+        'resourcePath': '/{proxy+}',
+        'httpMethod': 'GET',
+        'path': '/dev/catalog/items',
+        'accountId': '123456789012',
+        'stage': 'dev',
+        'identity': {'sourceIp': '203.0.113.7', 'userArn': None},
+        'requestId': 'c6af9ac6-7b61-11e6-9a41-93e8deadbeef',
+        'apiId': '1234567890',
+    },
+    'body': None,
+    'isBase64Encoded': False,
+}
+
+ALB_EVENT = {
+    'requestContext': {
+        'elb': {
+            'targetGroupArn': 'arn:aws:elasticloadbalancing:us-east-1:123456789012:targetgroup/lambda/50dc6c495c0c9188'
+        }
+    },
+    'httpMethod': 'POST',
+    'path': '/catalog/items',
+    'multiValueQueryStringParameters': {},
+    'multiValueHeaders': {
+        'accept': ['application/json'],
+        'accept-encoding': ['gzip'],
+        'content-type': ['application/json'],
+        'cookie': ['session=1', 'theme=dark'],
+        'host': ['example.com'],
+        'user-agent': ['okhttp/4.9.0'],
+        'x-amzn-trace-id': ['Root=1-5c536348-3d683b8b04734faae651f476'],
+        'x-forwarded-for': ['203.0.113.7'],
+        'x-forwarded-port': ['443'],
+        'x-forwarded-proto': ['https'],
+    },
+    'body': '{"name": "item"}',
+    'isBase64Encoded': False,
+}
+
+CONSOLE_TEST_EVENT = {
+    'resource': '/{proxy+}',
+    'path': '/catalog/items',
+    'httpMethod': 'GET',
+    'headers': None,
+    'multiValueHeaders': None,
+    'queryStringParameters': None,
+    'multiValueQueryStringParameters': None,
+    'pathParameters': {'proxy': 'catalog/items'},
+    'stageVariables': None,
+    'requestContext': {
+        'resourcePath': '/{proxy+}',
+        'httpMethod': 'GET',
+        'stage': 'test-invoke-stage',
+        'identity': {'sourceIp': 'test-invoke-source-ip', 'userArn': 'arn:aws:iam::123456789012:root'},
+    },
+    'body': None,
+    'isBase64Encoded': False,
+}
+
+WEB_EVENTS = [
+    ('api gateway', API_GATEWAY_EVENT),
+    ('alb', ALB_EVENT),
+    ('console test', CONSOLE_TEST_EVENT),
+]
+
+
+def report(name, seconds, number=NUMBER):
+    print('{0:<40} {1:>10.2f} us/invoke'.format(name, seconds / number * 1e6))
+
+
+def bench_routing():
+    """
+    Compare resolving an SQS event function on every invocation
+    with resolving it through the handler's routing table.
+    """
+    lh = LambdaHandler('tests.test_event_routing_settings')
+    record = SQS_EVENT['Records'][0]
+
+    def uncached():
+        whole_function = lh.get_function_for_aws_event(record)
+        app_function = lh.import_module_and_get_function(whole_function)
+        return lh.run_function(app_function, SQS_EVENT, None)
+
+    def cached():
+        whole_function = lh.get_function_for_aws_event(record)
+        return lh.run_routed_function(whole_function, SQS_EVENT, None)
+
+    report('routing: import and inspect per invoke', timeit.timeit(uncached, number=NUMBER))
+    report('routing: routing table', timeit.timeit(cached, number=NUMBER))
+    report('routing: full handler', timeit.timeit(lambda: lh.handler(SQS_EVENT, None), number=NUMBER))
+
+
+def bench_wsgi_request():
+    """
+    Compare building the WSGI headers by merging, titlecasing and
+    translating them in turn with doing it in a single pass,
+    then time create_wsgi_request and the handler for each kind of event.
+    """
+    def merge_and_translate(event):
+        # Once by the handler, and again by create_wsgi_request
+        merge_headers(event)
+        headers = titlecase_keys(merge_headers(event))
+        return {'HTTP_' + name.upper().replace('-', '_'): str(value) for name, value in headers.items()}
+
+    lh = LambdaHandler('tests.test_wsgi_script_name_settings')
+    for name, event in WEB_EVENTS:
+        report('wsgi_request: {}: merge and translate'.format(name),
+               timeit.timeit(lambda: merge_and_translate(event), number=NUMBER))
+        report('wsgi_request: {}: single pass'.format(name),
+               timeit.timeit(lambda: get_wsgi_headers(event), number=NUMBER))
+        report('wsgi_request: {}: create_wsgi_request'.format(name),
+               timeit.timeit(lambda: create_wsgi_request(event, trailing_slash=False), number=NUMBER))
+        report('wsgi_request: {}: full handler'.format(name),
+               timeit.timeit(lambda: lh.handler(dict(event), None), number=NUMBER // 10), number=NUMBER // 10)
+
+
+def bench_request_body():
+    """
+    Compare the peak memory and time of decoding a 5 MB base64 encoded
+    upload into a BytesIO with decoding it into a RequestBodyStream.
+    """
+    encoded = base64.b64encode(bytes(range(256)) * 20480).decode('ascii')
+
+    def copied():
+        return io.BytesIO(base64.b64decode(encoded))
+
+    def streamed():
+        return RequestBodyStream(decode_body(encoded, base64_encoded=True))
+
+    for name, function in [('b64decode into BytesIO', copied), ('decode_body into stream', streamed)]:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{0:<40} {1:>10.2f} MB peak'.format('request_body: ' + name, peak / 1e6))
+        report('request_body: ' + name, timeit.timeit(function, number=NUMBER // 100), number=NUMBER // 100)
+
+
+def bench_access_log():
+    """
+    Compare common_log with the access logger's Common Log Format
+    and JSON records, logged and sampled out.
+    """
+    environ = create_wsgi_request(API_GATEWAY_EVENT)
+    response = Response(b'x' * 100)
+    response.content = response.get_data()
+    loggers = [
+        ('common', AccessLogger()),
+        ('json', AccessLogger(format='json', stream=io.StringIO())),
+        ('json, 2xx sampled at 10%', AccessLogger(format='json', sample_rates={'2xx': 0.1}, stream=io.StringIO())),
+    ]
+
+    # Records go to the root logger at INFO, without being printed.
+    logging.disable(logging.NOTSET)
+    root = logging.getLogger()
+    handlers, level = root.handlers, root.level
+    root.handlers, root.level = [logging.NullHandler()], logging.INFO
+    try:
+        report('access_log: common_log', timeit.timeit(
+            lambda: common_log(environ, response, response_time=1.5), number=NUMBER))
+        for name, access_logger in loggers:
+            def log():
+                access_logger.log(environ, 200, 100, response_time=1.5)
+                access_logger.flush()
+            report('access_log: {}'.format(name), timeit.timeit(log, number=NUMBER))
+    finally:
+        root.handlers, root.level = handlers, level
+        logging.disable(logging.CRITICAL)
+
+
+BENCHMARKS = {
+    'access_log': bench_access_log,
+    'request_body': bench_request_body,
+    'routing': bench_routing,
+    'wsgi_request': bench_wsgi_request,
+}
+
+
+def main(names):
+    # The handler logs every request, which would be timed too.
+    logging.disable(logging.CRITICAL)
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+        # LambdaHandler is a singleton, so start each benchmark afresh.
+        LambdaHandler._LambdaHandler__instance = None
+        LambdaHandler.settings = None
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
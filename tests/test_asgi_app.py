@@ -0,0 +1,36 @@
+import asyncio
+import json
+
+lifespan_events = []
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            lifespan_events.append(message['type'])
+            if message['type'] == 'lifespan.startup':
+                scope['state']['loop'] = id(asyncio.get_event_loop())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    message = await receive()
+    response = {
+        'method': scope['method'],
+        'path': scope['path'],
+        'root_path': scope['root_path'],
+        'query_string': scope['query_string'].decode('latin-1'),
+        'headers': [[name.decode('latin-1'), value.decode('latin-1')] for name, value in scope['headers']],
+        'body': message['body'].decode('utf-8'),
+        'same_loop': scope['state']['loop'] == id(asyncio.get_event_loop()),
+    }
+    await send({
+        'type': 'http.response.start',
+        'status': 201,
+        'headers': [(b'content-type', b'application/json'), (b'set-cookie', b'a=1'), (b'set-cookie', b'b=2')],
+    })
+    body = json.dumps(response).encode('utf-8')
+    await send({'type': 'http.response.body', 'body': body[:10], 'more_body': True})
+    await send({'type': 'http.response.body', 'body': body[10:]})
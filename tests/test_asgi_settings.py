@@ -0,0 +1,15 @@
+API_STAGE = 'dev'
+APP_FUNCTION = 'app'
+APP_MODULE = 'tests.test_asgi_app'
+ASGI = True
+ASGI_LIFESPAN = True
+BINARY_SUPPORT = False
+CONTEXT_HEADER_MAPPINGS = {}
+DEBUG = 'True'
+DJANGO_SETTINGS = None
+DOMAIN = 'api.example.com'
+EXCEPTION_HANDLER = None
+ENVIRONMENT_VARIABLES = {}
+LOG_LEVEL = 'DEBUG'
+PROJECT_NAME = 'asgi_settings'
+COGNITO_TRIGGER_MAPPING = {}
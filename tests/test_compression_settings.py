@@ -0,0 +1,15 @@
+API_STAGE = 'dev'
+APP_FUNCTION = 'app'
+APP_MODULE = 'tests.test_wsgi_script_name_app'
+BINARY_SUPPORT = False
+CONTEXT_HEADER_MAPPINGS = {}
+DEBUG = 'True'
+DJANGO_SETTINGS = None
+DOMAIN = 'api.example.com'
+ENVIRONMENT_VARIABLES = {}
+LOG_LEVEL = 'DEBUG'
+PROJECT_NAME = 'compression_settings'
+COGNITO_TRIGGER_MAPPING = {}
+RESPONSE_COMPRESSION = True
+RESPONSE_COMPRESSION_MIN_SIZE = 100
+RESPONSE_COMPRESSION_MIMETYPES = ['text/*']
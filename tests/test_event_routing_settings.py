@@ -0,0 +1,18 @@
+API_STAGE = 'dev'
+APP_FUNCTION = 'handler_for_events'
+APP_MODULE = 'tests.test_event_script_app'
+DEBUG = 'True'
+DJANGO_SETTINGS = None
+DOMAIN = 'api.example.com'
+ENVIRONMENT_VARIABLES = {}
+LOG_LEVEL = 'DEBUG'
+PROJECT_NAME = 'test_event_routing'
+AWS_EVENT_MAPPING = {
+    'arn:aws:sqs:us-east-1:123456789012:queue': 'tests.test_handler.two_args',
+    'arn:aws:sns:us-east-1:123456789012:topic': 'tests.test_handler.does_not_exist',
+}
+AWS_BOT_EVENT_MAPPING = {'intent-name:DialogCodeHook': 'tests.test_handler.handle_bot_intent'}
+COGNITO_TRIGGER_MAPPING = {}
+AUTHORIZER_FUNCTION = 'tests.test_handler.one_arg'
+EXCEPTION_HANDLER = 'tests.test_handler.mocked_exception_handler'
+SCHEDULED_FUNCTIONS = ['tests.test_handler.no_args']
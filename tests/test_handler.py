@@ -1,7 +1,14 @@
-from mock import Mock
+from mock import Mock, patch
+import base64
+import botocore
+import gzip
+import io
+import json
+import os
 import sys
 import unittest
-from zappa.handler import LambdaHandler
+from zappa import metrics
+from zappa.handler import LambdaHandler, RecordProcessingError
 from zappa.utilities import merge_headers
 
 
@@ -37,6 +44,48 @@ def handle_bot_intent(event, context):
     return "Success"
 
 
+handled_exceptions = []
+
+
+def count_exception(exception, event, context):
+    handled_exceptions.append(event)
+    return False
+
+
+class FakeRemoteEnvS3Client:
+    """
+    Serves JSON config files, answering conditional GETs like S3 does.
+    """
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.requests.append((Key, IfNoneMatch))
+        content = json.dumps(self.files[Key])
+        etag = '"{}"'.format(hash(content))
+        if IfNoneMatch == etag:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        return {'Body': io.BytesIO(content.encode('utf-8')), 'ETag': etag}
+
+
+processed_records = []
+
+
+def process_record(event, context):
+    record = event['Records'][0]
+    if 'kinesis' in record:
+        body = record['kinesis']['data']
+    elif 'Sns' in record:
+        body = record['Sns']['Message']
+    else:
+        body = record['body']
+    if body == 'fail':
+        raise Exception('record failed')
+    processed_records.append(body)
+    return body
+
+
 mocked_exception_handler = Mock()
 
 
@@ -44,6 +93,7 @@ class TestZappa(unittest.TestCase):
 
     def setUp(self):
         mocked_exception_handler.reset_mock()
+        del processed_records[:]
 
     def tearDown(self):
         LambdaHandler._LambdaHandler__instance = None
@@ -69,6 +119,341 @@ class TestZappa(unittest.TestCase):
         f_with_type_hint = scope['f_with_type_hint']
         self.assertIsNone(LambdaHandler.run_function(f_with_type_hint, 'e', 'c'))
 
+    def test_routing_table(self):
+        """
+        Ensure that configured event functions are resolved once, at init.
+        """
+        lh = LambdaHandler('tests.test_event_routing_settings')
+
+        self.assertEqual(lh.routing_table['tests.test_handler.two_args'], (two_args, 2))
+        self.assertEqual(lh.routing_table['tests.test_handler.one_arg'], (one_arg, 1))
+        self.assertEqual(lh.routing_table['tests.test_handler.no_args'], (no_args, 0))
+        self.assertEqual(lh.routing_table['tests.test_handler.handle_bot_intent'], (handle_bot_intent, 2))
+        self.assertIs(lh.routing_table['tests.test_handler.mocked_exception_handler'][0], mocked_exception_handler)
+        # Unresolvable functions don't break init.
+        self.assertNotIn('tests.test_handler.does_not_exist', lh.routing_table)
+
+        event = {
+            'Records': [{
+                'eventSource': 'aws:sqs',
+                'eventSourceARN': 'arn:aws:sqs:us-east-1:123456789012:queue',
+                'body': 'hello',
+            }]
+        }
+        with patch.object(LambdaHandler, 'import_module_and_get_function') as mocked_import:
+            self.assertEqual(lh.handler(event, 'c'), (event, 'c'))
+            self.assertEqual(lh.handler({'type': 'TOKEN'}, 'c'), {'type': 'TOKEN'})
+            mocked_import.assert_not_called()
+
+        # Commands are resolved on first use, then cached.
+        event = {'command': 'tests.test_handler.var_args'}
+        self.assertEqual(lh.handler(event, 'c'), (event, 'c'))
+        self.assertEqual(lh.routing_table['tests.test_handler.var_args'], (var_args, 2))
+
+    def test_routing_table_invalid_signature(self):
+        lh = LambdaHandler('tests.test_event_routing_settings')
+
+        with self.assertRaises(RuntimeError):
+            lh.handler({'command': 'tests.test_handler.unsupported'}, 'c')
+        self.assertEqual(lh.routing_table['tests.test_handler.unsupported'], (unsupported, None))
+
+    def test_per_record_processing_sqs(self):
+        lh = LambdaHandler('tests.test_per_record_settings')
+
+        event = {
+            'Records': [{
+                'eventSource': 'aws:sqs',
+                'eventSourceARN': 'arn:aws:sqs:us-east-1:123456789012:queue',
+                'messageId': str(index),
+                'body': body,
+            } for index, body in enumerate(['a', 'fail', 'b', 'fail'])]
+        }
+        response = lh.handler(event, None)
+
+        self.assertEqual(response, {'batchItemFailures': [{'itemIdentifier': '1'}, {'itemIdentifier': '3'}]})
+        self.assertEqual(sorted(processed_records), ['a', 'b'])
+
+    def test_per_record_processing_keeps_message_group_order(self):
+        lh = LambdaHandler('tests.test_per_record_settings')
+
+        def record(message_id, group, body):
+            return {
+                'eventSource': 'aws:sqs',
+                'eventSourceARN': 'arn:aws:sqs:us-east-1:123456789012:queue.fifo',
+                'messageId': message_id,
+                'attributes': {'MessageGroupId': group},
+                'body': body,
+            }
+
+        event = {
+            'Records': [
+                record('1', 'a', 'a1'),
+                record('2', 'b', 'b1'),
+                record('3', 'a', 'fail'),
+                record('4', 'b', 'b2'),
+                record('5', 'a', 'a2'),
+            ]
+        }
+        response = lh.handler(event, None)
+
+        # a2 must not be processed before the failed record is retried.
+        self.assertEqual(response, {'batchItemFailures': [{'itemIdentifier': '3'}, {'itemIdentifier': '5'}]})
+        self.assertNotIn('a2', processed_records)
+        self.assertLess(processed_records.index('b1'), processed_records.index('b2'))
+
+    def test_per_record_processing_kinesis(self):
+        lh = LambdaHandler('tests.test_per_record_settings')
+
+        event = {
+            'Records': [{
+                'eventSource': 'aws:kinesis',
+                'eventSourceARN': 'arn:aws:kinesis:us-east-1:123456789012:stream/stream',
+                'kinesis': {
+                    'partitionKey': partition_key,
+                    'sequenceNumber': sequence_number,
+                    'data': data,
+                },
+            } for partition_key, sequence_number, data in [('x', '100', 'x1'), ('y', '101', 'fail')]]
+        }
+        response = lh.handler(event, None)
+
+        self.assertEqual(response, {'batchItemFailures': [{'itemIdentifier': '101'}]})
+        self.assertEqual(processed_records, ['x1'])
+
+    def test_per_record_processing_without_identifiers(self):
+        """
+        Event sources which can't report partial failures fail the whole batch.
+        """
+        lh = LambdaHandler('tests.test_per_record_settings')
+
+        event = {
+            'Records': [{
+                'Sns': {
+                    'TopicArn': 'arn:aws:sns:us-east-1:123456789012:topic',
+                    'Message': message,
+                },
+            } for message in ['a', 'fail']]
+        }
+        with self.assertRaises(Exception):
+            lh.handler(event, None)
+
+        # The exception handler is called once, for the failed record.
+        del handled_exceptions[:]
+        with patch.object(lh.settings, 'EXCEPTION_HANDLER', 'tests.test_handler.count_exception'):
+            with self.assertRaises(RecordProcessingError) as raised:
+                LambdaHandler.lambda_handler(event, None)
+        self.assertEqual(handled_exceptions, [{'Records': [event['Records'][1]]}])
+        self.assertEqual(str(raised.exception.__cause__), 'record failed')
+
+    def test_remote_settings(self):
+        s3_client = FakeRemoteEnvS3Client({
+            'base.json': {'ZAPPA_TEST_A': 'base', 'ZAPPA_TEST_B': 'base', 'ZAPPA_TEST_LOCAL': 'remote'},
+            'stage.json': {'ZAPPA_TEST_B': 'stage'},
+        })
+        session = Mock()
+        session.client.return_value = s3_client
+
+        try:
+            lh = LambdaHandler('tests.test_remote_env_settings', session=session)
+
+            # Merged in order, local env vars taking precedence.
+            self.assertEqual(os.environ['ZAPPA_TEST_A'], 'base')
+            self.assertEqual(os.environ['ZAPPA_TEST_B'], 'stage')
+            self.assertEqual(os.environ['ZAPPA_TEST_LOCAL'], 'local')
+
+            # Fresh config isn't refreshed.
+            self.assertFalse(lh.refresh_remote_settings())
+
+            # Stale config is refreshed in the background,
+            # with unchanged files costing only a 304.
+            s3_client.files['stage.json'] = {'ZAPPA_TEST_C': 'stage'}
+            lh.remote_env_loaded_at -= 61
+            self.assertTrue(lh.refresh_remote_settings())
+            lh.remote_env_refresh_thread.join()
+
+            self.assertEqual(s3_client.requests[2], ('base.json', lh.remote_env_etags[('bucket', 'base.json')]))
+            self.assertEqual(os.environ['ZAPPA_TEST_B'], 'base')
+            self.assertEqual(os.environ['ZAPPA_TEST_C'], 'stage')
+            self.assertEqual(os.environ['ZAPPA_TEST_LOCAL'], 'local')
+
+            s3_client.files['base.json'] = {}
+            lh.remote_env_loaded_at -= 61
+            lh.handler({'awslogs': {'data': ''}}, None)
+            lh.remote_env_refresh_thread.join()
+            self.assertNotIn('ZAPPA_TEST_A', os.environ)
+            self.assertNotIn('ZAPPA_TEST_B', os.environ)
+        finally:
+            for key in ['ZAPPA_TEST_A', 'ZAPPA_TEST_B', 'ZAPPA_TEST_C', 'ZAPPA_TEST_LOCAL']:
+                os.environ.pop(key, None)
+
+    def test_metrics(self):
+        """
+        Ensure that init and request phases are timed and flushed as EMF.
+        """
+        lh = LambdaHandler('tests.test_metrics_settings')
+        lh.metrics.emit = False
+        documents = []
+        metrics.add_sink(documents.append)
+
+        event = {
+            'body': '',
+            'resource': '/{proxy+}',
+            'requestContext': {},
+            'queryStringParameters': {},
+            'headers': {
+                'Host': 'example.com',
+            },
+            'pathParameters': {
+                'proxy': 'return/request/url'
+            },
+            'httpMethod': 'GET',
+            'stageVariables': {},
+            'path': '/return/request/url'
+        }
+        try:
+            lh.handler(event, None)
+            lh.metrics.flush(dimensions={'FunctionName': 'test'})
+            lh.handler(event, None)
+            lh.metrics.flush(dimensions={'FunctionName': 'test'})
+        finally:
+            metrics.remove_sink(documents.append)
+
+        cold, warm = documents
+        self.assertTrue(cold['ColdStart'])
+        self.assertFalse(warm['ColdStart'])
+        self.assertEqual(warm['FunctionName'], 'test')
+        self.assertEqual(cold['_aws']['CloudWatchMetrics'][0]['Namespace'], 'ZappaTest')
+        self.assertEqual(cold['_aws']['CloudWatchMetrics'][0]['Dimensions'], [['FunctionName']])
+
+        request_phases = ['request.app', 'request.create_wsgi_request', 'request.event_parse',
+                          'request.response', 'request.total']
+        init_phases = ['init.app', 'init.libraries', 'init.project_archive', 'init.remote_settings',
+                       'init.routing', 'init.settings', 'init.total']
+        self.assertEqual([m['Name'] for m in cold['_aws']['CloudWatchMetrics'][0]['Metrics']],
+                         init_phases + request_phases)
+        self.assertEqual([m['Name'] for m in warm['_aws']['CloudWatchMetrics'][0]['Metrics']], request_phases)
+        self.assertLessEqual(warm['request.app'], warm['request.total'])
+
+    def test_metrics_response_cache_counts(self):
+        lh = LambdaHandler('tests.test_metrics_settings')
+        lh.metrics.emit = False
+        documents = []
+        metrics.add_sink(documents.append)
+
+        lh.response_cache = Mock()
+        lh.response_cache.take_stats.return_value = {'hits': 2, 'misses': 1}
+        try:
+            lh.metrics.start()
+            lh.finish_invocation()
+        finally:
+            lh.response_cache = None
+            metrics.remove_sink(documents.append)
+
+        document, = documents
+        self.assertEqual(document['response_cache.hits'], 2)
+        self.assertEqual(document['response_cache.misses'], 1)
+        self.assertIn({'Name': 'response_cache.hits', 'Unit': 'Count'},
+                      document['_aws']['CloudWatchMetrics'][0]['Metrics'])
+
+    def test_metrics_disabled(self):
+        lh = LambdaHandler('tests.test_wsgi_script_name_settings')
+        self.assertFalse(lh.metrics.enabled)
+        lh.handler({}, None)
+        self.assertIsNone(lh.metrics.flush())
+        self.assertEqual(lh.metrics.timings, {'init.settings': lh.metrics.timings['init.settings']})
+
+    def test_asgi_app(self):
+        """
+        Ensure that ASGI apps run on one event loop, with their lifespan started once.
+        """
+        from tests import test_asgi_app
+        del test_asgi_app.lifespan_events[:]
+        lh = LambdaHandler('tests.test_asgi_settings')
+
+        event = {
+            'body': '{"hello": "world"}',
+            'resource': '/{proxy+}',
+            'requestContext': {},
+            'queryStringParameters': {'a': 'b'},
+            'headers': {
+                'Host': 'example.com',
+                'Content-Type': 'application/json',
+            },
+            'multiValueHeaders': {
+                'Host': ['example.com'],
+                'Content-Type': ['application/json'],
+            },
+            'pathParameters': {
+                'proxy': 'items/ü'
+            },
+            'httpMethod': 'POST',
+            'stageVariables': {},
+            'path': '/items/ü'
+        }
+        for _ in range(2):
+            response = lh.handler(event, None)
+            self.assertEqual(response['statusCode'], 201)
+            self.assertEqual(response['multiValueHeaders']['set-cookie'], ['a=1', 'b=2'])
+
+            body = json.loads(response['body'])
+            self.assertEqual(body['method'], 'POST')
+            self.assertEqual(body['path'], '/items/ü')
+            self.assertEqual(body['query_string'], 'a=b')
+            self.assertEqual(body['body'], '{"hello": "world"}')
+            self.assertIn(['content-type', 'application/json'], body['headers'])
+            self.assertEqual(len([h for h in body['headers'] if h[0] == 'content-type']), 1)
+            self.assertTrue(body['same_loop'])
+
+        self.assertEqual(test_asgi_app.lifespan_events, ['lifespan.startup'])
+        lh.asgi_app.shutdown()
+        self.assertEqual(test_asgi_app.lifespan_events, ['lifespan.startup', 'lifespan.shutdown'])
+
+    def test_http_api_event(self):
+        """
+        Ensure that 2.0 payload events, from HTTP APIs and Function URLs, are served.
+        """
+        lh = LambdaHandler('tests.test_wsgi_script_name_settings')
+
+        event = {
+            'version': '2.0',
+            'routeKey': '$default',
+            'rawPath': '/dev/return/request/url',
+            'rawQueryString': 'q=a%2Fb&q=c',
+            'cookies': ['a=1', 'b=2'],
+            'headers': {
+                'host': '1234567890.execute-api.us-east-1.amazonaws.com',
+                'x-forwarded-for': '10.0.0.1, 10.0.0.2',
+                'x-forwarded-proto': 'https',
+            },
+            'requestContext': {
+                'http': {
+                    'method': 'GET',
+                    'path': '/dev/return/request/url',
+                    'protocol': 'HTTP/1.1',
+                    'sourceIp': '192.0.2.1',
+                },
+                'stage': 'dev',
+            },
+            'isBase64Encoded': False,
+        }
+        response = lh.handler(event, None)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertFalse(response['isBase64Encoded'])
+        self.assertNotIn('multiValueHeaders', response)
+        self.assertEqual(
+            response['body'],
+            'https://1234567890.execute-api.us-east-1.amazonaws.com/dev/return/request/url?q=a%2Fb&q=c'
+        )
+
+        # Function URLs have no stage.
+        event['rawPath'] = '/return/request/url'
+        event['rawQueryString'] = ''
+        event['requestContext']['stage'] = '$default'
+        event['headers']['host'] = 'abc.lambda-url.us-east-1.on.aws'
+        response = lh.handler(event, None)
+        self.assertEqual(response['body'], 'https://abc.lambda-url.us-east-1.on.aws/return/request/url')
+
     def test_wsgi_script_name_on_aws_url(self):
         """
         Ensure that requests to the amazonaws.com host for an API with a
@@ -334,6 +719,41 @@ class TestZappa(unittest.TestCase):
         response = lh.lambda_handler(event, None)
         mocked_exception_handler.assert_called
 
+    def test_response_compression_without_binary_support(self):
+        """
+        Ensure responses are only compressed when they reach the client as bytes.
+        """
+        lh = LambdaHandler('tests.test_compression_settings')
+
+        event = {
+            'body': 'x' * 1000,
+            'resource': '/{proxy+}',
+            'requestContext': {},
+            'queryStringParameters': None,
+            'headers': {
+                'Host': 'example.com',
+                'Accept-Encoding': 'gzip',
+                'Content-Type': 'text/plain',
+            },
+            'pathParameters': {'proxy': 'return/request/body'},
+            'httpMethod': 'POST',
+            'stageVariables': {},
+            'path': '/return/request/body',
+        }
+        # A REST API without binary support would return the base64 text.
+        response = lh.handler(event, None)
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['body'], 'x' * 1000)
+        self.assertNotIn('Content-Encoding', response['headers'])
+        self.assertNotIn('isBase64Encoded', response)
+
+        # ALB decodes base64 bodies.
+        event['requestContext'] = {'elb': {'targetGroupArn': 'arn'}}
+        response = lh.handler(event, None)
+        self.assertEqual(response['headers']['Content-Encoding'], 'gzip')
+        self.assertTrue(response['isBase64Encoded'])
+        self.assertEqual(gzip.decompress(base64.b64decode(response['body'])), b'x' * 1000)
+
     def test_wsgi_script_name_on_alb_event(self):
         """
         Ensure ALB-triggered events are properly handled by LambdaHandler
@@ -0,0 +1,18 @@
+API_STAGE = 'dev'
+APP_FUNCTION = 'app'
+APP_MODULE = 'tests.test_wsgi_script_name_app'
+BINARY_SUPPORT = True
+CONTEXT_HEADER_MAPPINGS = {}
+DEBUG = 'True'
+DJANGO_SETTINGS = None
+DOMAIN = 'api.example.com'
+ENVIRONMENT_VARIABLES = {}
+LOG_LEVEL = 'DEBUG'
+PROJECT_NAME = 'offload_settings'
+COGNITO_TRIGGER_MAPPING = {}
+OFFLOAD_BUCKET = 'offload-bucket'
+OFFLOAD_PREFIX = 'zappa-offload/'
+OFFLOAD_THRESHOLD = 64
+OFFLOAD_EXPIRES_IN = 300
+OFFLOAD_STATUS_CODE = 303
+OFFLOAD_ENVELOPE = False
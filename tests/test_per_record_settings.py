@@ -0,0 +1,19 @@
+API_STAGE = 'dev'
+APP_FUNCTION = 'handler_for_events'
+APP_MODULE = 'tests.test_event_script_app'
+DEBUG = 'True'
+DJANGO_SETTINGS = None
+DOMAIN = 'api.example.com'
+ENVIRONMENT_VARIABLES = {}
+LOG_LEVEL = 'DEBUG'
+PROJECT_NAME = 'test_per_record'
+AWS_EVENT_MAPPING = {
+    'arn:aws:sqs:us-east-1:123456789012:queue': 'tests.test_handler.process_record',
+    'arn:aws:sqs:us-east-1:123456789012:queue.fifo': 'tests.test_handler.process_record',
+    'arn:aws:kinesis:us-east-1:123456789012:stream/stream': 'tests.test_handler.process_record',
+    'arn:aws:sns:us-east-1:123456789012:topic': 'tests.test_handler.process_record',
+}
+COGNITO_TRIGGER_MAPPING = {}
+EXCEPTION_HANDLER = None
+PER_RECORD_PROCESSING = True
+PER_RECORD_MAX_WORKERS = 4
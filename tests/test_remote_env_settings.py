@@ -0,0 +1,12 @@
+API_STAGE = 'dev'
+APP_FUNCTION = 'handler_for_events'
+APP_MODULE = 'tests.test_event_script_app'
+DEBUG = 'True'
+DJANGO_SETTINGS = None
+DOMAIN = 'api.example.com'
+ENVIRONMENT_VARIABLES = {'ZAPPA_TEST_LOCAL': 'local'}
+LOG_LEVEL = 'DEBUG'
+PROJECT_NAME = 'test_remote_env'
+COGNITO_TRIGGER_MAPPING = {}
+REMOTE_ENV = ['s3://bucket/base.json', 's3://bucket/stage.json']
+REMOTE_ENV_TTL = 60
@@ -0,0 +1,18 @@
+# The LocalRuntimeAPI the app is invoked through
+runtime_api = None
+
+# Whether the client had received each row before the next was produced
+streamed = []
+
+
+def app(environ, start_response):
+    invocation = runtime_api.invocations[environ['lambda.context'].aws_request_id]
+    start_response('200 OK', [('Content-Type', 'text/csv'), ('Set-Cookie', 'a=1')])
+
+    def rows():
+        for i in range(3):
+            # The prelude, then a chunk per row
+            streamed.append(invocation.wait_for_chunks(i + 1, timeout=5))
+            yield 'row,{}\n'.format(i)
+
+    return rows()
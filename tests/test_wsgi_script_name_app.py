@@ -6,3 +6,8 @@ app = Flask(__name__)
 @app.route('/return/request/url', methods=['GET', 'POST'])
 def return_request_url():
     return request.url
+
+
+@app.route('/return/request/body', methods=['POST'])
+def return_request_body():
+    return request.get_data()
@@ -1,5 +1,7 @@
 # -*- coding: utf8 -*-
+import base64
 import collections
+import gzip
 import json
 
 from io import BytesIO
@@ -23,16 +25,18 @@ from click.exceptions import ClickException
 from zappa.cli import ZappaCLI, shamelessly_promote, disable_click_colors
 from zappa.core import ALB_LAMBDA_ALIAS
 from zappa.ext.django_zappa import get_django_wsgi
+from zappa.preload import ImportRecord
 from zappa.letsencrypt import get_cert_and_update_domain, create_domain_key, create_domain_csr, \
     create_chained_certificate, cleanup, parse_account_key, parse_csr, sign_certificate, encode_certificate,\
     register_account, verify_challenge, gettempdir
 from zappa.utilities import (
-    conflicts_with_a_neighbouring_module, contains_python_files_or_subdirs,
+    add_event_source, conflicts_with_a_neighbouring_module, contains_python_files_or_subdirs,
     detect_django_settings, detect_flask_apps, get_venv_from_python_version,
     human_size, InvalidAwsLambdaName, parse_s3_url, string_to_timestamp,
     titlecase_keys, is_valid_bucket_name, validate_name
 )
-from zappa.wsgi import create_wsgi_request, common_log
+from zappa.wsgi import create_wsgi_request, common_log, compress_response, create_lambda_response, \
+    get_accepted_encoding, run_wsgi_app, RequestBodyStream
 from zappa.core import Zappa, ASSUME_POLICY, ATTACH_POLICY
 
 
@@ -349,6 +353,31 @@ class TestZappa(unittest.TestCase):
         parsable_template = json.loads(z.cf_template.to_json())
         self.assertEqual('arn:aws:apigateway:us-east-1:lambda:path/2015-03-31/functions/arn:aws:lambda:us-east-1:123456789012:function:my-function/invocations', parsable_template["Resources"]["Authorizer"]["Properties"]["AuthorizerUri"])
 
+    def test_create_http_api_routes(self):
+        z = Zappa()
+        z.credentials_arn = 'arn:aws:iam::12345:role/ZappaLambdaExecution'
+        lambda_arn = 'arn:aws:lambda:us-east-1:12345:function:helloworld'
+
+        z.create_stack_template(lambda_arn, 'helloworld', False, False, None, True,
+                                api_version='v2', stage_name='dev')
+        resources = json.loads(z.cf_template.to_json())["Resources"]
+        self.assertEqual(sorted(resources), ['Api', 'DefaultRoute', 'Integration', 'Stage'])
+        self.assertEqual("HTTP", resources["Api"]["Properties"]["ProtocolType"])
+        self.assertEqual(["*"], resources["Api"]["Properties"]["CorsConfiguration"]["AllowOrigins"])
+        self.assertEqual("2.0", resources["Integration"]["Properties"]["PayloadFormatVersion"])
+        self.assertEqual(lambda_arn, resources["Integration"]["Properties"]["IntegrationUri"])
+        self.assertEqual("$default", resources["DefaultRoute"]["Properties"]["RouteKey"])
+        self.assertEqual("dev", resources["Stage"]["Properties"]["StageName"])
+        self.assertTrue(resources["Stage"]["Properties"]["AutoDeploy"])
+
+        # Authorization isn't silently dropped.
+        with self.assertRaises(EnvironmentError):
+            z.create_stack_template(lambda_arn, 'helloworld', False, True, None,
+                                    api_version='v2', stage_name='dev')
+        with self.assertRaises(EnvironmentError):
+            z.create_stack_template(lambda_arn, 'helloworld', False, False, {'function': 'app.authorize'},
+                                    api_version='v2', stage_name='dev')
+
     def test_policy_json(self):
         # ensure the policy docs are valid JSON
         json.loads(ASSUME_POLICY)
@@ -359,6 +388,120 @@ class TestZappa(unittest.TestCase):
         path = os.getcwd()
       # z.schedule_events # TODO
 
+    def test_schedule_per_record_processing(self):
+        zappa_cli = ZappaCLI()
+        zappa_cli.api_stage = 'ttt888'
+        zappa_cli.load_settings('test_settings.json')
+        zappa_cli.override_stage_config_setting('keep_warm', False)
+        zappa_cli.override_stage_config_setting('per_record_processing', True)
+        zappa_cli.override_stage_config_setting('events', [
+            {'function': 'app.on_message',
+             'event_source': {'arn': 'arn:aws:sqs:us-east-1:12345:queue', 'batch_size': 10}},
+            {'function': 'app.on_record',
+             'event_source': {'arn': 'arn:aws:kinesis:us-east-1:12345:stream/stream'}},
+            {'function': 'app.on_change',
+             'event_source': {'arn': 'arn:aws:dynamodb:us-east-1:12345:table/table/stream/2020'}},
+            {'function': 'app.on_upload',
+             'event_source': {'arn': 'arn:aws:s3:::bucket', 'events': ['s3:ObjectCreated:*']}},
+        ])
+
+        with mock.patch.object(zappa_cli.zappa, 'lambda_client'), \
+             mock.patch.object(zappa_cli.zappa, 'schedule_events') as schedule_events:
+            zappa_cli.schedule()
+
+        event_sources = {event['function']: event['event_source'] for event in schedule_events.call_args[1]['events']}
+        for function in ['app.on_message', 'app.on_record', 'app.on_change']:
+            self.assertEqual(['ReportBatchItemFailures'], event_sources[function]['function_response_types'])
+        self.assertNotIn('function_response_types', event_sources['app.on_upload'])
+
+    def test_schedule_offload_expiration(self):
+        zappa_cli = ZappaCLI()
+        zappa_cli.api_stage = 'ttt888'
+        zappa_cli.load_settings('test_settings.json')
+        zappa_cli.override_stage_config_setting('keep_warm', False)
+        zappa_cli.override_stage_config_setting('offload_bucket', 'bodies')
+        zappa_cli.override_stage_config_setting('offload_prefix', 'large/')
+
+        with mock.patch.object(zappa_cli.zappa, 'lambda_client'), \
+             mock.patch.object(zappa_cli.zappa, 'schedule_events'), \
+             mock.patch.object(zappa_cli.zappa, 'add_offload_expiration') as add_offload_expiration:
+            zappa_cli.schedule()
+        add_offload_expiration.assert_called_once_with('bodies', days=1, prefix='large/')
+
+    def test_event_source_function_response_types(self):
+        mappings = []
+
+        def call(op_name, **kwargs):
+            if op_name == 'list_event_source_mappings':
+                return {'EventSourceMappings': mappings}
+            if op_name == 'get_event_source_mapping':
+                return mappings[0] if mappings else None
+            if op_name == 'create_event_source_mapping':
+                mappings.append(dict(kwargs, UUID='uuid'))
+            if op_name == 'update_event_source_mapping':
+                mappings[0].update(kwargs)
+
+        lambda_client = mock.Mock()
+        lambda_client.call.side_effect = call
+        event_source = {
+            'arn': 'arn:aws:kinesis:us-east-1:12345:stream/stream',
+            'starting_position': 'TRIM_HORIZON',
+            'function_response_types': ['ReportBatchItemFailures'],
+        }
+        lambda_arn = 'arn:aws:lambda:us-east-1:12345:function:test'
+
+        with mock.patch('kappa.awsclient.create_client', return_value=lambda_client):
+            self.assertEqual('successful', add_event_source(event_source, lambda_arn, 'app.on_record', mock.Mock()))
+            self.assertEqual(['ReportBatchItemFailures'], mappings[0]['FunctionResponseTypes'])
+            self.assertEqual('TRIM_HORIZON', mappings[0]['StartingPosition'])
+            self.assertEqual('exists', add_event_source(event_source, lambda_arn, 'app.on_record', mock.Mock()))
+
+            # A mapping created without them is updated.
+            del mappings[0]['FunctionResponseTypes']
+            self.assertEqual('updated', add_event_source(event_source, lambda_arn, 'app.on_record', mock.Mock()))
+            self.assertEqual(['ReportBatchItemFailures'], mappings[0]['FunctionResponseTypes'])
+            self.assertEqual('uuid', mappings[0]['UUID'])
+
+
+    def test_add_async_payload_expiration(self):
+        z = Zappa()
+        with mock.patch.object(z, 's3_client') as s3_client:
+            s3_client.get_bucket_lifecycle_configuration.side_effect = botocore.exceptions.ClientError(
+                {'Error': {'Code': 'NoSuchLifecycleConfiguration'}}, 'GetBucketLifecycleConfiguration')
+            z.add_async_payload_expiration('payloads', days=3)
+            rules = s3_client.put_bucket_lifecycle_configuration.call_args[1]['LifecycleConfiguration']['Rules']
+            self.assertEqual(rules, [{
+                'ID': 'zappa-async-payloads',
+                'Filter': {'Prefix': 'zappa-async/'},
+                'Status': 'Enabled',
+                'Expiration': {'Days': 3},
+            }])
+
+            # The bucket's other rules are kept, and ours is replaced.
+            s3_client.get_bucket_lifecycle_configuration.side_effect = None
+            s3_client.get_bucket_lifecycle_configuration.return_value = {'Rules': [{'ID': 'logs'}] + rules}
+            z.add_async_payload_expiration('payloads', days=7)
+            rules = s3_client.put_bucket_lifecycle_configuration.call_args[1]['LifecycleConfiguration']['Rules']
+            self.assertEqual([rule['ID'] for rule in rules], ['logs', 'zappa-async-payloads'])
+            self.assertEqual(rules[1]['Expiration'], {'Days': 7})
+
+    def test_add_offload_expiration(self):
+        z = Zappa()
+        with mock.patch.object(z, 's3_client') as s3_client:
+            # The offload rule doesn't replace the async payload rule in a shared bucket.
+            s3_client.get_bucket_lifecycle_configuration.return_value = {'Rules': [
+                {'ID': 'zappa-async-payloads', 'Filter': {'Prefix': 'zappa-async/'}},
+                {'ID': 'zappa-offload', 'Filter': {'Prefix': 'old/'}},
+            ]}
+            z.add_offload_expiration('bodies', days=1)
+            rules = s3_client.put_bucket_lifecycle_configuration.call_args[1]['LifecycleConfiguration']['Rules']
+            self.assertEqual([rule['ID'] for rule in rules], ['zappa-async-payloads', 'zappa-offload'])
+            self.assertEqual(rules[1], {
+                'ID': 'zappa-offload',
+                'Filter': {'Prefix': 'zappa-offload/'},
+                'Status': 'Enabled',
+                'Expiration': {'Days': 1},
+            })
 
     def test_update_aws_env_vars(self):
         z = Zappa()
@@ -593,6 +736,147 @@ class TestZappa(unittest.TestCase):
         le = common_log(environ, response, response_time=True)
         le = common_log(environ, response, response_time=False)
 
+    def test_wsgi_run_app(self):
+        closed = []
+
+        class AppIter:
+            def __iter__(self):
+                yield b'{"hello": '
+                yield '"world"}'
+
+            def close(self):
+                closed.append(True)
+
+        def app(environ, start_response):
+            start_response('201 CREATED', [('Content-Type', 'application/json'), ('X-Multi', 'a'), ('X-Multi', 'b')])
+            return AppIter()
+
+        response, body = run_wsgi_app(app, {})
+        self.assertEqual(body, b'{"hello": "world"}')
+        self.assertIs(response.get_data(), body)
+        self.assertEqual(closed, [True])
+
+        returndict = create_lambda_response(response, body, binary_support=True,
+                                            headers=True, multi_value_headers=True)
+        self.assertEqual(returndict['statusCode'], 201)
+        self.assertEqual(returndict['body'], '{"hello": "world"}')
+        self.assertNotIn('isBase64Encoded', returndict)
+        self.assertEqual(returndict['headers']['X-Multi'], 'b')
+        self.assertEqual(returndict['multiValueHeaders']['X-Multi'], ['a', 'b'])
+
+    def test_wsgi_binary_response(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'image/png')])
+            return [b'\x89PNG']
+
+        response, body = run_wsgi_app(app, {})
+        returndict = create_lambda_response(response, body, binary_support=True, headers=False, elb=True)
+        self.assertEqual(returndict['body'], 'iVBORw==')
+        self.assertTrue(returndict['isBase64Encoded'])
+        self.assertEqual(returndict['statusDescription'], '200 OK')
+        self.assertNotIn('headers', returndict)
+        self.assertNotIn('multiValueHeaders', returndict)
+
+    def test_wsgi_compressed_response(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', '2000')])
+            return [b'{"a": 1}' * 250]
+
+        response, body = run_wsgi_app(app, {})
+        body = compress_response(response, body, 'deflate, gzip;q=0.8')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.headers['Content-Length'], str(len(body)))
+
+        returndict = create_lambda_response(response, body, binary_support=True)
+        self.assertTrue(returndict['isBase64Encoded'])
+        self.assertEqual(gzip.decompress(base64.b64decode(returndict['body'])), b'{"a": 1}' * 250)
+
+        # Too small, not an allowed mimetype, or not accepted by the client.
+        response, body = run_wsgi_app(app, {})
+        self.assertEqual(compress_response(response, b'{}', 'gzip'), b'{}')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(compress_response(response, body, 'gzip', mimetypes=['text/*']), body)
+        self.assertEqual(compress_response(response, body, 'identity'), body)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_wsgi_request_body(self):
+        body = b'first line\nsecond line\n' + bytes(range(256))
+        event = {
+            'body': base64.b64encode(body).decode('ascii'),
+            'isBase64Encoded': True,
+            'headers': {'Content-Type': 'application/octet-stream'},
+            'httpMethod': 'PUT',
+            'path': '/upload',
+            'queryStringParameters': None,
+            'requestContext': {},
+        }
+        environ = create_wsgi_request(event, binary_support=True)
+        stream = environ['wsgi.input']
+        self.assertTrue(environ['wsgi.input_terminated'])
+        self.assertEqual(environ['CONTENT_LENGTH'], str(len(body)))
+        self.assertEqual(len(stream), len(body))
+
+        self.assertEqual(stream.readline(), b'first line\n')
+        self.assertEqual(stream.readline(4), b'seco')
+        buffer = bytearray(8)
+        self.assertEqual(stream.readinto(buffer), 8)
+        self.assertEqual(bytes(buffer), b'nd line\n')
+        self.assertEqual(stream.read(), bytes(range(256)))
+        self.assertEqual(stream.read(), b'')
+        stream.seek(0)
+        self.assertEqual(b''.join(stream), body)
+
+        # Every method gets a stream, empty without a body.
+        event.update(httpMethod='GET', body=None, isBase64Encoded=False)
+        environ = create_wsgi_request(event, binary_support=True)
+        self.assertIsInstance(environ['wsgi.input'], RequestBodyStream)
+        self.assertEqual(environ['wsgi.input'].read(), b'')
+        self.assertNotIn('CONTENT_LENGTH', environ)
+
+    def test_wsgi_payload_v2(self):
+        event = {
+            'version': '2.0',
+            'rawPath': '/items/%C3%BC',
+            'rawQueryString': 'a=%2F&b',
+            'cookies': ['a=1', 'b=2'],
+            'headers': {'content-type': 'text/plain'},
+            'requestContext': {
+                'http': {'method': 'POST', 'sourceIp': '192.0.2.1', 'protocol': 'HTTP/1.1'},
+                'stage': '$default',
+                'authorizer': {'jwt': {'claims': {'sub': 'user1'}, 'scopes': None}},
+            },
+            'body': base64.b64encode(b'\x00\x01').decode('ascii'),
+            'isBase64Encoded': True,
+        }
+        environ = create_wsgi_request(event)
+        self.assertEqual(environ['REQUEST_METHOD'], 'POST')
+        self.assertEqual(environ['PATH_INFO'], '/items/ü'.encode('utf-8').decode('iso-8859-1'))
+        self.assertEqual(environ['QUERY_STRING'], 'a=%2F&b')
+        self.assertEqual(environ['HTTP_COOKIE'], 'a=1; b=2')
+        self.assertEqual(environ['REMOTE_ADDR'], '192.0.2.1')
+        self.assertEqual(environ['REMOTE_USER'], 'user1')
+        self.assertEqual(environ['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(environ['wsgi.input'].read(), b'\x00\x01')
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'image/png'), ('Set-Cookie', 'a=1'),
+                                      ('set-cookie', 'b=2'), ('X-Multi', '1'), ('X-Multi', '2')])
+            return [b'\x89PNG']
+
+        response, body = run_wsgi_app(app, environ)
+        returndict = create_lambda_response(response, body, payload_version='2.0')
+        self.assertEqual(returndict['cookies'], ['a=1', 'b=2'])
+        self.assertEqual(returndict['headers'], {'Content-Type': 'image/png', 'X-Multi': '1, 2'})
+        self.assertTrue(returndict['isBase64Encoded'])
+
+    def test_get_accepted_encoding(self):
+        self.assertEqual(get_accepted_encoding('gzip, deflate'), 'gzip')
+        self.assertEqual(get_accepted_encoding('*'), get_accepted_encoding('br, gzip'))
+        self.assertIsNone(get_accepted_encoding(''))
+        self.assertIsNone(get_accepted_encoding('gzip;q=0, deflate'))
+
     def test_wsgi_multipart(self):
         #event = {'body': 'LS0tLS0tLS0tLS0tLS0tLS0tLS0tLS0tLS0tLS03Njk1MjI4NDg0Njc4MTc2NTgwNjMwOTYxDQpDb250ZW50LURpc3Bvc2l0aW9uOiBmb3JtLWRhdGE7IG5hbWU9Im15c3RyaW5nIg0KDQpkZGQNCi0tLS0tLS0tLS0tLS0tLS0tLS0tLS0tLS0tLS0tNzY5NTIyODQ4NDY3ODE3NjU4MDYzMDk2MS0tDQo=', 'headers': {'Content-Type': 'multipart/form-data; boundary=---------------------------7695228484678176580630961', 'Via': '1.1 38205a04d96d60185e88658d3185ccee.cloudfront.net (CloudFront)', 'Accept-Language': 'en-US,en;q=0.5', 'Accept-Encoding': 'gzip, deflate, br', 'CloudFront-Is-SmartTV-Viewer': 'false', 'CloudFront-Forwarded-Proto': 'https', 'X-Forwarded-For': '71.231.27.57, 104.246.180.51', 'CloudFront-Viewer-Country': 'US', 'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8', 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.10; rv:45.0) Gecko/20100101 Firefox/45.0', 'Host': 'xo2z7zafjh.execute-api.us-east-1.amazonaws.com', 'X-Forwarded-Proto': 'https', 'Cookie': 'zappa=AQ4', 'CloudFront-Is-Tablet-Viewer': 'false', 'X-Forwarded-Port': '443', 'Referer': 'https://xo8z7zafjh.execute-api.us-east-1.amazonaws.com/former/post', 'CloudFront-Is-Mobile-Viewer': 'false', 'X-Amz-Cf-Id': '31zxcUcVyUxBOMk320yh5NOhihn5knqrlYQYpGGyOngKKwJb0J0BAQ==', 'CloudFront-Is-Desktop-Viewer': 'true'}, 'params': {'parameter_1': 'post'}, 'method': 'POST', 'query': {}}
 
@@ -767,6 +1051,56 @@ class TestZappa(unittest.TestCase):
         zappa_cli.load_settings('test_settings.json')
         self.assertEqual(6, zappa_cli.stage_config['lambda_concurrency'])
 
+    def test_load_settings_http_api_rejects_rest_only_settings(self):
+        for setting, value in [('api_key_required', True), ('domain', 'api.example.com'),
+                               ('iam_authorization', True), ('authorizer', {'function': 'app.authorize'})]:
+            zappa_cli = ZappaCLI()
+            zappa_cli.api_stage = 'ttt888'
+            zappa_cli.override_stage_config_setting('apigateway_version', 'v2')
+            zappa_cli.override_stage_config_setting(setting, value)
+            with self.assertRaises(ClickException):
+                zappa_cli.load_settings('test_settings.json')
+
+        zappa_cli = ZappaCLI()
+        zappa_cli.api_stage = 'ttt888'
+        zappa_cli.override_stage_config_setting('apigateway_version', 'v2')
+        zappa_cli.load_settings('test_settings.json')
+        self.assertEqual('v2', zappa_cli.apigateway_version)
+
+    def test_load_settings_response_streaming_runtime(self):
+        zappa_cli = ZappaCLI()
+        zappa_cli.api_stage = 'ttt888'
+        zappa_cli.override_stage_config_setting('response_streaming', True)
+        zappa_cli.override_stage_config_setting('runtime', 'python3.7')
+        with self.assertRaises(ClickException):
+            zappa_cli.load_settings('test_settings.json')
+
+        zappa_cli.override_stage_config_setting('runtime', 'python3.8')
+        zappa_cli.load_settings('test_settings.json')
+        self.assertTrue(zappa_cli.function_url)
+
+        # The streaming runtime wouldn't call a custom handler.
+        zappa_cli.override_stage_config_setting('lambda_handler', 'my_handler.lambda_handler')
+        with self.assertRaises(ClickException):
+            zappa_cli.load_settings('test_settings.json')
+
+    def test_create_preload_manifest(self):
+        zappa_cli = ZappaCLI()
+        zappa_cli.api_stage = 'ttt888'
+        zappa_cli.load_settings('test_settings.json')
+        zappa_cli.app_function = 'myapp.app'
+        records = [ImportRecord('heavy', 9000, 10000, 1), ImportRecord('myapp', 100, 10100, 0)]
+
+        # The app is only traced when asked to.
+        zappa_cli.override_stage_config_setting('preload_modules', ['extra'])
+        with mock.patch('zappa.cli.trace_imports', return_value=records) as trace_imports:
+            self.assertEqual(zappa_cli.create_preload_manifest()['preload'], ['extra'])
+            trace_imports.assert_not_called()
+
+            zappa_cli.override_stage_config_setting('preload_trace', True)
+            self.assertEqual(zappa_cli.create_preload_manifest()['preload'], ['extra', 'heavy'])
+            self.assertEqual(trace_imports.call_args[0][0], ['myapp'])
+
     def test_load_settings_yml(self):
         zappa_cli = ZappaCLI()
         zappa_cli.api_stage = 'ttt888'
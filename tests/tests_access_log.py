@@ -0,0 +1,114 @@
+# -*- coding: utf8 -*-
+import io
+import json
+import logging
+import unittest
+
+from mock import Mock, patch
+from requestlogger import ApacheFormatter
+
+from zappa.access_log import AccessLogger
+from zappa.handler import LambdaHandler
+from zappa.wsgi import create_wsgi_request
+
+
+def make_environ():
+    event = {
+        'body': 'hello',
+        'resource': '/{proxy+}',
+        'requestContext': {},
+        'queryStringParameters': None,
+        'headers': {'Host': 'example.com', 'User-Agent': 'tests', 'X-Forwarded-For': '10.0.0.1, 10.0.0.2'},
+        'httpMethod': 'POST',
+        'path': '/items',
+    }
+    environ = create_wsgi_request(event, script_name='/dev')
+    environ['lambda.event'] = event
+    environ['lambda.context'] = Mock(aws_request_id='request-1')
+    return environ
+
+
+class TestAccessLog(unittest.TestCase):
+    def tearDown(self):
+        LambdaHandler._LambdaHandler__instance = None
+        LambdaHandler.settings = None
+        LambdaHandler.settings_name = None
+
+    def test_json_records(self):
+        stream = io.StringIO()
+        access_logger = AccessLogger(format='json', sample_rates={'2xx': 0}, stream=stream)
+
+        # Sampled out
+        self.assertIsNone(access_logger.log(make_environ(), 200, 10, response_time=1.5))
+        access_logger.log(make_environ(), 503, 10, response_time=1.5)
+        self.assertEqual(stream.getvalue(), '')
+
+        access_logger.flush()
+        record = json.loads(stream.getvalue())
+        self.assertEqual(record['request_id'], 'request-1')
+        self.assertEqual(record['route'], '/{proxy+}')
+        self.assertEqual(record['path'], '/dev/items')
+        self.assertEqual(record['status'], 503)
+        self.assertEqual(record['latency_ms'], 1.5)
+        self.assertEqual(record['bytes_in'], 5)
+        self.assertEqual(record['bytes_out'], 10)
+        self.assertEqual(record['remote_addr'], '10.0.0.1')
+        self.assertEqual(record['user_agent'], 'tests')
+        self.assertTrue(record['cold_start'])
+
+        access_logger.log(make_environ(), 404, 0)
+        access_logger.flush()
+        self.assertFalse(json.loads(stream.getvalue().splitlines()[-1])['cold_start'])
+
+        with patch('random.random', return_value=0.05):
+            access_logger.sample_rates['2xx'] = 0.1
+            self.assertEqual(json.loads(access_logger.log(make_environ(), 200, 0))['sample_rate'], 0.1)
+
+        with self.assertRaises(ValueError):
+            AccessLogger(format='xml')
+
+    def test_common_records(self):
+        access_logger = AccessLogger()
+        environ = make_environ()
+        self.assertEqual(
+            access_logger.format_common(environ, 200, 10, response_time=1.5),
+            ApacheFormatter(with_response_time=True)(200, environ, 10, rt_us=1.5)
+        )
+
+        with patch.object(logging.getLogger(), 'info') as info:
+            access_logger.log(make_environ(), 200, 10, response_time=1.5)
+            access_logger.log(make_environ(), 201, 10, response_time=1.5)
+            info.assert_not_called()
+            access_logger.flush()
+
+            # Both records, in one write
+            self.assertEqual(info.call_count, 1)
+            lines = info.call_args[0][0].splitlines()
+            self.assertEqual(len(lines), 2)
+            self.assertIn('"POST /items HTTP/1.1" 200 10', lines[0])
+
+            access_logger.format = 'none'
+            access_logger.log(make_environ(), 200, 10)
+            access_logger.flush()
+            self.assertEqual(info.call_count, 1)
+
+    def test_handler_access_log(self):
+        lh = LambdaHandler('tests.test_wsgi_script_name_settings')
+        lh.access_logger = AccessLogger(format='json', stream=io.StringIO())
+        event = {
+            'body': None,
+            'resource': '/{proxy+}',
+            'requestContext': {},
+            'queryStringParameters': None,
+            'headers': {'Host': 'example.com'},
+            'pathParameters': {'proxy': 'return/request/url'},
+            'httpMethod': 'GET',
+            'stageVariables': {},
+            'path': '/return/request/url',
+        }
+        lh.handler(event, None)
+        lh.finish_invocation()
+
+        record = json.loads(lh.access_logger.stream.getvalue())
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['bytes_out'], len('https://example.com/return/request/url'))
@@ -0,0 +1,167 @@
+# -*- coding: utf8 -*-
+import io
+import os
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from zappa.archive import LazyArchiveFinder, RangedS3Reader, load_project_archive, read_build_marker
+
+
+def make_tarball(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as t:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            t.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def make_zip(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, content in files.items():
+            z.writestr(name, content)
+    return buf.getvalue()
+
+
+class FakeS3Client:
+    """
+    Serves a single object, honouring Range and IfMatch like S3 does.
+    """
+    def __init__(self, data, etag='"1"'):
+        self.data = data
+        self.etag = etag
+        self.ranges = []
+
+    def head_object(self, Bucket, Key):
+        return {'ETag': self.etag, 'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        if IfMatch is not None and IfMatch != self.etag:
+            raise Exception('PreconditionFailed')
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', Range).groups())
+        self.ranges.append((start, end))
+        return {'Body': io.BytesIO(self.data[start:end + 1])}
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.project_folder = os.path.join(self.tmp, 'project')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, *path):
+        with open(os.path.join(self.project_folder, *path), 'rb') as f:
+            return f.read()
+
+    def test_ranged_reader(self):
+        data = os.urandom(1000)
+        client = FakeS3Client(data)
+        reader = RangedS3Reader(client, 'bucket', 'key', len(data), etag='"1"', chunk_size=64, concurrency=3)
+
+        self.assertEqual(io.BufferedReader(reader, 100).read(), data)
+        self.assertEqual(len(client.ranges), 16)
+        self.assertEqual(client.ranges[-1], (960, 999))
+        reader.close()
+
+    def test_load_project_archive(self):
+        files = {
+            'app.py': b'print("hello")\n',
+            'package/__init__.py': b'',
+            'package/data.json': os.urandom(5000),
+        }
+        client = FakeS3Client(make_tarball(files))
+
+        timings = load_project_archive(client, 'bucket', 'key', self.project_folder, chunk_size=100, concurrency=4)
+
+        self.assertEqual(list(timings.keys()), ['download', 'decompress', 'write', 'total'])
+        for name, content in files.items():
+            self.assertEqual(self.read(name), content)
+        self.assertEqual(read_build_marker(self.project_folder), '"1"')
+        self.assertEqual(os.listdir(self.tmp), ['project'])
+
+        # The same build is only extracted once.
+        client.ranges = []
+        self.assertIsNone(load_project_archive(client, 'bucket', 'key', self.project_folder))
+        self.assertEqual(client.ranges, [])
+
+    def test_load_project_archive_replaces_stale_build(self):
+        client = FakeS3Client(make_tarball({'old.py': b'old'}), etag='"1"')
+        load_project_archive(client, 'bucket', 'key', self.project_folder)
+
+        client = FakeS3Client(make_tarball({'new.py': b'new'}), etag='"2"')
+        load_project_archive(client, 'bucket', 'key', self.project_folder)
+
+        self.assertEqual(sorted(os.listdir(self.project_folder)), ['.zappa_build', 'new.py'])
+        self.assertEqual(read_build_marker(self.project_folder), '"2"')
+        self.assertEqual(os.listdir(self.tmp), ['project'])
+
+    def test_load_project_archive_keeps_build_on_failure(self):
+        client = FakeS3Client(make_tarball({'old.py': b'old'}), etag='"1"')
+        load_project_archive(client, 'bucket', 'key', self.project_folder)
+
+        client = FakeS3Client(b'this is not a tarball', etag='"2"')
+        with self.assertRaises(Exception):
+            load_project_archive(client, 'bucket', 'key', self.project_folder)
+
+        self.assertEqual(self.read('old.py'), b'old')
+        self.assertEqual(read_build_marker(self.project_folder), '"1"')
+        self.assertEqual(os.listdir(self.tmp), ['project'])
+
+    def test_load_lazy_project_archive(self):
+        files = {
+            'lazy_module.py': b'VALUE = 1\n',
+            'templates/index.html': b'<html></html>',
+            'lazy_package/__init__.py': b'',
+            'lazy_package/sub.py': b'VALUE = 2\n',
+            'lazy_package/data.json': b'{}',
+            'unused_package/__init__.py': b'',
+            'zipped_package/__init__.py': b'',
+            'zipped_package/sub.py': b'VALUE = 3\n',
+            'zipped_module.py': b'VALUE = 4\n',
+            'zipped-1.0.dist-info/RECORD': b'zipped_package/__init__.py,,\nzipped_package/sub.py,,\nzipped_module.py,,\n',
+        }
+        client = FakeS3Client(make_zip(files))
+
+        timings = load_project_archive(client, 'bucket', 'key', self.project_folder, lazy=True, chunk_size=64)
+        self.assertEqual(timings['decompress'], 0.0)
+
+        sys.path.insert(0, self.project_folder)
+        try:
+            # Modules and data folders are extracted up front, packages aren't.
+            self.assertEqual(self.read('templates', 'index.html'), b'<html></html>')
+            self.assertTrue(os.path.exists(os.path.join(self.project_folder, 'lazy_module.py')))
+            self.assertFalse(os.path.exists(os.path.join(self.project_folder, 'lazy_package')))
+
+            import lazy_package.sub
+            self.assertEqual(lazy_package.sub.VALUE, 2)
+            self.assertEqual(self.read('lazy_package', 'data.json'), b'{}')
+            self.assertFalse(os.path.exists(os.path.join(self.project_folder, 'unused_package')))
+
+            # Pure Python packages of installed distributions are imported from the zip.
+            import zipped_package.sub
+            import zipped_module
+            self.assertEqual(zipped_package.sub.VALUE, 3)
+            self.assertEqual(zipped_module.VALUE, 4)
+            self.assertIn('.zappa_archive.zip', zipped_package.sub.__file__)
+            self.assertFalse(os.path.exists(os.path.join(self.project_folder, 'zipped_package')))
+            self.assertFalse(os.path.exists(os.path.join(self.project_folder, 'zipped_module.py')))
+
+            # Mounting again reuses the finder.
+            finders = [f for f in sys.meta_path if isinstance(f, LazyArchiveFinder)]
+            self.assertIsNone(load_project_archive(client, 'bucket', 'key', self.project_folder, lazy=True))
+            self.assertEqual([f for f in sys.meta_path if isinstance(f, LazyArchiveFinder)], finders)
+        finally:
+            sys.path.remove(self.project_folder)
+            sys.meta_path[:] = [f for f in sys.meta_path if not isinstance(f, LazyArchiveFinder)]
+            for name in ['lazy_module', 'lazy_package', 'lazy_package.sub',
+                         'zipped_module', 'zipped_package', 'zipped_package.sub']:
+                sys.modules.pop(name, None)
@@ -1,7 +1,15 @@
 # -*- coding: utf8 -*-
+import asyncio
 import boto3
+import botocore
+import json
 import mock
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 try:
@@ -11,6 +19,67 @@ except ImportError:
 
 from zappa.asynchronous import AsyncException, LambdaAsyncResponse, SnsAsyncResponse
 from zappa.asynchronous import import_and_get_task, get_func_task_path
+from zappa.asynchronous import batch, pack_messages, route_lambda_task, run_many
+from zappa.asynchronous import BackgroundSender, flush, run
+from zappa.asynchronous import get_async_response
+from zappa.asynchronous import complete_map_chunk, map
+from zappa.asynchronous import get_async_responses, set_async_response, wait, wait_async
+from zappa.local_async import LocalAsyncResponse, apply_update, check_condition
+import zappa.asynchronous
+import zappa.local_async
+from zappa import clients
+from zappa.handler import LambdaHandler
+
+
+def square(x):
+    if x == 'fail':
+        raise ValueError(x)
+    return x * x
+
+
+map_callbacks = []
+
+
+def map_callback(results):
+    map_callbacks.append(results)
+
+
+class FakeResponseTable:
+    """
+    An in-memory async response table, for the expressions zappa.asynchronous uses.
+    """
+    def __init__(self):
+        self.items = {}
+        # How many keys the next BatchGetItem calls leave unprocessed
+        self.unprocessed = []
+        self.batch_get_calls = 0
+
+    def put_item(self, TableName, Item):
+        self.items[Item['id']['S']] = dict(Item)
+
+    def get_item(self, TableName, Key):
+        item = self.items.get(Key['id']['S'])
+        return {'Item': dict(item)} if item else {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues,
+                    ConditionExpression=None, ExpressionAttributeNames=None, ReturnValues=None):
+        item = dict(self.items.get(Key['id']['S'], {'id': Key['id']}))
+        if ConditionExpression and not check_condition(item, ConditionExpression, ExpressionAttributeValues):
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        self.items[Key['id']['S']] = apply_update(item, UpdateExpression, ExpressionAttributeValues,
+                                                  ExpressionAttributeNames)
+        return {'Attributes': dict(item)}
+
+    def batch_get_item(self, RequestItems):
+        self.batch_get_calls += 1
+        (table_name, request), = RequestItems.items()
+        assert len(request['Keys']) <= 100
+        unprocessed = self.unprocessed.pop(0) if self.unprocessed else 0
+        keys, unprocessed_keys = request['Keys'][unprocessed:], request['Keys'][:unprocessed]
+        return {
+            'Responses': {table_name: [self.items[key['id']['S']] for key in keys if key['id']['S'] in self.items]},
+            'UnprocessedKeys': {table_name: {'Keys': unprocessed_keys}} if unprocessed_keys else {},
+        }
 
 
 class TestZappa(unittest.TestCase):
@@ -90,3 +159,423 @@ class TestZappa(unittest.TestCase):
                                              lambda_function_name="MyLambda")
         lambda_async_mock.return_value.send.assert_called_with(
             get_func_task_path(async_me), ("qux",), {})
+
+    def test_batched_dispatch(self):
+        """
+        Tasks dispatched in a batch are sent in as few invocations as possible.
+        """
+        async_me = import_and_get_task("tests.test_app.async_me")
+        lambda_client = mock.Mock()
+        lambda_client.invoke.return_value = {'StatusCode': 202}
+        boto_session = mock.Mock()
+        boto_session.client.return_value = lambda_client
+        options = {
+            'AWS_LAMBDA_FUNCTION_NAME': 'MyLambda',
+            'AWS_REGION': 'us-east-1'
+        }
+        with mock.patch.dict(os.environ, options):
+            with batch():
+                responses = run_many(
+                    [(async_me, (str(i),), {}) for i in range(3)], boto_session=boto_session)
+                self.assertFalse(any(response.sent for response in responses))
+                lambda_client.invoke.assert_not_called()
+
+        self.assertTrue(all(response.sent for response in responses))
+        lambda_client.invoke.assert_called_once()
+        payload = json.loads(lambda_client.invoke.call_args[1]['Payload'].decode('utf-8'))
+        self.assertEqual(payload['command'], 'zappa.asynchronous.route_lambda_task')
+        self.assertEqual([message['args'] for message in payload['batch']], [['0'], ['1'], ['2']])
+
+        # The receiving side runs each task of the batch.
+        self.assertEqual(route_lambda_task(payload, None), [
+            "run async when on lambda 0",
+            "run async when on lambda 1",
+            "run async when on lambda 2",
+        ])
+
+        payload['batch'].insert(1, dict(payload['batch'][0], task_path='tests.test_app.missing'))
+        with self.assertRaises(AsyncException):
+            route_lambda_task(payload, None)
+
+    def test_pack_messages(self):
+        messages = [{'task_path': 'a.b', 'args': ['x' * 100]} for i in range(10)]
+        size = len(json.dumps(messages[0]))
+        self.assertEqual(pack_messages(messages, 100000), [(0, 10)])
+
+        # Three messages fit in each batch.
+        packs = pack_messages(messages, 100 + 3 * size)
+        self.assertEqual(packs, [(0, 3), (3, 6), (6, 9), (9, 10)])
+        for start, end in packs:
+            payload = json.dumps({'batch': messages[start:end], 'command': 'zappa.asynchronous.route_lambda_task'})
+            self.assertLessEqual(len(payload), 100 + 3 * size)
+
+        with self.assertRaises(AsyncException):
+            pack_messages(messages, size)
+
+    def test_background_sender(self):
+        """
+        With sender threads, dispatching returns before the message is sent.
+        """
+        async_me = import_and_get_task("tests.test_app.async_me")
+        release = threading.Event()
+        lambda_client = mock.Mock()
+        lambda_client.invoke.side_effect = lambda **kwargs: release.wait(5) and {'StatusCode': 202}
+        boto_session = mock.Mock()
+        boto_session.client.return_value = lambda_client
+
+        with mock.patch('zappa.asynchronous.ASYNC_SENDER_THREADS', 2), \
+                mock.patch('zappa.asynchronous._sender', BackgroundSender(2, 10)):
+            response = run(async_me, ('1',), remote_aws_lambda_function_name='MyLambda',
+                           remote_aws_region='us-east-1', boto_session=boto_session)
+            self.assertFalse(response.sent)
+            self.assertFalse(flush(0.01))
+
+            with batch():
+                responses = run_many([(async_me, (str(i),), {}) for i in range(3)],
+                                     remote_aws_lambda_function_name='MyLambda',
+                                     remote_aws_region='us-east-1', boto_session=boto_session)
+
+            release.set()
+            self.assertTrue(flush(5))
+            self.assertTrue(response.wait())
+            self.assertTrue(all(r.wait() for r in responses))
+            self.assertEqual(lambda_client.invoke.call_count, 2)
+
+            # Errors are kept on the response.
+            lambda_client.invoke.side_effect = ValueError('throttled')
+            response = run(async_me, ('1',), remote_aws_lambda_function_name='MyLambda',
+                           remote_aws_region='us-east-1', boto_session=boto_session)
+            self.assertTrue(flush(5))
+            self.assertIsInstance(response.error, ValueError)
+            with self.assertRaises(ValueError):
+                response.wait()
+
+    def test_sqs_batch_send_and_consume(self):
+        """
+        Batched SQS tasks are sent ten to a call, and a failed one is reported alone.
+        """
+        async_me = import_and_get_task("tests.test_app.async_me")
+        sqs_client = mock.Mock()
+        sqs_client.send_message_batch.side_effect = lambda QueueUrl, Entries: {
+            'Successful': [{'Id': entry['Id'], 'MessageId': 'm' + entry['Id']} for entry in Entries]
+        }
+        boto_session = mock.Mock()
+        boto_session.client.return_value = sqs_client
+
+        responses = run_many([(async_me, (str(i),), {}) for i in range(23)], service='sqs',
+                             remote_aws_lambda_function_name='MyLambda', remote_aws_region='us-east-1',
+                             boto_session=boto_session, queue_url='https://queue')
+        self.assertEqual(sqs_client.send_message_batch.call_count, 3)
+        self.assertEqual([r.sent for r in responses], ['m{}'.format(i) for i in range(23)])
+
+        entries = sqs_client.send_message_batch.call_args[1]['Entries']
+        self.assertEqual(len(entries), 3)
+        entries[1]['MessageBody'] = entries[1]['MessageBody'].replace('async_me', 'missing')
+
+        # Failed entries are reported.
+        sqs_client.send_message_batch.side_effect = None
+        sqs_client.send_message_batch.return_value = {'Failed': [{'Id': '1', 'Code': 'Throttled'}]}
+        with self.assertRaises(AsyncException):
+            run_many([(async_me, (str(i),), {}) for i in range(2)], service='sqs',
+                     boto_session=boto_session, queue_url='https://queue')
+
+        event = {
+            'Records': [{
+                'eventSource': 'aws:sqs',
+                'eventSourceARN': 'arn:aws:sqs:us-east-1:123456789012:MyLambda-zappa-async',
+                'messageId': entry['Id'],
+                'body': entry['MessageBody'],
+                'messageAttributes': {
+                    name: {'stringValue': value['StringValue'], 'dataType': value['DataType']}
+                    for name, value in entry['MessageAttributes'].items()
+                },
+            } for entry in entries]
+        }
+        try:
+            lh = LambdaHandler('tests.test_event_routing_settings')
+            self.assertEqual(lh.handler(event, None), {'batchItemFailures': [{'itemIdentifier': '21'}]})
+        finally:
+            LambdaHandler._LambdaHandler__instance = None
+            LambdaHandler.settings = None
+            LambdaHandler.settings_name = None
+
+    def test_large_payloads(self):
+        """
+        Large arguments and results travel through S3, by reference.
+        """
+        async_me = import_and_get_task("tests.test_app.async_me")
+        objects = {}
+        s3_client = mock.Mock()
+        s3_client.put_object.side_effect = lambda Bucket, Key, Body, **kwargs: objects.update({Key: Body})
+        s3_client.get_object.side_effect = lambda Bucket, Key: {'Body': mock.Mock(read=lambda: objects[Key])}
+        lambda_client = mock.Mock()
+        lambda_client.invoke.return_value = {'StatusCode': 202}
+        boto_session = mock.Mock()
+        boto_session.client.side_effect = lambda name: s3_client if name == 's3' else lambda_client
+        dynamodb_client = mock.Mock()
+
+        with mock.patch.multiple('zappa.asynchronous', ASYNC_PAYLOAD_BUCKET='payloads', ASYNC_PAYLOAD_THRESHOLD=1000,
+                                 ASYNC_RESPONSE_TABLE='responses', S3_CLIENT=s3_client,
+                                 DYNAMODB_CLIENT=dynamodb_client, create=True):
+            big = 'x' * 300000
+            response = run(async_me, (big,), {'foo': '!'}, capture_response=True,
+                           remote_aws_lambda_function_name='MyLambda', boto_session=boto_session)
+            self.assertTrue(response.sent)
+            payload = json.loads(lambda_client.invoke.call_args[1]['Payload'].decode('utf-8'))
+            self.assertNotIn('args', payload)
+            self.assertTrue(payload['payload']['key'].startswith('zappa-async/'))
+            self.assertEqual(len(objects), 1)
+            self.assertLess(len(objects[payload['payload']['key']]), 5000)
+
+            # Small arguments are sent inline.
+            run(async_me, ('small',), remote_aws_lambda_function_name='MyLambda', boto_session=boto_session)
+            self.assertEqual(json.loads(lambda_client.invoke.call_args[1]['Payload'].decode('utf-8'))['args'],
+                             ['small'])
+
+            self.assertEqual(route_lambda_task(payload, None), "run async when on lambda %s!" % big)
+            values = dynamodb_client.update_item.call_args[1]['ExpressionAttributeValues']
+            self.assertEqual(json.loads(values[':r']['S']), None)
+            self.assertEqual(len(objects), 2)
+
+            dynamodb_client.get_item.return_value = {'Item': {
+                'async_status': {'S': 'complete'},
+                'async_response': values[':r'],
+                'async_response_payload': values[':p'],
+            }}
+            self.assertEqual(get_async_response(response.response_id), {
+                'status': 'complete',
+                'response': "run async when on lambda %s!" % big,
+            })
+
+    def test_map(self):
+        """
+        A map's chunks run in lanes, and its callback runs once they're all done.
+        """
+        invocations = []
+        lambda_client = mock.Mock()
+        lambda_client.invoke.side_effect = lambda **kwargs: invocations.append(
+            json.loads(kwargs['Payload'].decode('utf-8'))) or {'StatusCode': 202}
+        table = FakeResponseTable()
+        options = {
+            'AWS_LAMBDA_FUNCTION_NAME': 'MyLambda',
+            'AWS_REGION': 'us-east-1'
+        }
+        del map_callbacks[:]
+
+        with mock.patch.dict(os.environ, options), \
+                mock.patch.multiple('zappa.asynchronous', LAMBDA_CLIENT=lambda_client, DYNAMODB_CLIENT=table,
+                                    ASYNC_RESPONSE_TABLE='responses', create=True):
+            result = map(square, range(5), chunk_size=2, max_in_flight=2, callback=map_callback)
+            self.assertEqual(len(invocations), 2)
+            self.assertFalse(result.done())
+
+            # Run the invocations, as Lambda would.
+            invocation_count = 0
+            while invocations:
+                route_lambda_task(invocations.pop(0), None)
+                invocation_count += 1
+            self.assertEqual(invocation_count, 4)
+
+            self.assertTrue(result.done())
+            self.assertEqual(result.results(), [0, 1, 4, 9, 16])
+            self.assertEqual(sorted(result.as_completed()), [(0, 0), (1, 1), (2, 4), (3, 9), (4, 16)])
+            self.assertEqual(map_callbacks, [[0, 1, 4, 9, 16]])
+
+            # A retried chunk doesn't complete the map again.
+            self.assertFalse(complete_map_chunk(result.map_id, 2, 'tests.tests_async.map_callback'))
+
+            # Chunk rows expire, and each completed chunk extends the map row's life.
+            for index in range(3):
+                self.assertIn('ttl', table.items['{}:{}'.format(result.map_id, index)])
+            self.assertGreater(int(table.items[result.map_id]['ttl']['N']),
+                               time.time() + zappa.asynchronous.ASYNC_RESPONSE_TTL)
+
+            # A failed chunk fails the map once Lambda's retries are exhausted, but the rest of its lane
+            # still runs, with the map's dispatch options, and the callback gets None for its items.
+            del map_callbacks[:]
+            lambda_client.invoke.reset_mock()
+            result = map(square, [1, 'fail', 3, 4], max_in_flight=1, callback=map_callback,
+                         remote_aws_lambda_function_name='OtherLambda')
+            route_lambda_task(invocations.pop(0), None)
+            failing = invocations.pop(0)
+            for attempt in range(2):
+                with self.assertRaises(ValueError):
+                    route_lambda_task(failing, None)
+                self.assertEqual(invocations, [])
+            route_lambda_task(failing, None)
+            self.assertEqual(table.items[result.map_id + ':1']['async_status'], {'S': 'failed'})
+            self.assertFalse(result.done())
+            while invocations:
+                route_lambda_task(invocations.pop(0), None)
+
+            self.assertTrue(result.done())
+            self.assertEqual(table.items[result.map_id]['async_status'], {'S': 'failed'})
+            with self.assertRaises(AsyncException):
+                result.results()
+            self.assertEqual(result.errors, {1: "ValueError('fail')"})
+            self.assertEqual(result.results(raise_failed=False), [1, None, 9, 16])
+            self.assertEqual(map_callbacks, [[1, None, 9, 16]])
+            self.assertEqual({call[1]['FunctionName'] for call in lambda_client.invoke.call_args_list},
+                             {'OtherLambda'})
+
+            # A chunk of an expired map can't complete it.
+            del table.items[result.map_id]
+            with self.assertRaises(AsyncException):
+                complete_map_chunk(result.map_id, 0)
+
+        # Outside of Lambda, the items are mapped synchronously.
+        self.assertEqual(map(square, range(3), chunk_size=2).results(), [0, 1, 4])
+
+    def test_wait_for_responses(self):
+        """
+        Responses are fetched a hundred at a time, and yielded as they complete.
+        """
+        table = FakeResponseTable()
+        with mock.patch.multiple('zappa.asynchronous', DYNAMODB_CLIENT=table,
+                                 ASYNC_RESPONSE_TABLE='responses', create=True):
+            ids = [str(i) for i in range(150)]
+            for response_id in ids[:149]:
+                set_async_response(response_id, int(response_id))
+
+            table.unprocessed = [30]
+            responses = get_async_responses(ids + ['0'])
+            self.assertEqual(table.batch_get_calls, 3)
+            self.assertEqual(responses['42'], {'status': 'complete', 'response': 42})
+            self.assertIsNone(responses['149'])
+
+            # The last task completes while waiting for it.
+            sleeps = []
+
+            def sleep(delay):
+                sleeps.append(delay)
+                if len(sleeps) == 3:
+                    set_async_response('149', 149)
+
+            with mock.patch('zappa.asynchronous.time.sleep', side_effect=sleep):
+                completed = list(wait(ids, timeout=60))
+            self.assertEqual(len(completed), 150)
+            self.assertEqual(completed[-1], ('149', {'status': 'complete', 'response': 149}))
+            self.assertEqual(len(sleeps), 3)
+            self.assertTrue(all(delay <= 5 for delay in sleeps))
+
+            table.items['149']['async_status'] = {'S': 'in progress'}
+            with self.assertRaises(AsyncException):
+                list(wait(['149'], timeout=0))
+
+            # The deadline passing just before sleeping doesn't make the delay negative.
+            sleeps = []
+            with mock.patch('zappa.asynchronous.time.time', side_effect=[0, 0.5, 2, 3]), \
+                    mock.patch('zappa.asynchronous.time.sleep', side_effect=sleeps.append):
+                with self.assertRaises(AsyncException):
+                    list(wait(['149'], timeout=1))
+            self.assertEqual(sleeps, [0])
+
+            async def wait_for_all():
+                return [response_id async for response_id, response in wait_async(ids[:10])]
+
+            self.assertEqual(asyncio.get_event_loop().run_until_complete(wait_for_all()), ids[:10])
+
+    def test_shared_clients(self):
+        """
+        Clients are created on first use and shared, and the account id is only asked for once.
+        """
+        session = mock.Mock()
+        session.client.return_value.get_caller_identity.return_value = {'Account': '123456789012'}
+        clients.reset()
+        try:
+            with mock.patch('boto3.Session', return_value=session):
+                self.assertIs(clients.get_client('sns'), clients.get_client('sns'))
+                session.client.assert_called_once()
+                self.assertEqual(session.client.call_args[1]['config'].max_pool_connections,
+                                 clients.CLIENT_MAX_POOL_CONNECTIONS)
+
+                for i in range(2):
+                    response = SnsAsyncResponse(lambda_function_name='MyLambda', aws_region='us-east-1')
+                self.assertEqual(response.arn, 'arn:aws:sns:us-east-1:123456789012:MyLambda-zappa-async')
+                self.assertEqual(session.client.return_value.get_caller_identity.call_count, 1)
+        finally:
+            clients.reset()
+
+    def test_local_thread_backend(self):
+        """
+        Outside of Lambda, a local backend runs tasks concurrently, and captures their responses.
+        """
+        async_me = import_and_get_task("tests.test_app.async_me")
+        del map_callbacks[:]
+        with mock.patch('zappa.asynchronous.ASYNC_LOCAL_BACKEND', 'thread'), \
+                mock.patch.multiple('zappa.local_async', ASYNC_LOCAL_STORE=None, _local_executor=None,
+                                    _local_table=None):
+            response = async_me('1', foo='!')
+            self.assertIsInstance(response, LocalAsyncResponse)
+            self.assertTrue(response.sent)
+            self.assertTrue(flush(5))
+            self.assertEqual(get_async_response(response.response_id),
+                             {'status': 'complete', 'response': 'run async when on lambda 1!'})
+
+            # Messages are checked as they would be on Lambda.
+            with self.assertRaises(TypeError):
+                async_me(object())
+            with self.assertRaises(AsyncException):
+                async_me('x' * 300000)
+
+            result = map(square, range(5), chunk_size=2, max_in_flight=2, callback=map_callback)
+            self.assertEqual(result.results(timeout=10), [0, 1, 4, 9, 16])
+            self.assertTrue(flush(5))
+            self.assertEqual(map_callbacks, [[0, 1, 4, 9, 16]])
+
+            # With a payload bucket, large arguments and responses still stay local.
+            s3_client = mock.Mock()
+            with mock.patch.multiple('zappa.asynchronous', ASYNC_PAYLOAD_BUCKET='payloads',
+                                     ASYNC_PAYLOAD_THRESHOLD=10, S3_CLIENT=s3_client):
+                response = async_me('x' * 100)
+                self.assertTrue(flush(5))
+                self.assertEqual(get_async_response(response.response_id)['response'],
+                                 'run async when on lambda {}'.format('x' * 100))
+            self.assertEqual(s3_client.mock_calls, [])
+
+        # Without one, tasks are run synchronously.
+        self.assertEqual(async_me('1'), 'run async when on lambda 1')
+
+    def test_local_backend_imported_lazily(self):
+        code = 'import sys, zappa.asynchronous; print("zappa.local_async" in sys.modules, "sqlite3" in sys.modules)'
+        output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True)
+        self.assertEqual(output.strip(), 'False False')
+
+    def test_local_process_backend(self):
+        async_me = import_and_get_task("tests.test_app.async_me")
+        store = tempfile.NamedTemporaryFile(suffix='.sqlite')
+        with store, mock.patch('zappa.asynchronous.ASYNC_LOCAL_BACKEND', 'process'), \
+                mock.patch.multiple('zappa.local_async', ASYNC_LOCAL_STORE=store.name, _local_executor=None,
+                                    _local_table=None):
+            responses = [async_me(str(i)) for i in range(4)]
+            self.assertTrue(flush(30))
+            completed = dict(wait([response.response_id for response in responses], timeout=10))
+            self.assertEqual(completed[responses[3].response_id]['response'], 'run async when on lambda 3')
+            zappa.local_async._local_executor.executor.shutdown()
+
+    def test_local_process_store_removed_at_exit(self):
+        """
+        The process backend's store is removed at exit, if it was made rather than given.
+        """
+        with mock.patch('zappa.asynchronous.ASYNC_LOCAL_BACKEND', 'process'), \
+                mock.patch.multiple('zappa.local_async', ASYNC_LOCAL_STORE=None, _local_executor=None,
+                                    _local_table=None, LocalExecutor=mock.Mock()), \
+                mock.patch.dict(os.environ), mock.patch('zappa.local_async.atexit.register') as register:
+            zappa.local_async.get_local_executor()
+            path = zappa.local_async.ASYNC_LOCAL_STORE
+            self.assertEqual(os.environ['ZAPPA_ASYNC_LOCAL_STORE'], path)
+            register.assert_called_once_with(zappa.local_async.remove_local_store, path, os.getpid())
+
+        self.assertTrue(os.path.exists(path))
+        zappa.local_async.remove_local_store(path, os.getpid() + 1)
+        self.assertTrue(os.path.exists(path))
+        zappa.local_async.remove_local_store(path, os.getpid())
+        self.assertFalse(os.path.exists(path))
+
+        store = tempfile.NamedTemporaryFile(suffix='.sqlite')
+        with store, mock.patch('zappa.asynchronous.ASYNC_LOCAL_BACKEND', 'process'), \
+                mock.patch.multiple('zappa.local_async', ASYNC_LOCAL_STORE=store.name, _local_executor=None,
+                                    _local_table=None, LocalExecutor=mock.Mock()), \
+                mock.patch('zappa.local_async.atexit.register') as register:
+            zappa.local_async.get_local_executor()
+            register.assert_not_called()
@@ -1,9 +1,11 @@
 # -*- coding: utf8 -*-
 import sys
+import time
 import unittest
 
+from zappa.utilities import merge_headers
 from zappa.wsgi import create_wsgi_request
-from zappa.middleware import ZappaWSGIMiddleware, all_casings
+from zappa.middleware import ResponseCacheMiddleware, ZappaWSGIMiddleware, all_casings
 
 
 class TestWSGIMockMiddleWare(unittest.TestCase):
@@ -312,3 +314,152 @@ class TestWSGIMockMiddleWare(unittest.TestCase):
         environ = create_wsgi_request(event, script_name='http://zappa.com/',
                                       trailing_slash=False)
         self.assertEqual(environ['QUERY_STRING'], 'foo=1&foo=2')
+
+    def test_should_merge_headers_in_one_pass(self):
+        event = {
+            'httpMethod': 'POST',
+            'path': '/v1/runs',
+            'body': '{}',
+            'headers': {
+                'content-type': 'application/json',
+                'X-Forwarded-For': 'ignored',
+                'x-forwarded-proto': 'https',
+            },
+            'multiValueHeaders': {
+                'X-Forwarded-For': ['1.1.1.1,2.2.2.2', '3.3.3.3'],
+                'accept': ['text/html', 'application/json'],
+            },
+            'requestContext': {
+                'identity': {'sourceIp': '2.2.2.2'},
+            },
+        }
+        environ = create_wsgi_request(event, trailing_slash=False,
+                                      context_header_mappings={'x-source-ip': 'identity.sourceIp'})
+        self.assertEqual(environ['HTTP_X_FORWARDED_FOR'], '1.1.1.1,2.2.2.2, 3.3.3.3')
+        self.assertEqual(environ['REMOTE_ADDR'], '2.2.2.2')
+        self.assertEqual(environ['HTTP_ACCEPT'], 'text/html, application/json')
+        self.assertEqual(environ['CONTENT_TYPE'], 'application/json')
+        self.assertEqual(environ['HTTP_CONTENT_TYPE'], 'application/json')
+        self.assertEqual(environ['HTTP_X_SOURCE_IP'], '2.2.2.2')
+        self.assertEqual(environ['wsgi.url_scheme'], 'https')
+
+        # Headers merged by the handler give the same environ.
+        merged = create_wsgi_request(event, trailing_slash=False, headers=merge_headers(event),
+                                     context_header_mappings={'x-source-ip': 'identity.sourceIp'})
+        environ.pop('wsgi.input')
+        merged.pop('wsgi.input')
+        self.assertEqual(merged, environ)
+
+    def test_response_cache(self):
+        calls = []
+
+        def app(environ, start_response):
+            calls.append(environ)
+            if environ.get('HTTP_IF_NONE_MATCH') == '"v1"':
+                start_response('304 Not Modified', [('Cache-Control', 'max-age=60')])
+                return [b'']
+            start_response('200 OK', [('Cache-Control', 'max-age=60'), ('ETag', '"v1"'), ('Vary', 'Accept')])
+            return [b'catalog']
+
+        cache = ResponseCacheMiddleware(app)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/catalog', 'HTTP_ACCEPT': 'application/json'}
+
+        self.assertEqual(cache(dict(environ), self._start_response), [b'catalog'])
+        self.assertEqual(cache(dict(environ), self._start_response), [b'catalog'])
+        self.assertEqual(self.status, ['200 OK'])
+        self.assertIn(('Age', '0'), self.headers)
+        self.assertEqual(len(calls), 1)
+
+        # A HEAD request is served from the GET response.
+        self.assertEqual(cache(dict(environ, REQUEST_METHOD='HEAD'), self._start_response), [b''])
+        self.assertEqual(len(calls), 1)
+
+        # The client's own ETag is answered without a body.
+        self.assertEqual(cache(dict(environ, HTTP_IF_NONE_MATCH='"v1"'), self._start_response), [b''])
+        self.assertEqual(self.status, ['304 Not Modified'])
+
+        # Another value of a Vary header, another query or a POST reach the app.
+        cache(dict(environ, HTTP_ACCEPT='text/html'), self._start_response)
+        cache(dict(environ, QUERY_STRING='page=2'), self._start_response)
+        cache(dict(environ, REQUEST_METHOD='POST'), self._start_response)
+        self.assertEqual(len(calls), 4)
+
+        # A stale response is revalidated with its ETag.
+        cache.clear()
+        cache(dict(environ), self._start_response)
+        key = cache.get_cache_key(environ)
+        cache.entries[key] = cache.entries[key]._replace(stored_at=time.time() - 120)
+        self.assertEqual(cache(dict(environ), self._start_response), [b'catalog'])
+        self.assertEqual(calls[-1]['HTTP_IF_NONE_MATCH'], '"v1"')
+        self.assertEqual(self.status, ['200 OK'])
+        self.assertEqual(cache.stats['revalidations'], 1)
+        self.assertEqual(cache.stats['hits'], 3)
+
+    def test_response_cache_isolation(self):
+        """
+        Hosts, cookies and responses setting cookies aren't shared through the cache.
+        """
+        calls = []
+
+        def app(environ, start_response):
+            calls.append(environ)
+            headers = [('Cache-Control', environ.get('HTTP_X_CACHE_CONTROL', 'max-age=60'))]
+            if environ.get('HTTP_X_SET_COOKIE'):
+                headers.append(('Set-Cookie', 'session=' + environ['HTTP_X_SET_COOKIE']))
+            start_response('200 OK', headers)
+            return [environ.get('HTTP_HOST', '').encode('utf-8')]
+
+        cache = ResponseCacheMiddleware(app)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'HTTP_HOST': 'a.example.com'}
+
+        # Each host has its own entries.
+        self.assertEqual(cache(dict(environ), self._start_response), [b'a.example.com'])
+        self.assertEqual(cache(dict(environ, HTTP_HOST='b.example.com'), self._start_response), [b'b.example.com'])
+        self.assertEqual(cache(dict(environ), self._start_response), [b'a.example.com'])
+        self.assertEqual(len(calls), 2)
+
+        # Requests with cookies reach the app, and aren't stored.
+        for i in range(2):
+            cache(dict(environ, PATH_INFO='/me', HTTP_COOKIE='session=1'), self._start_response)
+        self.assertEqual(len(calls), 4)
+        self.assertNotIn(cache.get_cache_key(dict(environ, PATH_INFO='/me')), cache.entries)
+
+        # Unless the cache is keyed on them.
+        keyed = ResponseCacheMiddleware(app, key_headers=['Cookie'])
+        for i in range(2):
+            keyed(dict(environ, PATH_INFO='/me', HTTP_COOKIE='session=1'), self._start_response)
+        keyed(dict(environ, PATH_INFO='/me', HTTP_COOKIE='session=2'), self._start_response)
+        self.assertEqual(len(calls), 6)
+
+        # Responses setting cookies are only stored if they're public.
+        for i in range(2):
+            cache(dict(environ, PATH_INFO='/login', HTTP_X_SET_COOKIE='1'), self._start_response)
+        self.assertEqual(len(calls), 8)
+        for i in range(2):
+            cache(dict(environ, PATH_INFO='/banner', HTTP_X_SET_COOKIE='1',
+                       HTTP_X_CACHE_CONTROL='public, max-age=60'), self._start_response)
+        self.assertEqual(len(calls), 9)
+
+    def test_response_cache_eviction(self):
+        def app(environ, start_response):
+            headers = [('Cache-Control', environ.get('HTTP_X_CACHE_CONTROL', 'max-age=60'))]
+            start_response('200 OK', headers)
+            return [environ['PATH_INFO'].encode('utf-8') * 10]
+
+        cache = ResponseCacheMiddleware(app, max_entries=2, max_bytes=50)
+        for path in ['/a', '/b', '/a', '/c']:
+            cache({'REQUEST_METHOD': 'GET', 'PATH_INFO': path}, self._start_response)
+        self.assertEqual([key[0] for key in cache.entries], ['/a', '/c'])
+        self.assertEqual(cache.size, 40)
+        self.assertEqual(cache.stats['evictions'], 1)
+        self.assertEqual(cache.take_stats(), {'hits': 1, 'misses': 3, 'revalidations': 0,
+                                              'stores': 3, 'evictions': 1})
+        cache({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/c'}, self._start_response)
+        self.assertEqual(+cache.take_stats(), {'hits': 1})
+
+        # Bodies over the byte limit, and uncacheable responses, are never stored.
+        cache({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/toolong'}, self._start_response)
+        for cache_control in ['no-store', 'private, max-age=60', 'no-cache']:
+            cache({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/d', 'HTTP_X_CACHE_CONTROL': cache_control},
+                  self._start_response)
+        self.assertEqual([key[0] for key in cache.entries], ['/a', '/c'])
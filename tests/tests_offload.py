@@ -0,0 +1,137 @@
+# -*- coding: utf8 -*-
+import io
+import json
+import unittest
+
+import botocore
+from mock import Mock
+from werkzeug.wrappers import Response
+
+from zappa.handler import LambdaHandler
+from zappa.offload import OffloadError, S3Offloader, get_serialized_size, upload_body
+
+
+def make_s3_client():
+    s3_client = Mock()
+    s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    s3_client.upload_part.side_effect = lambda **kwargs: {'ETag': 'etag-{}'.format(kwargs['PartNumber'])}
+    s3_client.generate_presigned_url.side_effect = \
+        lambda method, Params, ExpiresIn: 'https://s3.example.com/{}?method={}'.format(Params['Key'], method)
+    return s3_client
+
+
+class TestOffload(unittest.TestCase):
+    def tearDown(self):
+        LambdaHandler._LambdaHandler__instance = None
+        LambdaHandler.settings = None
+        LambdaHandler.settings_name = None
+
+    def test_serialized_size(self):
+        self.assertEqual(get_serialized_size(10), 10)
+        self.assertEqual(get_serialized_size(10, base64_encoded=True), 16)
+
+    def test_upload_body(self):
+        s3_client = make_s3_client()
+        upload_body(s3_client, 'bucket', 'small', b'body', part_size=8)
+        s3_client.put_object.assert_called_once_with(Bucket='bucket', Key='small', Body=b'body')
+
+        upload_body(s3_client, 'bucket', 'large', b'0123456789abcdefXY', part_size=8, ContentType='text/csv')
+        s3_client.create_multipart_upload.assert_called_once_with(Bucket='bucket', Key='large', ContentType='text/csv')
+        parts = sorted((c[1]['PartNumber'], c[1]['Body']) for c in s3_client.upload_part.call_args_list)
+        self.assertEqual(parts, [(1, b'01234567'), (2, b'89abcdef'), (3, b'XY')])
+        s3_client.complete_multipart_upload.assert_called_once_with(
+            Bucket='bucket', Key='large', UploadId='upload-1', MultipartUpload={'Parts': [
+                {'PartNumber': 1, 'ETag': 'etag-1'},
+                {'PartNumber': 2, 'ETag': 'etag-2'},
+                {'PartNumber': 3, 'ETag': 'etag-3'},
+            ]})
+
+        # A failed upload is aborted.
+        s3_client.upload_part.side_effect = ValueError('network')
+        with self.assertRaises(ValueError):
+            upload_body(s3_client, 'bucket', 'large', b'0123456789abcdefXY', part_size=8)
+        s3_client.abort_multipart_upload.assert_called_once_with(Bucket='bucket', Key='large', UploadId='upload-1')
+
+    def test_offload_response(self):
+        offloader = S3Offloader('bucket', threshold=8, s3_client=make_s3_client())
+        self.assertFalse(offloader.should_offload(b'x' * 8))
+        self.assertTrue(offloader.should_offload(b'x' * 7, base64_encoded=True))
+
+        response = Response(b'a,b\n' * 10, mimetype='text/csv', headers={'Set-Cookie': 'a=1'})
+        body = offloader.offload_response(response, response.get_data())
+        self.assertEqual(body, b'')
+        self.assertEqual(response.status_code, 303)
+        self.assertTrue(response.headers['Location'].startswith('https://s3.example.com/zappa-offload/responses/'))
+        self.assertNotIn('Content-Type', response.headers)
+        self.assertEqual(response.headers['Set-Cookie'], 'a=1')
+
+        offloader.envelope = True
+        response = Response(b'a,b\n' * 10, mimetype='text/csv')
+        envelope = json.loads(offloader.offload_response(response, response.get_data()).decode('utf-8'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(envelope['size'], 40)
+        self.assertEqual(envelope['content_type'], 'text/csv; charset=utf-8')
+        self.assertTrue(envelope['url'].endswith('method=get_object'))
+
+    def test_resolve_request(self):
+        s3_client = make_s3_client()
+        s3_client.get_object.return_value = {'Body': io.BytesIO(b'uploaded'), 'ContentType': 'text/plain'}
+        offloader = S3Offloader('bucket', s3_client=s3_client)
+
+        upload = offloader.create_upload(content_type='text/plain')
+        self.assertTrue(upload['url'].endswith('method=put_object'))
+        self.assertEqual(upload['header'], 'X-Zappa-Offload-Key')
+
+        environ = {'HTTP_X_ZAPPA_OFFLOAD_KEY': upload['key']}
+        self.assertTrue(offloader.resolve_request(environ))
+        self.assertEqual(environ['wsgi.input'].read(), b'uploaded')
+        self.assertEqual(environ['CONTENT_LENGTH'], '8')
+        self.assertEqual(environ['CONTENT_TYPE'], 'text/plain')
+        self.assertFalse(offloader.resolve_request({}))
+
+        # Uploads are deleted once read, and failing to doesn't fail the request.
+        s3_client.delete_object.assert_called_once_with(Bucket='bucket', Key=upload['key'])
+        s3_client.get_object.return_value = {'Body': io.BytesIO(b'uploaded')}
+        s3_client.delete_object.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'AccessDenied'}}, 'DeleteObject')
+        self.assertTrue(offloader.resolve_request({'HTTP_X_ZAPPA_OFFLOAD_KEY': upload['key']}))
+
+        # Only uploads can be read.
+        with self.assertRaises(OffloadError):
+            offloader.resolve_request({'HTTP_X_ZAPPA_OFFLOAD_KEY': 'zappa-offload/responses/abc'})
+
+        s3_client.get_object.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        with self.assertRaises(OffloadError):
+            offloader.resolve_request(environ)
+
+    def test_handler_offload(self):
+        lh = LambdaHandler('tests.test_offload_settings')
+        lh.offloader._s3_client = s3_client = make_s3_client()
+        s3_client.get_object.return_value = {'Body': io.BytesIO(b'x' * 100), 'ContentType': 'text/plain'}
+
+        event = {
+            'body': None,
+            'resource': '/{proxy+}',
+            'requestContext': {},
+            'queryStringParameters': None,
+            'headers': {
+                'Host': 'example.com',
+                'X-Zappa-Offload-Key': 'zappa-offload/uploads/abc',
+            },
+            'pathParameters': {'proxy': 'return/request/body'},
+            'httpMethod': 'POST',
+            'stageVariables': {},
+            'path': '/return/request/body',
+        }
+        response = lh.handler(event, None)
+        self.assertEqual(response['statusCode'], 303)
+        self.assertNotIn('body', response)
+        self.assertTrue(response['headers']['Location'].startswith('https://s3.example.com/zappa-offload/responses/'))
+        self.assertEqual(s3_client.put_object.call_args[1]['Body'], b'x' * 100)
+
+        lh.offloader.threshold = 1000
+        event['headers']['X-Zappa-Offload-Key'] = '../secrets'
+        response = lh.handler(event, None)
+        self.assertEqual(response['statusCode'], 400)
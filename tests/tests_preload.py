@@ -0,0 +1,75 @@
+# -*- coding: utf8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from zappa.preload import (DeferredImportFinder, ImportRecord, build_manifest, format_report,
+                           get_new_modules, install_deferred_imports, parse_importtime, trace_imports)
+
+IMPORTTIME_OUTPUT = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _json
+import time:      2100 |       2220 | json
+import time:        80 |         80 |     small
+import time:     15000 |      15080 |   heavy
+import time:       500 |      15580 | app
+"""
+
+
+class TestPreload(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        sys.path.insert(0, self.tmp)
+
+    def tearDown(self):
+        sys.path.remove(self.tmp)
+        sys.meta_path[:] = [f for f in sys.meta_path if not isinstance(f, DeferredImportFinder)]
+        sys.modules.pop('preload_deferred', None)
+        shutil.rmtree(self.tmp)
+
+    def test_parse_importtime(self):
+        records = parse_importtime(IMPORTTIME_OUTPUT)
+        self.assertEqual(records[0], ImportRecord('_json', 120, 120, 1))
+        self.assertEqual(records[-1], ImportRecord('app', 500, 15580, 0))
+        self.assertEqual([r.depth for r in records], [1, 0, 2, 1, 0])
+
+        report = format_report(records, limit=2).splitlines()
+        self.assertEqual(len(report), 3)
+        self.assertTrue(report[1].endswith('heavy'))
+
+    def test_build_manifest(self):
+        records = parse_importtime(IMPORTTIME_OUTPUT)
+        manifest = build_manifest(records, threshold_ms=1, exclude=['app'])
+        self.assertEqual(manifest['preload'], ['heavy', 'json'])
+        self.assertEqual(manifest['imports'][0]['name'], 'heavy')
+        self.assertEqual(manifest['imports'][0]['self_ms'], 15.0)
+
+        # The requested modules come first, and deferred modules are never preloaded.
+        manifest = build_manifest(records, preload=['missing'], defer=['heavy'], exclude=['app'])
+        self.assertEqual(manifest['preload'], ['missing', 'json', 'small'])
+        self.assertEqual(manifest['defer'], ['heavy'])
+        self.assertEqual(build_manifest(records, limit=1)['preload'], ['app'])
+
+    def test_trace_imports(self):
+        records = trace_imports(['json'])
+        self.assertIn('json', [r.name for r in records])
+
+        with self.assertRaises(RuntimeError):
+            trace_imports(['this_module_does_not_exist'])
+
+    def test_deferred_imports(self):
+        with open(os.path.join(self.tmp, 'preload_deferred.py'), 'w') as f:
+            f.write('import sys\nsys.preload_deferred_executed = True\nVALUE = 1\n')
+
+        known_modules = set(sys.modules)
+        install_deferred_imports(['preload_deferred'])
+        import preload_deferred
+        self.assertFalse(hasattr(sys, 'preload_deferred_executed'))
+        self.assertEqual(get_new_modules(known_modules), ['preload_deferred'])
+
+        try:
+            self.assertEqual(preload_deferred.VALUE, 1)
+            self.assertTrue(sys.preload_deferred_executed)
+        finally:
+            del sys.preload_deferred_executed
@@ -0,0 +1,160 @@
+# -*- coding: utf8 -*-
+import json
+import threading
+import unittest
+
+from zappa.handler import LambdaHandler
+from zappa.streaming import (STREAMING_CONTENT_TYPE, LocalRuntimeAPI, StreamingRuntime,
+                             create_prelude, parse_prelude)
+
+FUNCTION_URL_EVENT = {
+    'version': '2.0',
+    'routeKey': '$default',
+    'rawPath': '/export.csv',
+    'rawQueryString': '',
+    'headers': {
+        'host': 'abcdefgh.lambda-url.us-east-1.on.aws',
+        'x-forwarded-proto': 'https',
+    },
+    'requestContext': {
+        'domainName': 'abcdefgh.lambda-url.us-east-1.on.aws',
+        'http': {
+            'method': 'GET',
+            'path': '/export.csv',
+            'protocol': 'HTTP/1.1',
+            'sourceIp': '192.0.2.1',
+        },
+    },
+    'isBase64Encoded': False,
+}
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.runtime_api = LocalRuntimeAPI(timeout=10).start()
+
+    def tearDown(self):
+        self.runtime_api.stop()
+        LambdaHandler._LambdaHandler__instance = None
+        LambdaHandler.settings = None
+        LambdaHandler.settings_name = None
+
+    def invoke(self, handler, event):
+        runtime = StreamingRuntime(handler, self.runtime_api.address)
+        thread = threading.Thread(target=runtime.run, args=(1,))
+        thread.start()
+        invocation = self.runtime_api.invoke(event)
+        thread.join(10)
+        return invocation
+
+    def test_prelude(self):
+        prelude = create_prelude(201, [
+            ('Content-Type', 'text/plain'),
+            ('Vary', 'Accept'),
+            ('Vary', 'Cookie'),
+            ('Set-Cookie', 'a=1'),
+            ('set-cookie', 'b=2'),
+        ])
+        self.assertEqual(parse_prelude(prelude + b'body'), ({
+            'statusCode': 201,
+            'headers': {'Content-Type': 'text/plain', 'Vary': 'Accept, Cookie'},
+            'cookies': ['a=1', 'b=2'],
+        }, b'body'))
+
+        with self.assertRaises(ValueError):
+            parse_prelude(b'{}')
+
+    def test_runtime_errors(self):
+        def fails(event, context):
+            raise ValueError('no response')
+
+        invocation = self.invoke(fails, {})
+        self.assertEqual(invocation.error['errorType'], 'ValueError')
+        self.assertEqual(invocation.error['errorMessage'], 'no response')
+
+        def fails_midstream(event, context):
+            def chunks():
+                yield b'partial'
+                raise ValueError('cut short')
+            return 'text/plain', chunks()
+
+        invocation = self.invoke(fails_midstream, {})
+        self.assertEqual(invocation.chunks, [b'partial'])
+        self.assertEqual(invocation.trailers['Lambda-Runtime-Function-Error-Type'], 'ValueError')
+        self.assertEqual(invocation.error['errorMessage'], 'cut short')
+
+    def test_stream_wsgi_app(self):
+        """
+        Ensure that the chunks of a WSGI app's response are sent as it produces them.
+        """
+        from tests import test_streaming_app
+        test_streaming_app.runtime_api = self.runtime_api
+        del test_streaming_app.streamed[:]
+
+        lh = LambdaHandler('tests.test_streaming_settings')
+        invocation = self.invoke(lh.stream, FUNCTION_URL_EVENT)
+
+        self.assertIsNone(invocation.error)
+        self.assertEqual(invocation.content_type, STREAMING_CONTENT_TYPE)
+        self.assertEqual(test_streaming_app.streamed, [True, True, True])
+        self.assertEqual(invocation.chunks[1:], [b'row,0\n', b'row,1\n', b'row,2\n'])
+
+        prelude, body = invocation.get_response()
+        self.assertEqual(prelude['statusCode'], 200)
+        self.assertEqual(prelude['headers']['Content-Type'], 'text/csv')
+        self.assertEqual(prelude['cookies'], ['a=1'])
+        self.assertEqual(body, b'row,0\nrow,1\nrow,2\n')
+
+        # Other events are answered with their result.
+        invocation = self.invoke(lh.stream, {'raw_command': '1 + 1'})
+        self.assertEqual(invocation.content_type, 'application/json')
+        self.assertEqual(invocation.body, b'null')
+
+    def test_stream_asgi_app(self):
+        """
+        Ensure that ASGI body messages are sent as they are sent by the app.
+        """
+        lh = LambdaHandler('tests.test_asgi_settings')
+        event = dict(FUNCTION_URL_EVENT, body='{"hello": "world"}')
+        event['requestContext'] = dict(FUNCTION_URL_EVENT['requestContext'],
+                                       http=dict(FUNCTION_URL_EVENT['requestContext']['http'], method='POST'))
+        invocation = self.invoke(lh.stream, event)
+
+        self.assertIsNone(invocation.error)
+        self.assertEqual(len(invocation.chunks), 3)
+        self.assertEqual(len(invocation.chunks[1]), 10)
+
+        prelude, body = invocation.get_response()
+        self.assertEqual(prelude['statusCode'], 201)
+        self.assertEqual(prelude['cookies'], ['a=1', 'b=2'])
+        body = json.loads(body.decode('utf-8'))
+        self.assertEqual(body['method'], 'POST')
+        self.assertEqual(body['body'], '{"hello": "world"}')
+        self.assertTrue(body['same_loop'])
+
+    def test_stream_only_function_url_events(self):
+        """
+        Ensure that API Gateway requests get the usual proxy response, as a whole.
+        """
+        lh = LambdaHandler('tests.test_asgi_settings')
+
+        # An HTTP API event, in the same payload format as a Function URL's
+        event = dict(FUNCTION_URL_EVENT, requestContext=dict(
+            FUNCTION_URL_EVENT['requestContext'], domainName='abcdefgh.execute-api.us-east-1.amazonaws.com'))
+        rest_event = {
+            'httpMethod': 'GET',
+            'path': '/export.csv',
+            'headers': {'Host': 'abcdefgh.execute-api.us-east-1.amazonaws.com'},
+            'queryStringParameters': None,
+            'requestContext': {},
+            'body': None,
+        }
+        for event in [event, rest_event]:
+            invocation = self.invoke(lh.stream, event)
+
+            self.assertIsNone(invocation.error)
+            self.assertEqual(invocation.content_type, 'application/json')
+            self.assertEqual(len(invocation.chunks), 1)
+            response = json.loads(invocation.body.decode('utf-8'))
+            self.assertEqual(response['statusCode'], 201)
+            self.assertEqual(json.loads(response['body'])['method'], 'GET')
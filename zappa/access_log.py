@@ -0,0 +1,145 @@
+"""
+Access logging for web requests.
+
+Each request is logged in Common Log Format, the default, or as a JSON record
+holding its request id, route, status, latency, bytes in and out and whether
+it was a cold start, which CloudWatch Logs Insights can query. Records can be
+sampled per status class, so that, say, one in ten successful requests is
+logged while every error is. They are buffered, and written once per
+invocation.
+
+Unlike `zappa.wsgi.common_log`, nothing is formatted when a record isn't
+logged, and the timestamp is formatted at most once a second.
+"""
+import json
+import logging
+import random
+import sys
+import time
+
+ACCESS_LOG_FORMATS = ['common', 'json', 'none']
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# Records are written when this many are buffered, even mid-invocation
+ACCESS_LOG_BUFFER_SIZE = 100
+
+
+class AccessLogger:
+    """
+    Formats, samples and buffers access log records.
+
+    `sample_rates` maps status classes ('2xx', '3xx', '4xx', '5xx') to the
+    fraction of their requests to log; unlisted classes are always logged.
+    JSON records are written to stream (stdout by default), and Common Log
+    Format ones through the root logger, at INFO.
+    """
+    def __init__(self, format='common', sample_rates=None, stream=None):
+        if format not in ACCESS_LOG_FORMATS:
+            raise ValueError('Unknown access log format {!r}, expected one of {}.'.format(
+                format, ', '.join(ACCESS_LOG_FORMATS)))
+        self.format = format
+        self.sample_rates = dict(sample_rates or {})
+        self.stream = stream
+        self.buffer = []
+        self.timestamp = None
+        self.timestamp_second = None
+        self.cold_start = True
+
+    def get_sample_rate(self, status_code):
+        return self.sample_rates.get('{}xx'.format(status_code // 100), 1.0)
+
+    def is_sampled(self, sample_rate):
+        return sample_rate >= 1 or random.random() < sample_rate
+
+    def log(self, environ, status_code, content_length, response_time=None):
+        """
+        Buffer the record of a request, if it's sampled.
+        The response time is in milliseconds.
+        """
+        if self.format == 'none':
+            return None
+        if self.format == 'common' and not logging.getLogger().isEnabledFor(logging.INFO):
+            return None
+        sample_rate = self.get_sample_rate(status_code)
+        if not self.is_sampled(sample_rate):
+            return None
+
+        if self.format == 'common':
+            record = self.format_common(environ, status_code, content_length, response_time)
+        else:
+            record = self.format_json(environ, status_code, content_length, response_time, sample_rate)
+
+        self.buffer.append(record)
+        if len(self.buffer) >= ACCESS_LOG_BUFFER_SIZE:
+            self.write()
+        return record
+
+    def get_timestamp(self):
+        """
+        Return the current time as Common Log Format has it,
+        formatted at most once a second.
+        """
+        second = int(time.time())
+        if second != self.timestamp_second:
+            local = time.localtime(second)
+            self.timestamp = time.strftime('%d/{}/%Y:%H:%M:%S %z'.format(MONTHS[local.tm_mon - 1]), local)
+            self.timestamp_second = second
+        return self.timestamp
+
+    def format_common(self, environ, status_code, content_length, response_time=None):
+        """
+        Format a record the same way as common_log, which uses requestlogger's ApacheFormatter.
+        """
+        record = '{} - - [{}] "{} {} {}" {} {} "{}" "{}"'.format(
+            environ.get('REMOTE_ADDR', ''),
+            self.get_timestamp(),
+            environ.get('REQUEST_METHOD', ''),
+            environ.get('PATH_INFO', ''),
+            environ.get('SERVER_PROTOCOL', ''),
+            status_code,
+            content_length,
+            environ.get('HTTP_REFERER', ''),
+            environ.get('HTTP_USER_AGENT', '')
+        )
+        if response_time is not None:
+            # The response time is given in milliseconds, though printed as if microseconds.
+            record += ' {}/{}'.format(int(response_time / 1000000), response_time % 1000000)
+        return record
+
+    def format_json(self, environ, status_code, content_length, response_time=None, sample_rate=1.0):
+        event = environ.get('lambda.event') or {}
+        context = environ.get('lambda.context')
+        return json.dumps({
+            'type': 'access',
+            'request_id': getattr(context, 'aws_request_id', None),
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+            'route': event.get('resource') or event.get('routeKey'),
+            'status': status_code,
+            'latency_ms': round(response_time, 3) if response_time is not None else None,
+            'bytes_in': int(environ.get('CONTENT_LENGTH') or 0),
+            'bytes_out': content_length,
+            'cold_start': self.cold_start,
+            'remote_addr': environ.get('REMOTE_ADDR'),
+            'user_agent': environ.get('HTTP_USER_AGENT'),
+            'sample_rate': sample_rate,
+        })
+
+    def write(self):
+        if not self.buffer:
+            return
+        records, self.buffer = self.buffer, []
+        if self.format == 'common':
+            logging.getLogger().info('\n'.join(records))
+        else:
+            stream = self.stream or sys.stdout
+            stream.write('\n'.join(records) + '\n')
+            stream.flush()
+
+    def flush(self):
+        """
+        Write the buffered records, at the end of an invocation.
+        """
+        self.write()
+        self.cold_start = False
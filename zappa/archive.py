@@ -0,0 +1,339 @@
+"""
+Loading of the slim_handler project archive.
+
+The archive is fetched from S3 with parallel ranged GETs and decompressed and
+extracted while the remaining ranges are still downloading. The ETag of the
+extracted archive is recorded next to the project files, so that a warm
+container holding the same build skips the download, and one holding a stale
+build replaces it atomically.
+
+A `lazy_zip` archive is instead kept as a (compressed) zip next to the project
+files and mounted with a `sys.meta_path` finder. Pure Python packages and modules
+of installed distributions are imported straight from the zip, like zipimport
+does, so only the modules which are actually imported are ever inflated. Project
+code, and packages holding extension modules or data files, which can't be
+loaded from a zip or are read through __file__, are copied out of the zip the
+first time they are imported, a whole top-level package at a time.
+
+/tmp therefore holds the zip itself, plus the extracted copies of the project
+code and of the non-pure packages which were imported, so with large binary
+dependencies a lazy archive can need more of /tmp than an extracted tarball.
+"""
+import collections
+import concurrent.futures
+import csv
+import gzip
+import importlib
+import importlib.util
+import io
+import logging
+import os
+import shutil
+import sys
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+import zipimport
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_CHUNK_SIZE = 4 * 1024 * 1024
+ARCHIVE_DOWNLOAD_CONCURRENCY = 8
+
+# Holds the ETag of the archive a project folder was extracted from
+BUILD_MARKER = '.zappa_build'
+
+# Where a lazily mounted archive is kept, inside the project folder
+LAZY_ARCHIVE = '.zappa_archive.zip'
+
+
+class RangedS3Reader(io.RawIOBase):
+    """
+    A readable stream over an S3 object, fetched as ranges by a pool of threads.
+
+    At most `concurrency` ranges are held or in flight at once, so memory use is
+    bounded no matter how large the object is. The time spent waiting on the
+    network is accumulated in `wait_time`.
+    """
+    def __init__(self, s3_client, bucket, key, size, etag=None,
+                 chunk_size=ARCHIVE_CHUNK_SIZE, concurrency=ARCHIVE_DOWNLOAD_CONCURRENCY):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.chunk_size = chunk_size
+        self.wait_time = 0.0
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._offsets = iter(range(0, size, chunk_size))
+        self._pending = collections.deque()
+        self._chunk = memoryview(b'')
+        for _ in range(concurrency):
+            self._schedule()
+
+    def _schedule(self):
+        offset = next(self._offsets, None)
+        if offset is not None:
+            self._pending.append(self._executor.submit(self._fetch, offset))
+
+    def _fetch(self, offset):
+        end = min(offset + self.chunk_size, self.size) - 1
+        kwargs = {
+            'Bucket': self.bucket,
+            'Key': self.key,
+            'Range': 'bytes={0}-{1}'.format(offset, end),
+        }
+        # Make sure every range comes from the same version of the object.
+        if self.etag:
+            kwargs['IfMatch'] = self.etag
+        return self.s3_client.get_object(**kwargs)['Body'].read()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._chunk:
+            if not self._pending:
+                return 0
+            start = time.time()
+            self._chunk = memoryview(self._pending.popleft().result())
+            self.wait_time += time.time() - start
+            self._schedule()
+
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+        super().close()
+
+
+class TimedReader:
+    """
+    Wraps a file-like object, accumulating the time spent in read().
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.elapsed = 0.0
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self.fileobj.read(size)
+        self.elapsed += time.time() - start
+        return data
+
+
+def read_build_marker(project_folder):
+    """
+    Return the ETag of the archive the project folder was extracted from, if any.
+    """
+    try:
+        with open(os.path.join(project_folder, BUILD_MARKER)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def write_build_marker(project_folder, etag):
+    with open(os.path.join(project_folder, BUILD_MARKER), 'w') as f:
+        f.write(etag)
+
+
+def replace_folder(new_folder, project_folder):
+    """
+    Swap a freshly extracted folder into place of the project folder,
+    so that the project folder never holds a partial build.
+    """
+    stale_folder = None
+    if os.path.isdir(project_folder):
+        stale_folder = '{0}.stale-{1}'.format(project_folder, uuid.uuid4().hex)
+        os.rename(project_folder, stale_folder)
+    os.rename(new_folder, project_folder)
+    if stale_folder:
+        shutil.rmtree(stale_folder, ignore_errors=True)
+
+
+def extract_tarball(reader, destination):
+    """
+    Decompress and extract a .tar.gz stream into the destination folder.
+
+    Returns the time spent in (decompress, write), not counting the time
+    spent reading from the stream itself.
+    """
+    raw = TimedReader(reader)
+    decompressed = TimedReader(gzip.GzipFile(fileobj=raw, mode='rb'))
+
+    start = time.time()
+    with tarfile.open(fileobj=decompressed, mode='r|') as t:
+        t.extractall(destination)
+    total = time.time() - start
+
+    return decompressed.elapsed - raw.elapsed, total - decompressed.elapsed
+
+
+def download_archive(reader, destination, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Write the archive stream to the destination folder as is, to be mounted lazily.
+
+    Returns the time spent in (decompress, write), the former always being zero.
+    """
+    os.makedirs(destination)
+    start = time.time()
+    with open(os.path.join(destination, LAZY_ARCHIVE), 'wb') as f:
+        shutil.copyfileobj(reader, f, chunk_size)
+    total = time.time() - start
+
+    return 0.0, total - reader.raw.wait_time
+
+
+class LazyArchiveFinder:
+    """
+    A meta path finder for a project archive mounted from a zip.
+
+    Pure Python packages and modules of installed distributions are imported from
+    the zip. Other top-level packages are copied out of the zip into the project
+    folder the first time they are imported, after which the regular path finder
+    imports them. Everything else (project modules, data folders, package
+    metadata, extension modules) is extracted when the archive is mounted.
+    """
+    def __init__(self, project_folder):
+        self.project_folder = project_folder
+        self.path = os.path.join(project_folder, LAZY_ARCHIVE)
+        self.archive = zipfile.ZipFile(self.path)
+        self.importer = zipimport.zipimporter(self.path)
+        self.lock = threading.Lock()
+
+        groups = collections.defaultdict(list)
+        for info in self.archive.infolist():
+            groups[info.filename.split('/', 1)[0]].append(info)
+        installed = self.get_installed_names()
+
+        self.packages = {}
+        self.zipped = set()
+        for name, members in groups.items():
+            filenames = set(info.filename for info in members)
+            pure = all(filename.endswith(('/', '.py', '.pyc')) for filename in filenames)
+            if name + '/__init__.py' in filenames or name + '/__init__.pyc' in filenames:
+                if pure and name in installed:
+                    self.zipped.add(name)
+                else:
+                    self.packages[name] = members
+            elif pure and name in installed and name.endswith(('.py', '.pyc')):
+                self.zipped.add(name.rsplit('.', 1)[0])
+            else:
+                self.extract(members)
+
+    def get_installed_names(self):
+        """
+        Return the top-level names of the files installed by the distributions in the zip.
+        """
+        names = set()
+        for info in self.archive.infolist():
+            folder, _, filename = info.filename.partition('/')
+            if filename == 'RECORD' and folder.endswith('.dist-info'):
+                with self.archive.open(info) as f:
+                    for row in csv.reader(io.TextIOWrapper(f, 'utf-8')):
+                        if row:
+                            names.add(row[0].split('/', 1)[0])
+            elif filename == 'top_level.txt' and folder.endswith(('.dist-info', '.egg-info')):
+                for line in self.archive.read(info).decode('utf-8').splitlines():
+                    if line.strip():
+                        names.update([line.strip(), line.strip() + '.py'])
+        return names
+
+    def extract(self, members):
+        for info in members:
+            destination = os.path.join(self.project_folder, info.filename)
+            if not os.path.exists(destination):
+                self.archive.extract(info, self.project_folder)
+
+    def find_spec(self, fullname, path=None, target=None):
+        # Submodules are found through their package's __path__,
+        # which for zipped packages points into the zip.
+        if path is not None:
+            return None
+
+        if fullname in self.zipped:
+            return importlib.util.spec_from_loader(fullname, self.importer)
+
+        if fullname not in self.packages:
+            return None
+
+        with self.lock:
+            members = self.packages.pop(fullname, None)
+            if members is not None:
+                self.extract(members)
+                importlib.invalidate_caches()
+        return None
+
+    def invalidate_caches(self):
+        pass
+
+
+def mount_project_archive(project_folder):
+    """
+    Install a finder for the zip in the project folder, unless one is installed.
+    """
+    for finder in sys.meta_path:
+        if isinstance(finder, LazyArchiveFinder) and finder.project_folder == project_folder:
+            return finder
+
+    finder = LazyArchiveFinder(project_folder)
+    sys.meta_path.insert(0, finder)
+    return finder
+
+
+def load_project_archive(s3_client, bucket, key, project_folder, lazy=False,
+                         chunk_size=ARCHIVE_CHUNK_SIZE, concurrency=ARCHIVE_DOWNLOAD_CONCURRENCY):
+    """
+    Make sure the project folder holds the current build of the project archive,
+    downloading and extracting it if needed. A lazy archive is mounted instead
+    of being extracted.
+
+    Returns a dictionary of the time in seconds spent on each phase, or None
+    if the project folder was already up to date.
+    """
+    start = time.time()
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    etag = head['ETag']
+
+    if read_build_marker(project_folder) == etag:
+        logger.debug('Project archive {} is already extracted.'.format(etag))
+        if lazy:
+            mount_project_archive(project_folder)
+        return None
+
+    new_folder = '{0}.{1}'.format(project_folder, uuid.uuid4().hex)
+    reader = RangedS3Reader(s3_client, bucket, key, head['ContentLength'], etag=etag,
+                            chunk_size=chunk_size, concurrency=concurrency)
+    try:
+        if lazy:
+            decompress_time, write_time = download_archive(io.BufferedReader(reader, chunk_size), new_folder)
+        else:
+            decompress_time, write_time = extract_tarball(io.BufferedReader(reader, chunk_size), new_folder)
+        write_build_marker(new_folder, etag)
+        replace_folder(new_folder, project_folder)
+    except Exception:
+        shutil.rmtree(new_folder, ignore_errors=True)
+        raise
+    finally:
+        reader.close()
+
+    timings = collections.OrderedDict([
+        ('download', reader.wait_time),
+        ('decompress', decompress_time),
+        ('write', write_time),
+        ('total', time.time() - start),
+    ])
+    if lazy:
+        mount_project_archive(project_folder)
+    logger.info('Loaded project archive ({}): {}'.format(
+        etag, ', '.join('{}={:.3f}s'.format(phase, seconds) for phase, seconds in timings.items())))
+    return timings
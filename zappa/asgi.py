@@ -0,0 +1,262 @@
+"""
+Support for ASGI applications.
+
+An ASGI app is run on an event loop which is kept for the life of the
+container, so that connection pools and other async clients created by the app
+survive between warm invocations. Its lifespan startup is run once, when the
+handler is loaded.
+
+The request scope is derived from the WSGI environ built by create_wsgi_request,
+so ASGI and WSGI apps see the same requests.
+"""
+import asyncio
+import atexit
+import logging
+
+from werkzeug.wrappers import Response
+
+try:
+    from zappa.wsgi import RequestBodyStream
+except ImportError:  # pragma: no cover
+    from .wsgi import RequestBodyStream
+
+logger = logging.getLogger(__name__)
+
+ASGI_VERSION = {'version': '3.0', 'spec_version': '2.3'}
+
+# How long the app has to finish its lifespan shutdown
+LIFESPAN_SHUTDOWN_TIMEOUT = 5
+
+# Queued after the last message of a streamed response
+STREAM_COMPLETE = 'zappa.stream.complete'
+
+
+def create_asgi_scope(environ, state=None):
+    """
+    Given a WSGI environ, create and return the equivalent ASGI HTTP scope.
+    """
+    headers = []
+    seen = set()
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            name = key[5:]
+        elif key in ['CONTENT_TYPE', 'CONTENT_LENGTH']:
+            name = key
+        else:
+            continue
+        name = name.replace('_', '-').lower()
+        if name in seen:
+            continue
+        seen.add(name)
+        headers.append((name.encode('latin-1'), value.encode('latin-1')))
+
+    # WSGI strings are latin-1 decoded bytes
+    raw_path = environ['PATH_INFO'].encode('latin-1')
+    scope = {
+        'type': 'http',
+        'asgi': ASGI_VERSION,
+        'http_version': environ.get('SERVER_PROTOCOL', 'HTTP/1.1').split('/', 1)[-1],
+        'method': environ['REQUEST_METHOD'],
+        'scheme': environ.get('wsgi.url_scheme', 'http'),
+        'path': raw_path.decode('utf-8'),
+        'raw_path': raw_path,
+        'root_path': environ.get('SCRIPT_NAME', ''),
+        'query_string': environ.get('QUERY_STRING', '').encode('latin-1'),
+        'headers': headers,
+        'client': (environ.get('REMOTE_ADDR', '127.0.0.1'), 0),
+        'server': (environ.get('SERVER_NAME', 'zappa'), int(environ.get('SERVER_PORT') or 80)),
+        'aws.event': environ.get('lambda.event'),
+        'aws.context': environ.get('lambda.context'),
+    }
+    if state is not None:
+        scope['state'] = dict(state)
+    return scope
+
+
+def get_response_headers(message):
+    return [
+        (name.decode('latin-1'), value.decode('latin-1'))
+        for name, value in message.get('headers', [])
+    ]
+
+
+def get_request_body(environ):
+    body = environ.get('wsgi.input')
+    if isinstance(body, RequestBodyStream) and not body.tell() and isinstance(body.body, bytes):
+        # The body itself, rather than a copy
+        return body.body
+    if hasattr(body, 'read'):
+        return body.read()
+    return body if isinstance(body, bytes) else b''
+
+
+class ASGIAdapter:
+    """
+    Runs an ASGI app on a persistent event loop.
+    """
+    def __init__(self, app, lifespan=True):
+        self.app = app
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.state = {}
+        self.lifespan_supported = False
+        self.lifespan_receive = None
+        self.lifespan_send = None
+        self.lifespan_task = None
+        if lifespan:
+            self.loop.run_until_complete(self.startup())
+            if self.lifespan_supported:
+                atexit.register(self.shutdown)
+
+    def __call__(self, environ):
+        """
+        Handle a request given as a WSGI environ,
+        returning the response and its body as bytes.
+        """
+        return self.loop.run_until_complete(self.handle(environ))
+
+    async def run_lifespan(self):
+        scope = {'type': 'lifespan', 'asgi': ASGI_VERSION, 'state': self.state}
+        try:
+            await self.app(scope, self.lifespan_receive.get, self.lifespan_send.put)
+        except Exception as e:
+            logger.debug('ASGI lifespan ended: {!r}'.format(e))
+        finally:
+            await self.lifespan_send.put({'type': 'lifespan.unsupported'})
+
+    async def startup(self):
+        self.lifespan_receive = asyncio.Queue()
+        self.lifespan_send = asyncio.Queue()
+        self.lifespan_task = self.loop.create_task(self.run_lifespan())
+
+        await self.lifespan_receive.put({'type': 'lifespan.startup'})
+        message = await self.lifespan_send.get()
+        if message['type'] == 'lifespan.startup.failed':
+            raise RuntimeError('ASGI lifespan startup failed: {}'.format(message.get('message', '')))
+        self.lifespan_supported = message['type'] == 'lifespan.startup.complete'
+        if not self.lifespan_supported:
+            logger.debug('ASGI app does not support lifespan.')
+
+    def shutdown(self):
+        """
+        Run the app's lifespan shutdown, if it was started.
+        """
+        if not self.lifespan_supported or self.loop.is_closed():
+            return
+        self.lifespan_supported = False
+
+        async def shutdown():
+            await self.lifespan_receive.put({'type': 'lifespan.shutdown'})
+            message = await asyncio.wait_for(self.lifespan_send.get(), LIFESPAN_SHUTDOWN_TIMEOUT)
+            if message['type'] == 'lifespan.shutdown.failed':
+                logger.error('ASGI lifespan shutdown failed: {}'.format(message.get('message', '')))
+
+        try:
+            self.loop.run_until_complete(shutdown())
+        except asyncio.TimeoutError:  # pragma: no cover
+            logger.error('ASGI lifespan shutdown timed out.')
+
+    async def run_app(self, environ, send):
+        """
+        Run the app for a request, passing the messages it sends to send.
+        """
+        scope = create_asgi_scope(environ, self.state)
+        request = {'type': 'http.request', 'body': get_request_body(environ), 'more_body': False}
+        response_complete = asyncio.Event()
+
+        async def receive():
+            nonlocal request
+            if request is not None:
+                message, request = request, None
+                return message
+            await response_complete.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send_message(message):
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                response_complete.set()
+
+        try:
+            await self.app(scope, receive, send_message)
+        finally:
+            response_complete.set()
+
+    async def handle(self, environ):
+        response = {}
+        chunks = []
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = get_response_headers(message)
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+
+        try:
+            await self.run_app(environ, send)
+        except Exception:
+            # Errors after the response has started can't change it.
+            if 'status' not in response:
+                raise
+            logger.exception('ASGI app raised after starting its response.')
+
+        if 'status' not in response:
+            raise RuntimeError('ASGI app returned without sending a response.')
+
+        body = b''.join(chunks)
+        return Response([body], status=response['status'], headers=response['headers']), body
+
+    def stream(self, environ):
+        """
+        Handle a request given as a WSGI environ, returning the response,
+        without its body, once the app starts it, and an iterator over the
+        chunks of the body, which are produced as the app sends them.
+        """
+        messages, task = self.loop.run_until_complete(self.start_stream(environ))
+
+        message = self.loop.run_until_complete(messages.get())
+        while message['type'] not in ('http.response.start', STREAM_COMPLETE):
+            message = self.loop.run_until_complete(messages.get())
+        if message['type'] == STREAM_COMPLETE:
+            # Raises the app's exception, if it had one.
+            task.result()
+            raise RuntimeError('ASGI app returned without sending a response.')
+
+        response = Response(status=message['status'], headers=get_response_headers(message))
+        return response, self.iter_body(messages, task)
+
+    async def start_stream(self, environ):
+        messages = asyncio.Queue()
+
+        async def run():
+            try:
+                await self.run_app(environ, messages.put)
+            finally:
+                await messages.put({'type': STREAM_COMPLETE})
+
+        return messages, self.loop.create_task(run())
+
+    def iter_body(self, messages, task):
+        finished = False
+        try:
+            while not finished:
+                message = self.loop.run_until_complete(messages.get())
+                if message['type'] == STREAM_COMPLETE:
+                    finished = True
+                elif message['type'] == 'http.response.body':
+                    finished = not message.get('more_body', False)
+                    if message.get('body'):
+                        yield message['body']
+        finally:
+            # Let the app finish, or cancel it if the stream was abandoned.
+            if not finished:
+                task.cancel()
+            try:
+                self.loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # Errors after the response has started can't change it.
+                logger.exception('ASGI app raised after starting its response.')
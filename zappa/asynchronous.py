@@ -83,36 +83,178 @@ Discussion of this comes from:
    by: `my_async_func.sync(1,2)` in which case it would run synchronously
    and in the current lambda function.
 
+## Batched dispatch
+
+Inside a `with batch():` block, tasks aren't dispatched when called but when
+the block exits, packed into as few invocations (or SNS messages) as the
+payload limit allows:
+
+```
+   from zappa.asynchronous import batch
+
+   with batch():
+       for item in items:
+           my_async_func(item)
+```
+
+`run_many` does the same for a list of `(func, args, kwargs)` calls. A batch
+is run by a single invocation, task after task. If any of its tasks raises,
+the others still run and the invocation then fails, so a retried batch runs
+all of its tasks again: batched tasks should be idempotent.
+
+## SQS
+
+With `service='sqs'` (or `async_source: sqs` and `@task_sqs`), tasks are sent
+to a queue, from which Lambda runs them in batches of `async_sqs_batch_size`
+messages, waiting up to `async_sqs_batching_window` seconds to fill a batch.
+A queue smooths bursts of tasks into a steady rate of invocations. Tasks sent
+from a `batch()` block go out through SendMessageBatch, ten messages a call,
+and a failed task only has its own message retried.
+
+## Large payloads
+
+With the `async_payload_bucket` setting, a task's arguments or captured result
+past `async_payload_threshold` bytes once serialized are compressed and
+written to the bucket, under a key derived from their content, and only a
+reference to them travels through Lambda, SNS, SQS or DynamoDB. They're read
+back when the task is run, or its response is fetched. On deploy, the bucket
+gets a lifecycle rule which expires objects under its `zappa-async/` prefix
+after `async_payload_expiration_days` (7 by default), as nothing else deletes
+them.
+
+## Fan-out and fan-in
+
+`map` runs a function on each item of an iterable, in chunks which are each
+run by an invocation, and tracks them in the async response table:
+
+```
+   from zappa.asynchronous import map
+
+   result = map(resize, image_keys, chunk_size=10, max_in_flight=50, callback=notify)
+   for index, resized in result.as_completed():
+       ...
+```
+
+The callback, if any, is dispatched as a task with the list of all results
+once every chunk is done. With `max_in_flight`, the chunks are split into that
+many lanes, each of which runs its chunks one after the other: a chunk
+dispatches the rest of its lane once it's done. The lanes, and the callback,
+are dispatched with the same options as the map itself.
+
+A failed chunk is retried with its invocation, and is only marked failed after
+`max_attempts` (by default 3, like Lambda's retries of asynchronous
+invocations). It then still dispatches the rest of its lane, and the map
+finishes with the status `failed`: `MapResult.results()` raises, naming the
+failed chunks, and the callback gets None for each of their items. The map's
+rows are kept in the table for a day after its last chunk completed.
+
+## Waiting for responses
+
+`get_async_responses` fetches the responses of many tasks in as few
+BatchGetItem calls as possible. `wait` yields each task's response as it
+completes, polling those still pending with exponential backoff and jitter;
+`wait_async` does the same from a coroutine:
+
+```
+   from zappa.asynchronous import wait
+
+   for response_id, response in wait(response_ids, timeout=60):
+       ...
+```
+
+## Local execution
+
+Outside of Lambda, tasks are run synchronously, as plain function calls. With
+the `ZAPPA_ASYNC_LOCAL_BACKEND` environment variable set to `thread` or
+`process`, they're run on a local pool of `ZAPPA_ASYNC_LOCAL_WORKERS` threads
+or processes instead, so a development server or a test suite sees the same
+concurrency as it would on Lambda. Messages are checked for being JSON
+serializable and under the payload limit, as they would be when sent.
+
+Responses, which are always captured, go to a SQLite stand-in for the async
+response table: in memory with threads, or in the `ZAPPA_ASYNC_LOCAL_STORE`
+file (a temporary one by default) with processes. `get_async_response`,
+`wait` and `map` work as they do on Lambda. `flush()` waits for the tasks
+still running. Large arguments and responses stay local too, rather than going
+to the payload bucket. The backend lives in zappa.local_async, which is only
+imported when it's used.
+
+## Background sending
+
+With the `async_sender_threads` setting, dispatching a task doesn't wait for
+the Lambda or SNS API: the message is handed to a small pool of threads which
+send it, and the returned response is a handle whose `sent` becomes true once
+it's been sent. `wait()` waits for that, raising the error if sending failed,
+and `error` holds it. At most `async_sender_queue_size` messages are pending
+at once; past that, dispatching blocks until one has been sent.
+
+Pending messages are all sent before the handler returns, since the container
+may be frozen once it has.
+
 """
 
-import boto3
 import botocore
+import concurrent.futures
 from functools import update_wrapper, wraps
 import importlib
 import inspect
+import itertools
 import json
+import hashlib
 import os
+import random
+import threading
 import uuid
 import time
+import zlib
+from contextlib import contextmanager
 
-from .utilities import get_topic_name
+from .clients import get_account_id, get_client
+from .utilities import get_queue_name, get_topic_name
 
 try:
     from zappa_settings import ASYNC_RESPONSE_TABLE
 except ImportError:
     ASYNC_RESPONSE_TABLE = None
 
-# Declare these here so they're kept warm.
 try:
-    aws_session = boto3.Session()
-    LAMBDA_CLIENT = aws_session.client('lambda')
-    SNS_CLIENT = aws_session.client('sns')
-    STS_CLIENT = aws_session.client('sts')
-    DYNAMODB_CLIENT = aws_session.client('dynamodb')
-except botocore.exceptions.NoRegionError as e: # pragma: no cover
-    # This can happen while testing on Travis, but it's taken care  of
-    # during class initialization.
-    pass
+    from zappa_settings import ASYNC_PAYLOAD_BUCKET, ASYNC_PAYLOAD_THRESHOLD
+except ImportError:
+    ASYNC_PAYLOAD_BUCKET = None
+    ASYNC_PAYLOAD_THRESHOLD = 100000
+
+try:
+    from zappa_settings import ASYNC_SENDER_THREADS, ASYNC_SENDER_QUEUE_SIZE
+except ImportError:
+    ASYNC_SENDER_THREADS = 0
+    ASYNC_SENDER_QUEUE_SIZE = 100
+
+try:
+    from zappa_settings import ASYNC_LOCAL_BACKEND
+except ImportError:
+    ASYNC_LOCAL_BACKEND = None
+ASYNC_LOCAL_BACKEND = os.environ.get('ZAPPA_ASYNC_LOCAL_BACKEND', ASYNC_LOCAL_BACKEND)
+
+# The clients are the shared ones from zappa.clients, created on first use
+# and kept warm. Setting one of these overrides it.
+LAMBDA_CLIENT = None
+SNS_CLIENT = None
+SQS_CLIENT = None
+STS_CLIENT = None
+DYNAMODB_CLIENT = None
+S3_CLIENT = None
+
+
+def get_async_client(service_name):
+    """
+    Return the client of a service: its override above, if set, or the shared one.
+    Running tasks locally, the async response table is the local one.
+    """
+    client = globals()['{}_CLIENT'.format(service_name.upper())]
+    if client is None and service_name == 'dynamodb' and is_local():
+        from .local_async import get_local_table
+        client = get_local_table()
+    return client or get_client(service_name)
 
 
 ##
@@ -121,26 +263,67 @@ except botocore.exceptions.NoRegionError as e: # pragma: no cover
 
 LAMBDA_ASYNC_PAYLOAD_LIMIT = 256000
 SNS_ASYNC_PAYLOAD_LIMIT = 256000
+SQS_ASYNC_PAYLOAD_LIMIT = 256000
+
+# The most messages SendMessageBatch takes
+SQS_BATCH_LIMIT = 10
+
+# The message attribute which routes SQS messages to route_sqs_task
+SQS_COMMAND_ATTRIBUTE = 'zappa_command'
+
+# Where large payloads are written in ASYNC_PAYLOAD_BUCKET
+ASYNC_PAYLOAD_PREFIX = 'zappa-async/'
+
+# The most keys BatchGetItem takes
+DYNAMODB_BATCH_GET_LIMIT = 100
+
+# How many times keys BatchGetItem leaves unprocessed are retried
+DYNAMODB_BATCH_GET_RETRIES = 8
+
+# The delays between polls for responses, in seconds
+ASYNC_POLL_INITIAL_DELAY = 0.1
+ASYNC_POLL_MAX_DELAY = 5
+
+# How long responses are kept in the async table, in seconds. A map's rows are
+# kept that long after its last chunk completed, so a map can run for longer.
+ASYNC_RESPONSE_TTL = 600
+ASYNC_MAP_TTL = 24 * 60 * 60
+
+# How many times a map's chunk is run before it's marked failed: once, then
+# retried twice, as Lambda does with asynchronous invocations by default
+ASYNC_MAP_MAX_ATTEMPTS = 3
 
 class AsyncException(Exception): # pragma: no cover
     """ Simple exception class for async tasks. """
     pass
 
 
+# The batch being collected by each thread, if any
+_local = threading.local()
+
+
 class LambdaAsyncResponse:
     """
     Base Response Dispatcher class
     Can be used directly or subclassed if the method to send the message is changed.
     """
+    payload_limit = LAMBDA_ASYNC_PAYLOAD_LIMIT
+
+    # Set when the message is sent in the background
+    future = None
+
+    boto_session = None
+
     def __init__(self, lambda_function_name=None, aws_region=None, capture_response=False, **kwargs):
         """ """
         if kwargs.get('boto_session'):
             self.client = kwargs.get('boto_session').client('lambda')
         else:  # pragma: no cover
-            self.client = LAMBDA_CLIENT
+            self.client = get_async_client('lambda')
 
         self.lambda_function_name = lambda_function_name
         self.aws_region = aws_region
+        self.boto_session = kwargs.get('boto_session')
         if capture_response:
             if ASYNC_RESPONSE_TABLE is None:
                 print(
@@ -161,7 +344,8 @@ class LambdaAsyncResponse:
 
     def send(self, task_path, args, kwargs):
         """
-        Create the message object and pass it to the actual sender.
+        Create the message object and pass it to the actual sender,
+        or add it to the current batch.
         """
         message = {
                 'task_path': task_path,
@@ -170,9 +354,63 @@ class LambdaAsyncResponse:
                 'args': args,
                 'kwargs': kwargs
             }
-        self._send(message)
+        message = self.check_payload(message)
+        current_batch = getattr(_local, 'batch', None)
+        if current_batch is not None:
+            self.sent = False
+            current_batch.append((self, message))
+        elif ASYNC_SENDER_THREADS:
+            self.sent = False
+            self.future = get_sender().submit(self._send, message)
+        else:
+            self._send(message)
         return self
 
+    def check_payload(self, message):
+        """
+        Move the message's arguments to the payload bucket, if there's one
+        and they're too large to send.
+        """
+        if not ASYNC_PAYLOAD_BUCKET:
+            return message
+        s3_client = self.boto_session.client('s3') if self.boto_session else get_async_client('s3')
+        return check_message_payload(message, s3_client)
+
+    @property
+    def error(self):
+        """
+        The error raised while sending the message in the background, if any.
+        """
+        if self.future is None or not self.future.done():
+            return None
+        return self.future.exception()
+
+    def wait(self, timeout=None):
+        """
+        Wait for a message sent in the background to have been sent,
+        raising the error if sending it failed. Returns sent.
+        """
+        if self.future is not None:
+            self.future.result(timeout)
+        return self.sent
+
+    def get_batch_key(self):
+        """
+        Messages with the same key can be sent together.
+        """
+        return (type(self), self.lambda_function_name, self.aws_region, getattr(self, 'arn', None))
+
+    def send_batch(self, responses, messages):
+        """
+        Send the messages in as few payloads under the limit as possible,
+        updating the response each message was sent for.
+        """
+        for start, end in pack_messages(messages, self.payload_limit):
+            self._send({'batch': messages[start:end]})
+            for response in responses[start:end]:
+                response.response = self.response
+                response.sent = self.sent
+
     def _send(self, message):
         """
         Given a message, directly invoke the lamdba function for this task.
@@ -193,6 +431,8 @@ class SnsAsyncResponse(LambdaAsyncResponse):
     Send a SNS message to a specified SNS topic
     Serialise the func path and arguments
     """
+    payload_limit = SNS_ASYNC_PAYLOAD_LIMIT
+
     def __init__(self, lambda_function_name=None, aws_region=None, capture_response=False, **kwargs):
 
         self.lambda_function_name = lambda_function_name
@@ -201,22 +441,18 @@ class SnsAsyncResponse(LambdaAsyncResponse):
         if kwargs.get('boto_session'):
             self.client = kwargs.get('boto_session').client('sns')
         else: # pragma: no cover
-            self.client = SNS_CLIENT
+            self.client = get_async_client('sns')
 
 
         if kwargs.get('arn'):
             self.arn = kwargs.get('arn')
+        elif kwargs.get('boto_session'):
+            AWS_ACCOUNT_ID = kwargs.get('boto_session').client('sts').get_caller_identity()['Account']
+            self.arn = get_topic_arn(self.lambda_function_name, self.aws_region, AWS_ACCOUNT_ID)
         else:
-            if kwargs.get('boto_session'):
-                sts_client = kwargs.get('boto_session').client('sts')
-            else:
-                sts_client = STS_CLIENT
-            AWS_ACCOUNT_ID = sts_client.get_caller_identity()['Account']
-            self.arn = 'arn:aws:sns:{region}:{account}:{topic_name}'.format(
-                                    region=self.aws_region,
-                                    account=AWS_ACCOUNT_ID,
-                                    topic_name=get_topic_name(self.lambda_function_name)
-                                )
+            # The account id is only asked for once per container.
+            account_id = STS_CLIENT.get_caller_identity()['Account'] if STS_CLIENT else get_account_id()
+            self.arn = get_topic_arn(self.lambda_function_name, self.aws_region, account_id)
 
         # Issue: https://github.com/Miserlou/Zappa/issues/1209
         # TODO: Refactor
@@ -253,6 +489,321 @@ class SnsAsyncResponse(LambdaAsyncResponse):
                             )
         self.sent = self.response.get('MessageId')
 
+
+def get_topic_arn(lambda_function_name, aws_region, account_id):
+    return 'arn:aws:sns:{region}:{account}:{topic_name}'.format(
+        region=aws_region,
+        account=account_id,
+        topic_name=get_topic_name(lambda_function_name)
+    )
+
+
+# Queue URLs are looked up once per container
+_queue_urls = {}
+
+
+def get_queue_url(client, queue_name):
+    key = (client.meta.region_name, queue_name)
+    if key not in _queue_urls:
+        _queue_urls[key] = client.get_queue_url(QueueName=queue_name)['QueueUrl']
+    return _queue_urls[key]
+
+
+class SqsAsyncResponse(LambdaAsyncResponse):
+    """
+    Send a message to the function's SQS queue,
+    or a batch of them with SendMessageBatch.
+    """
+    payload_limit = SQS_ASYNC_PAYLOAD_LIMIT
+
+    def __init__(self, lambda_function_name=None, aws_region=None, capture_response=False, **kwargs):
+
+        self.lambda_function_name = lambda_function_name
+        self.aws_region = aws_region
+
+        if kwargs.get('boto_session'):
+            self.client = kwargs.get('boto_session').client('sqs')
+        else: # pragma: no cover
+            self.client = get_async_client('sqs')
+
+        if kwargs.get('queue_url'):
+            self.queue_url = kwargs.get('queue_url')
+        else:
+            self.queue_url = get_queue_url(self.client, get_queue_name(self.lambda_function_name))
+
+        self.capture_response = capture_response
+        if capture_response:
+            if ASYNC_RESPONSE_TABLE is None:
+                print(
+                    "Warning! Attempted to capture a response without "
+                    "async_response_table configured in settings (you won't "
+                    "capture async responses)."
+                )
+                capture_response = False
+                self.response_id = "MISCONFIGURED"
+
+            else:
+                self.response_id = str(uuid.uuid4())
+        else:
+            self.response_id = None
+
+        self.capture_response = capture_response
+
+    def get_batch_key(self):
+        return (type(self), self.queue_url)
+
+    def get_entry(self, message, id=None):
+        message['command'] = 'zappa.asynchronous.route_sqs_task'
+        body = json.dumps(message)
+        if len(body.encode('utf-8')) > SQS_ASYNC_PAYLOAD_LIMIT:
+            raise AsyncException("Payload too large for SQS")
+        entry = {
+            'MessageBody': body,
+            'MessageAttributes': {
+                SQS_COMMAND_ATTRIBUTE: {'DataType': 'String', 'StringValue': message['command']}
+            }
+        }
+        if id is not None:
+            entry['Id'] = id
+        return entry
+
+    def _send(self, message):
+        """
+        Given a message, send it to the queue.
+        """
+        self.response = self.client.send_message(QueueUrl=self.queue_url, **self.get_entry(message))
+        self.sent = self.response.get('MessageId')
+
+    def send_batch(self, responses, messages):
+        """
+        Send each message as its own entry of as few SendMessageBatch calls as possible,
+        so that a failed task only has its own message retried.
+        """
+        entries = [self.get_entry(message, str(index)) for index, message in enumerate(messages)]
+        failed = []
+        packs = pack_messages([entry['MessageBody'] for entry in entries], self.payload_limit,
+                              overhead=0, separator=0, max_messages=SQS_BATCH_LIMIT)
+        for start, end in packs:
+            response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=entries[start:end])
+            for result in response.get('Successful', []):
+                responses[int(result['Id'])].response = result
+                responses[int(result['Id'])].sent = result['MessageId']
+            for result in response.get('Failed', []):
+                responses[int(result['Id'])].response = result
+                responses[int(result['Id'])].sent = False
+                failed.append(result)
+        if failed:
+            raise AsyncException('Failed to send {} of {} messages to SQS, the first with: {}'.format(
+                len(failed), len(messages), failed[0].get('Message', failed[0].get('Code'))))
+
+
+def pack_messages(messages, payload_limit, overhead=None, separator=len(', '), max_messages=None):
+    """
+    Split the messages, in order, into as few batches as fit in payload_limit
+    once serialized, and have at most max_messages each. By default, a batch
+    is serialized as a single payload, which has some overhead.
+
+    Returns the (start, end) indexes of each batch.
+    """
+    if overhead is None:
+        # The batch's brackets and command
+        overhead = len(json.dumps({'batch': [], 'command': 'zappa.asynchronous.route_lambda_task'}))
+
+    packs = []
+    start = 0
+    size = overhead
+    for index, message in enumerate(messages):
+        if isinstance(message, str):
+            message_size = len(message.encode('utf-8'))
+        else:
+            message_size = len(json.dumps(message).encode('utf-8'))
+        if overhead + message_size > payload_limit:
+            raise AsyncException("Payload too large for async call: {}".format(
+                message['task_path'] if isinstance(message, dict) else message[:100]))
+        if index > start and (size + separator + message_size > payload_limit
+                              or (max_messages and index - start >= max_messages)):
+            packs.append((start, index))
+            start = index
+            size = overhead
+        size += message_size + (separator if index > start else 0)
+    if start < len(messages):
+        packs.append((start, len(messages)))
+    return packs
+
+
+@contextmanager
+def batch():
+    """
+    Collect the tasks dispatched in the block, and send them when it exits,
+    in as few invocations or messages as possible. Nested blocks join the
+    outermost one.
+    """
+    if getattr(_local, 'batch', None) is not None:
+        yield _local.batch
+        return
+
+    _local.batch = collected = []
+    try:
+        yield collected
+    finally:
+        _local.batch = None
+        if ASYNC_SENDER_THREADS and collected:
+            future = get_sender().submit(send_collected, collected)
+            for response, message in collected:
+                response.future = future
+        else:
+            send_collected(collected)
+
+
+def send_collected(collected):
+    groups = {}
+    for response, message in collected:
+        groups.setdefault(response.get_batch_key(), []).append((response, message))
+    for group in groups.values():
+        responses = [response for response, message in group]
+        messages = [message for response, message in group]
+        if len(messages) == 1:
+            responses[0]._send(messages[0])
+        else:
+            responses[0].send_batch(responses, messages)
+
+
+def put_payload(s3_client, data):
+    """
+    Compress and write a serialized, encoded payload to the payload bucket,
+    under a key derived from its content. Returns its reference.
+    """
+    key = '{}{}.json.z'.format(ASYNC_PAYLOAD_PREFIX, hashlib.sha256(data).hexdigest())
+    s3_client.put_object(
+        Bucket=ASYNC_PAYLOAD_BUCKET,
+        Key=key,
+        Body=zlib.compress(data),
+        ContentType='application/json'
+    )
+    return {'bucket': ASYNC_PAYLOAD_BUCKET, 'key': key}
+
+
+def get_payload(s3_client, reference):
+    """
+    Read and deserialize the payload a reference points to.
+    """
+    obj = s3_client.get_object(Bucket=reference['bucket'], Key=reference['key'])
+    return json.loads(zlib.decompress(obj['Body'].read()).decode('utf-8'))
+
+
+def check_message_payload(message, s3_client):
+    """
+    Replace a message's arguments with a reference to them in the payload
+    bucket, if they're too large to send.
+    """
+    arguments = json.dumps({'args': message['args'], 'kwargs': message['kwargs']}).encode('utf-8')
+    if len(arguments) <= ASYNC_PAYLOAD_THRESHOLD:
+        return message
+    message = dict(message, payload=put_payload(s3_client, arguments))
+    del message['args'], message['kwargs']
+    return message
+
+
+class BackgroundSender:
+    """
+    Sends messages from a pool of threads, so that dispatching a task doesn't
+    wait for the API. At most queue_size sends are pending at once.
+    """
+    failure_message = 'Failed to send an async task: {!r}'
+
+    def __init__(self, threads=ASYNC_SENDER_THREADS, queue_size=ASYNC_SENDER_QUEUE_SIZE):
+        self.executor = self.create_executor(max(threads, 1))
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def create_executor(self, workers):
+        return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, send, *args):
+        """
+        Call send(*args) in the background, blocking while the queue is full.
+        Returns the future of the call.
+        """
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(send, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        self.slots.release()
+
+    def flush(self, timeout=None):
+        """
+        Wait for the pending sends, printing those which failed.
+        Returns whether they all finished within the timeout.
+        """
+        with self.lock:
+            pending = list(self.pending)
+        if not pending:
+            return True
+        done, not_done = concurrent.futures.wait(pending, timeout)
+        for future in done:
+            if future.exception() is not None:
+                print(self.failure_message.format(future.exception()))
+        return not not_done
+
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def get_sender():
+    """
+    Return the background sender, starting it on first use.
+    """
+    global _sender
+    with _sender_lock:
+        if _sender is None:
+            _sender = BackgroundSender(ASYNC_SENDER_THREADS, ASYNC_SENDER_QUEUE_SIZE)
+    return _sender
+
+
+def flush(timeout=None):
+    """
+    Wait for the messages being sent in the background, and the tasks being
+    run locally, if any. Returns whether they were all done within the timeout.
+    """
+    flushed = _sender is None or _sender.flush(timeout)
+    if is_local():
+        from .local_async import flush as flush_local
+        flushed = flush_local(timeout) and flushed
+    return flushed
+
+
+##
+# Local execution
+##
+
+def is_local():
+    """
+    Whether tasks are run by the local backend, rather than synchronously or on Lambda.
+    """
+    return bool(ASYNC_LOCAL_BACKEND) and not os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+
+
+def get_local_response(service='lambda'):
+    """
+    Return a response running a task on the local backend, which is only
+    imported when it's used.
+    """
+    from .local_async import LocalAsyncResponse
+    return LocalAsyncResponse(service=service)
+
+
 ##
 # Aync Routers
 ##
@@ -260,6 +811,7 @@ class SnsAsyncResponse(LambdaAsyncResponse):
 ASYNC_CLASSES = {
     'lambda': LambdaAsyncResponse,
     'sns': SnsAsyncResponse,
+    'sqs': SqsAsyncResponse,
 }
 
 
@@ -269,7 +821,7 @@ def route_lambda_task(event, context):
     imports the function, calls the function with args
     """
     message = event
-    return run_message(message)
+    return run_messages(message)
 
 
 def route_sns_task(event, context):
@@ -281,7 +833,52 @@ def route_sns_task(event, context):
     message = json.loads(
             record['Sns']['Message']
         )
-    return run_message(message)
+    return run_messages(message)
+
+
+def route_sqs_task(event, context):
+    """
+    Runs each message of a batch of SQS records, returning the ones which
+    failed in a partial batch response, so that only those are retried.
+
+    A lone record's error is raised instead, as the handler's per-record
+    processing expects.
+    """
+    records = event['Records']
+    if len(records) == 1:
+        return run_messages(json.loads(records[0]['body']))
+
+    batch_item_failures = []
+    for record in records:
+        try:
+            run_messages(json.loads(record['body']))
+        except Exception as e:
+            print('SQS message {} failed: {!r}'.format(record.get('messageId'), e))
+            batch_item_failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': batch_item_failures}
+
+
+def run_messages(message):
+    """
+    Run a message, or each message of a batch, returning the list of their
+    results. A batch's messages are all run, even if some of them raise.
+    """
+    if 'batch' not in message:
+        return run_message(message)
+
+    results = []
+    errors = []
+    for task_message in message['batch']:
+        try:
+            results.append(run_message(task_message))
+        except Exception as e:
+            print('Task {} failed: {!r}'.format(task_message.get('task_path'), e))
+            errors.append(e)
+            results.append(None)
+    if errors:
+        raise AsyncException('{} of {} batched tasks failed, the first with: {!r}'.format(
+            len(errors), len(results), errors[0]))
+    return results
 
 
 def run_message(message):
@@ -291,16 +888,19 @@ def run_message(message):
     and a 'command' in handler.py
     """
     if message.get('capture_response', False):
-        DYNAMODB_CLIENT.put_item(
+        get_async_client('dynamodb').put_item(
             TableName=ASYNC_RESPONSE_TABLE,
             Item={
                 'id': {'S': str(message['response_id'])},
-                'ttl': {'N': str(int(time.time()+600))},
+                'ttl': get_ttl(ASYNC_RESPONSE_TTL),
                 'async_status': {'S': 'in progress'},
                 'async_response': {'S': str(json.dumps('N/A'))},
             }
         )
 
+    if 'payload' in message:
+        message = dict(message, **get_payload(get_async_client('s3'), message['payload']))
+
     func = import_and_get_task(message['task_path'])
     if hasattr(func, 'sync'):
         response = func.sync(
@@ -314,18 +914,43 @@ def run_message(message):
         )
 
     if message.get('capture_response', False):
-        DYNAMODB_CLIENT.update_item(
-            TableName=ASYNC_RESPONSE_TABLE,
-            Key={'id': {'S': str(message['response_id'])}},
-            UpdateExpression="SET async_response = :r, async_status = :s",
-            ExpressionAttributeValues={
-                ':r': {'S': str(json.dumps(response))},
-                ':s': {'S': 'complete'},
-            },
-        )
+        set_async_response(message['response_id'], response)
 
     return response
 
+
+def get_ttl(seconds):
+    """
+    Return the ttl attribute of an item expiring in that many seconds.
+    """
+    return {'N': str(int(time.time() + seconds))}
+
+
+def set_async_response(response_id, response, status='complete', ttl=ASYNC_RESPONSE_TTL):
+    """
+    Store a task's response in the async table, to expire ttl seconds later.
+    """
+    serialized_response = json.dumps(response)
+    values = {
+        ':r': {'S': serialized_response},
+        ':s': {'S': status},
+        ':t': get_ttl(ttl),
+    }
+    # ttl is a reserved word.
+    update = "SET async_response = :r, async_status = :s, #ttl = :t"
+    # Local responses never leave the machine.
+    if ASYNC_PAYLOAD_BUCKET and not is_local() and len(serialized_response.encode('utf-8')) > ASYNC_PAYLOAD_THRESHOLD:
+        values[':r'] = {'S': json.dumps(None)}
+        values[':p'] = {'S': json.dumps(put_payload(get_async_client('s3'), serialized_response.encode('utf-8')))}
+        update += ", async_response_payload = :p"
+    get_async_client('dynamodb').update_item(
+        TableName=ASYNC_RESPONSE_TABLE,
+        Key={'id': {'S': str(response_id)}},
+        UpdateExpression=update,
+        ExpressionAttributeNames={'#ttl': 'ttl'},
+        ExpressionAttributeValues=values,
+    )
+
 ##
 # Execution interfaces and classes
 ##
@@ -350,12 +975,283 @@ def run(func, args=[], kwargs={}, service='lambda', capture_response=False,
     aws_region = remote_aws_region or os.environ.get('AWS_REGION')
 
     task_path = get_func_task_path(func)
+    if not lambda_function_name and is_local():
+        return get_local_response(service).send(task_path, args, kwargs)
     return ASYNC_CLASSES[service](lambda_function_name=lambda_function_name,
                                   aws_region=aws_region,
                                   capture_response=capture_response,
                                   **task_kwargs).send(task_path, args, kwargs)
 
 
+def run_many(calls, service='lambda', capture_response=False,
+             remote_aws_lambda_function_name=None, remote_aws_region=None, **task_kwargs):
+    """
+    Run each of a list of (func, args, kwargs) calls asynchronously, as with run(),
+    sending them in as few invocations or messages as possible.
+
+    Returns the response of each call's dispatch.
+    """
+    with batch():
+        return [
+            run(func, args, kwargs, service=service, capture_response=capture_response,
+                remote_aws_lambda_function_name=remote_aws_lambda_function_name,
+                remote_aws_region=remote_aws_region, **task_kwargs)
+            for func, args, kwargs in calls
+        ]
+
+
+##
+# Fan-out and fan-in
+##
+
+def map(func, iterable, chunk_size=1, max_in_flight=None, callback=None, service='lambda',
+        max_attempts=ASYNC_MAP_MAX_ATTEMPTS, remote_aws_lambda_function_name=None, remote_aws_region=None,
+        **task_kwargs):
+    """
+    Run func on each item of iterable asynchronously, chunk_size items to an
+    invocation, with at most max_in_flight chunks running at once. Once every
+    chunk is done, callback is run as a task with the list of all the results.
+
+    A chunk is only marked failed once it failed max_attempts times, which
+    should match the retries of the function's asynchronous invocations.
+
+    Returns a MapResult. Outside of Lambda, the items are mapped synchronously,
+    unless there's a local backend.
+    """
+    items = list(iterable)
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+
+    lambda_function_name = remote_aws_lambda_function_name or os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    aws_region = remote_aws_region or os.environ.get('AWS_REGION')
+    if not lambda_function_name and not is_local():
+        mapped_func = getattr(func, 'sync', func)
+        results = [[mapped_func(item) for item in chunk] for chunk in chunks]
+        if callback:
+            getattr(callback, 'sync', callback)(list(itertools.chain.from_iterable(results)))
+        return MapResult(None, len(chunks), chunk_size, results=results)
+
+    if ASYNC_RESPONSE_TABLE is None and not is_local():
+        raise AsyncException("Mapping requires the async_response_table setting.")
+
+    callback_path = get_func_task_path(callback) if callback else None
+    dispatch_kwargs = dict(
+        service=service,
+        remote_aws_lambda_function_name=lambda_function_name,
+        remote_aws_region=aws_region,
+        **task_kwargs
+    )
+    map_id = str(uuid.uuid4())
+    if not chunks:
+        if callback:
+            run(callback, ([],), **dispatch_kwargs)
+        return MapResult(map_id, 0, chunk_size)
+
+    item = {
+        'id': {'S': map_id},
+        'ttl': get_ttl(ASYNC_MAP_TTL),
+        'async_status': {'S': 'in progress'},
+        'async_response': {'S': json.dumps('N/A')},
+        'chunks': {'N': str(len(chunks))},
+        'chunk_size': {'N': str(chunk_size)},
+        'items': {'N': str(len(items))},
+    }
+    get_async_client('dynamodb').put_item(TableName=ASYNC_RESPONSE_TABLE, Item=item)
+
+    task_path = get_func_task_path(func)
+    # Local tasks aren't retried.
+    max_attempts = 1 if is_local() else max_attempts
+    lanes = min(max_in_flight or len(chunks), len(chunks))
+    for lane in range(lanes):
+        lane_chunks = [[index, chunks[index]] for index in range(lane, len(chunks), lanes)]
+        run(run_map_lane, (map_id, task_path, lane_chunks, callback_path, dispatch_kwargs, max_attempts),
+            **dispatch_kwargs)
+    return MapResult(map_id, len(chunks), chunk_size)
+
+
+def get_map_chunk_id(map_id, index):
+    return '{}:{}'.format(map_id, index)
+
+
+def run_map_lane(map_id, task_path, chunks, callback_path=None, dispatch_kwargs=None,
+                 max_attempts=ASYNC_MAP_MAX_ATTEMPTS):
+    """
+    Run the first of a map's lane of chunks, then dispatch the rest of the
+    lane with the map's dispatch options.
+
+    A chunk which fails raises, so that it's retried, until its last attempt:
+    that one records the chunk as failed, and the lane carries on.
+    """
+    dispatch_kwargs = dispatch_kwargs or {}
+    (index, items), rest = chunks[0], chunks[1:]
+    func = import_and_get_task(task_path)
+    func = getattr(func, 'sync', func)
+    try:
+        results = [func(item) for item in items]
+    except Exception as e:
+        if not fail_map_chunk(map_id, index, e, max_attempts):
+            raise
+        results = None
+    else:
+        set_async_response(get_map_chunk_id(map_id, index), results, ttl=ASYNC_MAP_TTL)
+
+    if rest:
+        run(run_map_lane, (map_id, task_path, rest, callback_path, dispatch_kwargs, max_attempts),
+            **dispatch_kwargs)
+    complete_map_chunk(map_id, index, callback_path, failed=results is None, **dispatch_kwargs)
+    return results
+
+
+def fail_map_chunk(map_id, index, exception, max_attempts=ASYNC_MAP_MAX_ATTEMPTS):
+    """
+    Count a failed attempt at a chunk of a map, marking the chunk failed once
+    it's the last. Until then the chunk stays in progress, as it's retried.
+    Returns whether the chunk was marked failed.
+    """
+    chunk_id = get_map_chunk_id(map_id, index)
+    item = get_async_client('dynamodb').update_item(
+        TableName=ASYNC_RESPONSE_TABLE,
+        Key={'id': {'S': chunk_id}},
+        UpdateExpression="ADD attempts :one SET async_response = :r, async_status = :s, #ttl = :t",
+        ExpressionAttributeNames={'#ttl': 'ttl'},
+        ExpressionAttributeValues={
+            ':one': {'N': '1'},
+            ':r': {'S': json.dumps(None)},
+            ':s': {'S': 'in progress'},
+            ':t': get_ttl(ASYNC_MAP_TTL),
+        },
+        ReturnValues='ALL_NEW',
+    )['Attributes']
+    if int(item['attempts']['N']) < max_attempts:
+        return False
+    set_async_response(chunk_id, repr(exception), status='failed', ttl=ASYNC_MAP_TTL)
+    return True
+
+
+def complete_map_chunk(map_id, index, callback_path=None, failed=False, **dispatch_kwargs):
+    """
+    Record that a chunk of a map is done, or failed, and if it was the last
+    one, complete the map and dispatch its callback with dispatch_kwargs.
+    Returns whether it completed the map.
+
+    Chunks are recorded in sets, and the map is completed with a conditional
+    update, so that a retried chunk doesn't complete it twice. Each chunk
+    extends the life of the map's row.
+    """
+    update = "ADD done_chunks :c, failed_chunks :c" if failed else "ADD done_chunks :c"
+    try:
+        item = get_async_client('dynamodb').update_item(
+            TableName=ASYNC_RESPONSE_TABLE,
+            Key={'id': {'S': map_id}},
+            UpdateExpression=update + " SET #ttl = :t",
+            ConditionExpression="attribute_exists(chunks)",
+            ExpressionAttributeNames={'#ttl': 'ttl'},
+            ExpressionAttributeValues={':c': {'NS': [str(index)]}, ':t': get_ttl(ASYNC_MAP_TTL)},
+            ReturnValues='ALL_NEW',
+        )['Attributes']
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            raise AsyncException("Map {} doesn't exist, or expired.".format(map_id))
+        raise
+    chunk_count = int(item['chunks']['N'])
+    if len(item['done_chunks']['NS']) < chunk_count:
+        return False
+
+    status = 'failed' if 'failed_chunks' in item else 'complete'
+    try:
+        get_async_client('dynamodb').update_item(
+            TableName=ASYNC_RESPONSE_TABLE,
+            Key={'id': {'S': map_id}},
+            UpdateExpression="SET async_status = :s",
+            ConditionExpression="async_status = :p",
+            ExpressionAttributeValues={':s': {'S': status}, ':p': {'S': 'in progress'}},
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+    if callback_path:
+        result = MapResult(map_id, chunk_count, int(item['chunk_size']['N']), item_count=int(item['items']['N']))
+        run(import_and_get_task(callback_path), (result.results(raise_failed=False),), **dispatch_kwargs)
+    return True
+
+
+class MapResult:
+    """
+    The handle of a map, whose chunks' results are read from the async
+    response table as they complete.
+    """
+    def __init__(self, map_id, chunk_count, chunk_size=1, results=None, item_count=None):
+        self.map_id = map_id
+        self.chunk_count = chunk_count
+        self.chunk_size = chunk_size
+        self.item_count = item_count if item_count is not None else chunk_count * chunk_size
+        # The results of the chunks already read, by index
+        self.chunk_results = dict(enumerate(results)) if results is not None else {}
+        # The errors of the chunks which failed, by index
+        self.errors = {}
+
+    @property
+    def response_ids(self):
+        return [get_map_chunk_id(self.map_id, index) for index in range(self.chunk_count)]
+
+    def done(self):
+        """
+        Whether every chunk is done.
+        """
+        if len(self.chunk_results) + len(self.errors) == self.chunk_count:
+            return True
+        response = get_async_response(self.map_id)
+        return response is not None and response['status'] != 'in progress'
+
+    def iter_chunks(self, timeout=None, raise_failed=True):
+        """
+        Yield the (index, results) of each chunk as it completes. Raises
+        AsyncException if a chunk failed its last attempt, unless raise_failed
+        is False, in which case its error is kept in errors, or if the timeout
+        passes first.
+        """
+        for index in sorted(self.chunk_results):
+            yield index, self.chunk_results[index]
+
+        pending = [
+            get_map_chunk_id(self.map_id, index) for index in range(self.chunk_count)
+            if index not in self.chunk_results and index not in self.errors
+        ]
+        for response_id, response in wait(pending, timeout):
+            index = int(response_id.rsplit(':', 1)[1])
+            if response['status'] == 'failed':
+                self.errors[index] = response['response']
+                continue
+            self.chunk_results[index] = response['response']
+            yield index, response['response']
+        if self.errors and raise_failed:
+            raise AsyncException('Chunks {} of map {} failed: {}'.format(
+                sorted(self.errors), self.map_id, self.errors[min(self.errors)]))
+
+    def as_completed(self, timeout=None):
+        """
+        Yield the (index, result) of each item as its chunk completes.
+        """
+        for chunk_index, results in self.iter_chunks(timeout):
+            for offset, result in enumerate(results):
+                yield chunk_index * self.chunk_size + offset, result
+
+    def results(self, timeout=None, raise_failed=True):
+        """
+        Wait for every chunk, and return the list of all the results, in order.
+        Without raise_failed, the items of failed chunks get None.
+        """
+        for _ in self.iter_chunks(timeout, raise_failed):
+            pass
+        return list(itertools.chain.from_iterable(
+            self.chunk_results[index] if index in self.chunk_results else [None] * self.get_chunk_length(index)
+            for index in range(self.chunk_count)))
+
+    def get_chunk_length(self, index):
+        return min(self.chunk_size, self.item_count - index * self.chunk_size)
+
+
 # Handy:
 # http://stackoverflow.com/questions/10294014/python-decorator-best-practice-using-a-class-vs-a-function
 # However, this needs to pass inspect.getargspec() in handler.py which does not take classes
@@ -369,7 +1265,7 @@ def task(*args, **kwargs):
             Further requirements:
             func must be an independent top-level function.
                  i.e. not a class method or an anonymous function
-        service (str): either 'lambda' or 'sns'
+        service (str): either 'lambda', 'sns' or 'sqs'
         remote_aws_lambda_function_name (str): the name of a remote lambda function to call with this task
         remote_aws_region (str): the name of a remote region to make lambda/sns calls against
 
@@ -426,6 +1322,8 @@ def task(*args, **kwargs):
                                                      aws_region=aws_region,
                                                      capture_response=capture_response).send(task_path, args, kwargs)
                 return send_result
+            elif (service in ASYNC_CLASSES) and is_local():
+                return get_local_response(service).send(task_path, args, kwargs)
             else:
                 return func(*args, **kwargs)
 
@@ -446,6 +1344,13 @@ def task_sns(func):
     return task(func, service='sns')
 
 
+def task_sqs(func):
+    """
+    SQS-based task dispatcher. Functions the same way as task()
+    """
+    return task(func, service='sqs')
+
+
 ##
 # Utility Functions
 ##
@@ -477,14 +1382,124 @@ def get_async_response(response_id):
     """
     Get the response from the async table
     """
-    response = DYNAMODB_CLIENT.get_item(
+    response = get_async_client('dynamodb').get_item(
         TableName=ASYNC_RESPONSE_TABLE,
         Key={'id': {'S': str(response_id)}}
     )
     if 'Item' not in response:
         return None
 
+    return get_response_from_item(response['Item'])
+
+
+def get_response_from_item(item):
+    if 'async_response_payload' in item:
+        # The response was too large for the table.
+        task_response = get_payload(get_async_client('s3'), json.loads(item['async_response_payload']['S']))
+    else:
+        task_response = json.loads(item['async_response']['S'])
     return {
-        'status': response['Item']['async_status']['S'],
-        'response': json.loads(response['Item']['async_response']['S']),
+        'status': item['async_status']['S'],
+        'response': task_response,
     }
+
+
+def get_async_responses(response_ids):
+    """
+    Get the responses of many tasks from the async table, a hundred to a
+    BatchGetItem call. Returns a dict of each id's response, or None if the
+    table doesn't have it.
+    """
+    response_ids = list(dict.fromkeys(str(response_id) for response_id in response_ids))
+    responses = dict.fromkeys(response_ids)
+    for start in range(0, len(response_ids), DYNAMODB_BATCH_GET_LIMIT):
+        keys = [{'id': {'S': response_id}} for response_id in response_ids[start:start + DYNAMODB_BATCH_GET_LIMIT]]
+        for attempt in range(DYNAMODB_BATCH_GET_RETRIES + 1):
+            if attempt:
+                time.sleep(get_backoff_delay(attempt))
+            result = get_async_client('dynamodb').batch_get_item(RequestItems={ASYNC_RESPONSE_TABLE: {'Keys': keys}})
+            for item in result.get('Responses', {}).get(ASYNC_RESPONSE_TABLE, []):
+                responses[item['id']['S']] = get_response_from_item(item)
+            keys = result.get('UnprocessedKeys', {}).get(ASYNC_RESPONSE_TABLE, {}).get('Keys')
+            if not keys:
+                break
+        else:
+            raise AsyncException('Failed to get {} async responses after {} retries.'.format(
+                len(keys), DYNAMODB_BATCH_GET_RETRIES))
+    return responses
+
+
+def get_backoff_delay(attempt, initial_delay=ASYNC_POLL_INITIAL_DELAY, max_delay=ASYNC_POLL_MAX_DELAY):
+    """
+    Return a delay before the attempt-th retry: exponential backoff, with full jitter.
+    """
+    return random.uniform(0, min(max_delay, initial_delay * 2 ** attempt))
+
+
+def pop_completed(pending, responses):
+    """
+    Remove the ids of the completed tasks from pending,
+    and return their (response_id, response).
+    """
+    completed = [
+        (response_id, responses[response_id]) for response_id in pending
+        if responses.get(response_id) is not None and responses[response_id]['status'] != 'in progress'
+    ]
+    for response_id, response in completed:
+        pending.remove(response_id)
+    return completed
+
+
+def wait(response_ids, timeout=None, initial_delay=ASYNC_POLL_INITIAL_DELAY, max_delay=ASYNC_POLL_MAX_DELAY):
+    """
+    Yield the (response_id, response) of each task as it completes, or fails.
+    The tasks still pending are polled with exponential backoff, which starts
+    over whenever one completes. Raises AsyncException if the timeout passes first.
+    """
+    pending = list(dict.fromkeys(str(response_id) for response_id in response_ids))
+    deadline = time.time() + timeout if timeout is not None else None
+    attempt = 0
+    while pending:
+        completed = pop_completed(pending, get_async_responses(pending))
+        for response_id, response in completed:
+            yield response_id, response
+        if not pending:
+            break
+
+        attempt = 0 if completed else attempt + 1
+        delay = get_backoff_delay(attempt, initial_delay, max_delay)
+        if deadline is not None:
+            if time.time() >= deadline:
+                raise AsyncException('Timed out waiting for {} async responses.'.format(len(pending)))
+            delay = max(0, min(delay, deadline - time.time()))
+        time.sleep(delay)
+
+
+async def wait_async(response_ids, timeout=None, initial_delay=ASYNC_POLL_INITIAL_DELAY,
+                     max_delay=ASYNC_POLL_MAX_DELAY):
+    """
+    The same as wait(), as an asynchronous generator. The table is read
+    in the event loop's default executor.
+    """
+    # Imported here, so that only the apps using it pay for it.
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    pending = list(dict.fromkeys(str(response_id) for response_id in response_ids))
+    deadline = time.time() + timeout if timeout is not None else None
+    attempt = 0
+    while pending:
+        responses = await loop.run_in_executor(None, get_async_responses, list(pending))
+        completed = pop_completed(pending, responses)
+        for response_id, response in completed:
+            yield response_id, response
+        if not pending:
+            break
+
+        attempt = 0 if completed else attempt + 1
+        delay = get_backoff_delay(attempt, initial_delay, max_delay)
+        if deadline is not None:
+            if time.time() >= deadline:
+                raise AsyncException('Timed out waiting for {} async responses.'.format(len(pending)))
+            delay = max(0, min(delay, deadline - time.time()))
+        await asyncio.sleep(delay)
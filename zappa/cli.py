@@ -46,6 +46,13 @@ from .utilities import (check_new_version_available, detect_django_settings,
                   detect_flask_apps, parse_s3_url, human_size,
                   validate_name, InvalidAwsLambdaName, get_venv_from_python_version,
                   get_runtime_from_python_version, string_to_timestamp, is_valid_bucket_name)
+from .access_log import ACCESS_LOG_FORMATS
+from .metrics import METRICS_NAMESPACE
+from .offload import OFFLOAD_EXPIRES_IN, OFFLOAD_PREFIX, OFFLOAD_STATUS_CODE, OFFLOAD_THRESHOLD
+from .preload import PRELOAD_LIMIT, PRELOAD_MANIFEST, build_manifest, format_report, trace_imports
+from .streaming import EXEC_WRAPPER, EXEC_WRAPPER_SCRIPT
+from .middleware import RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES
+from .wsgi import COMPRESSION_MIN_SIZE, COMPRESSION_MIMETYPES
 
 
 CUSTOM_SETTINGS = [
@@ -666,7 +673,9 @@ class ZappaCLI:
                                             authorizer=self.authorizer,
                                             cors_options=self.cors,
                                             description=self.apigateway_description,
-                                            endpoint_configuration=self.endpoint_configuration
+                                            endpoint_configuration=self.endpoint_configuration,
+                                            api_version=self.apigateway_version,
+                                            stage_name=self.api_stage
                                         )
 
         if not output:
@@ -737,7 +746,7 @@ class ZappaCLI:
                     raise ClickException("Unable to upload handler to S3. Quitting.")
 
                 # Copy the project zip to the current project zip
-                current_project_name = '{0!s}_{1!s}_current_project.tar.gz'.format(self.api_stage, self.project_name)
+                current_project_name = self.get_current_project_archive_name()
                 success = self.zappa.copy_on_s3(src_file_name=self.zip_path, dst_file_name=current_project_name,
                                                 bucket_name=self.s3_bucket_name)
                 if not success:  # pragma: no cover
@@ -811,7 +820,9 @@ class ZappaCLI:
                                                         authorizer=self.authorizer,
                                                         cors_options=self.cors,
                                                         description=self.apigateway_description,
-                                                        endpoint_configuration=self.endpoint_configuration
+                                                        endpoint_configuration=self.endpoint_configuration,
+                                                        api_version=self.apigateway_version,
+                                                        stage_name=self.api_stage
                                                     )
 
             self.zappa.update_stack(
@@ -823,18 +834,22 @@ class ZappaCLI:
 
             api_id = self.zappa.get_api_id(self.lambda_name)
 
-            # Add binary support
-            if self.binary_support:
-                self.zappa.add_binary_support(api_id=api_id, cors=self.cors)
-
-            # Add payload compression
-            if self.stage_config.get('payload_compression', True):
-                self.zappa.add_api_compression(
-                    api_id=api_id,
-                    min_compression_size=self.stage_config.get('payload_minimum_compression_size', 0))
-
-            # Deploy the API!
-            endpoint_url = self.deploy_api_gateway(api_id)
+            if self.apigateway_version == 'v2':
+                # HTTP APIs handle binary bodies themselves, and deploy automatically.
+                endpoint_url = self.zappa.get_api_url(self.lambda_name, self.api_stage)
+            else:
+                # Add binary support
+                if self.binary_support:
+                    self.zappa.add_binary_support(api_id=api_id, cors=self.cors)
+
+                # Add payload compression
+                if self.stage_config.get('payload_compression', True):
+                    self.zappa.add_api_compression(
+                        api_id=api_id,
+                        min_compression_size=self.stage_config.get('payload_minimum_compression_size', 0))
+
+                # Deploy the API!
+                endpoint_url = self.deploy_api_gateway(api_id)
             deployment_string = deployment_string + ": {}".format(endpoint_url)
 
             # Create/link API key
@@ -847,6 +862,10 @@ class ZappaCLI:
             if self.stage_config.get('touch', True):
                 self.touch_endpoint(endpoint_url)
 
+        if self.function_url:
+            function_url = self.deploy_function_url()
+            deployment_string = deployment_string + "\nFunction URL: {}".format(function_url)
+
         # Finally, delete the local copy our zip package
         if not source_zip:
             if self.stage_config.get('delete_local_zip', True):
@@ -925,7 +944,7 @@ class ZappaCLI:
                         raise ClickException("Unable to upload handler to S3. Quitting.")
 
                     # Copy the project zip to the current project zip
-                    current_project_name = '{0!s}_{1!s}_current_project.tar.gz'.format(self.api_stage, self.project_name)
+                    current_project_name = self.get_current_project_archive_name()
                     success = self.zappa.copy_on_s3(src_file_name=self.zip_path, dst_file_name=current_project_name,
                                                     bucket_name=self.s3_bucket_name)
                     if not success:  # pragma: no cover
@@ -994,7 +1013,9 @@ class ZappaCLI:
                                             authorizer=self.authorizer,
                                             cors_options=self.cors,
                                             description=self.apigateway_description,
-                                            endpoint_configuration=self.endpoint_configuration
+                                            endpoint_configuration=self.endpoint_configuration,
+                                            api_version=self.apigateway_version,
+                                            stage_name=self.api_stage
                                         )
             self.zappa.update_stack(
                                     self.lambda_name,
@@ -1005,22 +1026,25 @@ class ZappaCLI:
 
             api_id = self.zappa.get_api_id(self.lambda_name)
 
-            # Update binary support
-            if self.binary_support:
-                self.zappa.add_binary_support(api_id=api_id, cors=self.cors)
+            if self.apigateway_version == 'v2':
+                endpoint_url = self.zappa.get_api_url(self.lambda_name, self.api_stage)
             else:
-                self.zappa.remove_binary_support(api_id=api_id, cors=self.cors)
+                # Update binary support
+                if self.binary_support:
+                    self.zappa.add_binary_support(api_id=api_id, cors=self.cors)
+                else:
+                    self.zappa.remove_binary_support(api_id=api_id, cors=self.cors)
 
-            if self.stage_config.get('payload_compression', True):
-                self.zappa.add_api_compression(
-                    api_id=api_id,
-                    min_compression_size=self.stage_config.get('payload_minimum_compression_size', 0))
-            else:
-                self.zappa.remove_api_compression(api_id=api_id)
+                if self.stage_config.get('payload_compression', True):
+                    self.zappa.add_api_compression(
+                        api_id=api_id,
+                        min_compression_size=self.stage_config.get('payload_minimum_compression_size', 0))
+                else:
+                    self.zappa.remove_api_compression(api_id=api_id)
 
-            # It looks a bit like we might actually be using this just to get the URL,
-            # but we're also updating a few of the APIGW settings.
-            endpoint_url = self.deploy_api_gateway(api_id)
+                # It looks a bit like we might actually be using this just to get the URL,
+                # but we're also updating a few of the APIGW settings.
+                endpoint_url = self.deploy_api_gateway(api_id)
 
             if self.stage_config.get('domain', None):
                 endpoint_url = self.stage_config.get('domain')
@@ -1034,6 +1058,9 @@ class ZappaCLI:
         # do this after schedule as schedule clears the lambda policy and we need to add one
         self.update_cognito_triggers()
 
+        # Re-add the Function URL's permission, which scheduling removed
+        function_url = self.deploy_function_url() if self.function_url else None
+
         self.callback('post')
 
         if endpoint_url and 'https://' not in endpoint_url:
@@ -1043,6 +1070,8 @@ class ZappaCLI:
             endpoint_url += '/' + self.base_path
 
         deployed_string = "Your updated Zappa deployment is " + click.style("live", fg='green', bold=True) + "!"
+        if function_url:
+            deployed_string = deployed_string + "\nFunction URL: " + click.style(function_url, bold=True)
         if self.use_apigateway:
             deployed_string = deployed_string + ": " + click.style("{}".format(endpoint_url), bold=True)
 
@@ -1063,6 +1092,16 @@ class ZappaCLI:
 
         click.echo(deployed_string)
 
+    def deploy_function_url(self):
+        """
+        Create or update the function's URL, streaming its responses if response_streaming is set.
+        """
+        return self.zappa.deploy_function_url(
+            self.lambda_name,
+            invoke_mode='RESPONSE_STREAM' if self.response_streaming else 'BUFFERED',
+            auth_type=self.function_url_auth_type
+        )
+
     def rollback(self, revision):
         """
         Rollsback the currently deploy lambda code to a previous revision.
@@ -1175,6 +1214,15 @@ class ZappaCLI:
         for event in events:
             self.collision_warning(event.get('function'))
 
+        if self.stage_config.get('per_record_processing', False):
+            # Failed records are reported in the handler's response rather than raised,
+            # which the mappings must be told about, or the failures are dropped.
+            for event in events:
+                event_source = event.get('event_source', {})
+                if 'arn' in event_source and \
+                   self.zappa.service_from_arn(event_source['arn']) in ('sqs', 'kinesis', 'dynamodb'):
+                    event_source.setdefault('function_response_types', ['ReportBatchItemFailures'])
+
         if self.stage_config.get('keep_warm', True):
             if not events:
                 events = []
@@ -1212,6 +1260,35 @@ class ZappaCLI:
             )
             click.echo('SNS Topic created: %s' % topic_arn)
 
+        # Add async tasks SQS
+        if self.stage_config.get('async_source', None) == 'sqs' \
+           and self.stage_config.get('async_resources', True):
+            self.lambda_arn = self.zappa.get_lambda_function(
+                function_name=self.lambda_name)
+            queue_arn = self.zappa.create_async_sqs_queue(
+                lambda_name=self.lambda_name,
+                lambda_arn=self.lambda_arn,
+                batch_size=self.stage_config.get('async_sqs_batch_size', 10),
+                batching_window=self.stage_config.get('async_sqs_batching_window', 0),
+                visibility_timeout=6 * self.timeout_seconds
+            )
+            click.echo('SQS Queue created: %s' % queue_arn)
+
+        # Expire large async payloads, which nothing else deletes
+        async_payload_bucket = self.stage_config.get('async_payload_bucket')
+        expiration_days = self.stage_config.get('async_payload_expiration_days', 7)
+        if async_payload_bucket and self.stage_config.get('async_resources', True):
+            self.zappa.add_async_payload_expiration(async_payload_bucket, days=expiration_days)
+            click.echo('Async payloads in %s expire after %d days' % (async_payload_bucket, expiration_days))
+
+        # Expire offloaded bodies, which are only read once
+        offload_bucket = self.stage_config.get('offload_bucket')
+        expiration_days = self.stage_config.get('offload_expiration_days', 1)
+        if offload_bucket:
+            self.zappa.add_offload_expiration(
+                offload_bucket, days=expiration_days, prefix=self.stage_config.get('offload_prefix', OFFLOAD_PREFIX))
+            click.echo('Offloaded bodies in %s expire after %d days' % (offload_bucket, expiration_days))
+
         # Add async tasks DynamoDB
         table_name = self.stage_config.get('async_response_table', False)
         read_capacity = self.stage_config.get('async_response_table_read_capacity', 1)
@@ -1266,6 +1343,13 @@ class ZappaCLI:
             removed_arns = self.zappa.remove_async_sns_topic(self.lambda_name)
             click.echo('SNS Topic removed: %s' % ', '.join(removed_arns))
 
+        # Remove async task SQS
+        if self.stage_config.get('async_source', None) == 'sqs' \
+           and self.stage_config.get('async_resources', True):
+            removed_arn = self.zappa.remove_async_sqs_queue(self.lambda_name)
+            if removed_arn:
+                click.echo('SQS Queue removed: %s' % removed_arn)
+
     def invoke(self, function_name, raw_python=False, command=None, no_color=False):
         """
         Invoke a remote function.
@@ -2076,6 +2160,8 @@ class ZappaCLI:
         self.use_apigateway = self.stage_config.get('use_apigateway', True)
         if self.use_apigateway:
             self.use_apigateway = self.stage_config.get('apigateway_enabled', True)
+        # 'v1' for a REST API, 'v2' for an HTTP API
+        self.apigateway_version = self.stage_config.get('apigateway_version', 'v1')
         self.apigateway_description = self.stage_config.get('apigateway_description', None)
 
         self.lambda_handler = self.stage_config.get('lambda_handler', 'handler.lambda_handler')
@@ -2089,6 +2175,16 @@ class ZappaCLI:
         self.binary_support = self.stage_config.get('binary_support', True)
         self.api_key_required = self.stage_config.get('api_key_required', False)
         self.api_key = self.stage_config.get('api_key')
+
+        # API keys, usage plans, authorizers and the custom domains Zappa manages
+        # belong to REST APIs. An HTTP API without them would be public.
+        if self.use_apigateway and self.apigateway_version == 'v2':
+            for setting in ['api_key_required', 'domain', 'iam_authorization', 'authorizer']:
+                if self.stage_config.get(setting):
+                    raise ClickException(
+                        click.style(setting, fg="red", bold=True) + " isn't supported with " +
+                        click.style("apigateway_version", bold=True) + " v2 (HTTP APIs). "
+                        "Use a REST API (v1), or remove it from the settings.")
         self.endpoint_configuration = self.stage_config.get('endpoint_configuration', None)
         self.iam_authorization = self.stage_config.get('iam_authorization', False)
         self.cors = self.stage_config.get("cors", False)
@@ -2109,6 +2205,25 @@ class ZappaCLI:
         self.use_alb = self.stage_config.get('alb_enabled', False)
         self.alb_vpc_config = self.stage_config.get('alb_vpc_config', {})
 
+        # Load Function URL settings. Streamed responses are served through one.
+        self.response_streaming = self.stage_config.get('response_streaming', False)
+        self.function_url = self.stage_config.get('function_url', self.response_streaming)
+        self.function_url_auth_type = self.stage_config.get('function_url_auth_type', 'NONE')
+        if self.response_streaming:
+            if self.runtime in ['python3.6', 'python3.7']:
+                raise ClickException(
+                    click.style("response_streaming", fg="red", bold=True) + " needs the python3.8 runtime or "
+                    "later, which run the exec wrapper that streams responses.")
+            # The streaming runtime always calls Zappa's handler.
+            if self.lambda_handler != 'handler.lambda_handler':
+                raise ClickException(
+                    click.style("response_streaming", fg="red", bold=True) + " can't be used with a custom " +
+                    click.style("lambda_handler", bold=True) + ", which the streaming runtime wouldn't call.")
+            self.aws_environment_variables = dict(
+                self.aws_environment_variables,
+                AWS_LAMBDA_EXEC_WRAPPER='/var/task/' + EXEC_WRAPPER
+            )
+
         # Additional tags
         self.tags = self.stage_config.get('tags', {})
 
@@ -2225,7 +2340,7 @@ class ZappaCLI:
                 exclude=self.stage_config.get('exclude', []),
                 exclude_glob=self.stage_config.get('exclude_glob', []),
                 disable_progress=self.disable_progress,
-                archive_format='tarball'
+                archive_format='lazy_zip' if self.stage_config.get('slim_handler_lazy_load', False) else 'tarball'
             )
 
             # Make sure the normal venv is not included in the handler's zip
@@ -2304,6 +2419,58 @@ class ZappaCLI:
             else:
                 settings_s = settings_s + "BINARY_SUPPORT=False\n"
 
+            # The app is an ASGI app
+            if self.stage_config.get('asgi', False):
+                settings_s += "ASGI=True\n"
+                settings_s += "ASGI_LIFESPAN={0!s}\n".format(self.stage_config.get('asgi_lifespan', True))
+
+            # Emit init and request phase timings as CloudWatch metrics
+            if self.stage_config.get('metrics', False):
+                settings_s += "METRICS=True\n"
+                settings_s += "METRICS_NAMESPACE='{0!s}'\n".format(
+                    self.stage_config.get('metrics_namespace', METRICS_NAMESPACE))
+
+            # Cache responses in the memory of warm containers
+            if self.stage_config.get('response_cache', False):
+                settings_s += "RESPONSE_CACHE=True\n"
+                settings_s += "RESPONSE_CACHE_MAX_ENTRIES={0!s}\n".format(
+                    self.stage_config.get('response_cache_max_entries', RESPONSE_CACHE_MAX_ENTRIES))
+                settings_s += "RESPONSE_CACHE_MAX_BYTES={0!s}\n".format(
+                    self.stage_config.get('response_cache_max_bytes', RESPONSE_CACHE_MAX_BYTES))
+                settings_s += "RESPONSE_CACHE_KEY_HEADERS={0!s}\n".format(
+                    self.stage_config.get('response_cache_key_headers', []))
+
+            # Offload request and response bodies too large for Lambda to S3
+            if self.stage_config.get('offload_bucket', None):
+                settings_s += "OFFLOAD_BUCKET='{0!s}'\n".format(self.stage_config['offload_bucket'])
+                settings_s += "OFFLOAD_PREFIX='{0!s}'\n".format(
+                    self.stage_config.get('offload_prefix', OFFLOAD_PREFIX))
+                settings_s += "OFFLOAD_THRESHOLD={0!s}\n".format(
+                    self.stage_config.get('offload_threshold', OFFLOAD_THRESHOLD))
+                settings_s += "OFFLOAD_EXPIRES_IN={0!s}\n".format(
+                    self.stage_config.get('offload_expires_in', OFFLOAD_EXPIRES_IN))
+                settings_s += "OFFLOAD_STATUS_CODE={0!s}\n".format(
+                    self.stage_config.get('offload_status_code', OFFLOAD_STATUS_CODE))
+                settings_s += "OFFLOAD_ENVELOPE={0!s}\n".format(
+                    self.stage_config.get('offload_envelope', False))
+
+            # Log requests as JSON records, and sample them
+            access_log_format = self.stage_config.get('access_log_format', 'common')
+            if access_log_format not in ACCESS_LOG_FORMATS:
+                raise ClickException("access_log_format must be one of: " + ", ".join(ACCESS_LOG_FORMATS))
+            settings_s += "ACCESS_LOG_FORMAT='{0!s}'\n".format(access_log_format)
+            settings_s += "ACCESS_LOG_SAMPLE_RATES={0!s}\n".format(
+                self.stage_config.get('access_log_sample_rates', {}))
+
+            # Compress responses in the handler, for ALB as well as API Gateway
+            # (REST APIs only with binary_support, which decodes the body)
+            if self.stage_config.get('response_compression', False):
+                settings_s += "RESPONSE_COMPRESSION=True\n"
+                settings_s += "RESPONSE_COMPRESSION_MIN_SIZE={0!s}\n".format(
+                    self.stage_config.get('response_compression_min_size', COMPRESSION_MIN_SIZE))
+                settings_s += "RESPONSE_COMPRESSION_MIMETYPES={0!s}\n".format(
+                    self.stage_config.get('response_compression_mimetypes', COMPRESSION_MIMETYPES))
+
             head_map_dict = {}
             head_map_dict.update(dict(self.context_header_mappings))
             settings_s = settings_s + "CONTEXT_HEADER_MAPPINGS={0}\n".format(
@@ -2324,15 +2491,27 @@ class ZappaCLI:
 
             # Pass through remote config bucket and path
             if self.remote_env:
-                settings_s = settings_s + "REMOTE_ENV='{0!s}'\n".format(
-                    self.remote_env
-                )
+                # Several files can be given, later ones taking precedence
+                if isinstance(self.remote_env, list):
+                    settings_s = settings_s + "REMOTE_ENV={0!s}\n".format(
+                        [str(remote_env) for remote_env in self.remote_env]
+                    )
+                else:
+                    settings_s = settings_s + "REMOTE_ENV='{0!s}'\n".format(
+                        self.remote_env
+                    )
             # DEPRECATED. use remove_env instead
             elif self.remote_env_bucket and self.remote_env_file:
                 settings_s = settings_s + "REMOTE_ENV='s3://{0!s}/{1!s}'\n".format(
                     self.remote_env_bucket, self.remote_env_file
                 )
 
+            # Refresh the remote config in the background once this many seconds old
+            if self.stage_config.get('remote_env_ttl'):
+                settings_s = settings_s + "REMOTE_ENV_TTL={0!s}\n".format(
+                    int(self.stage_config['remote_env_ttl'])
+                )
+
             # Local envs
             env_dict = {}
             if self.aws_region:
@@ -2367,14 +2546,22 @@ class ZappaCLI:
 
             # If slim handler, path to project zip
             if self.stage_config.get('slim_handler', False):
-                settings_s += "ARCHIVE_PATH='s3://{0!s}/{1!s}_{2!s}_current_project.tar.gz'\n".format(
-                    self.s3_bucket_name, self.api_stage, self.project_name)
+                settings_s += "ARCHIVE_PATH='s3://{0!s}/{1!s}'\n".format(
+                    self.s3_bucket_name, self.get_current_project_archive_name())
 
                 # since includes are for slim handler add the setting here by joining arbitrary list from zappa_settings file
                 # and tell the handler we are the slim_handler
                 # https://github.com/Miserlou/Zappa/issues/776
                 settings_s += "SLIM_HANDLER=True\n"
 
+                # Tuning for the parallel download of the project archive
+                if self.stage_config.get('slim_handler_chunk_size'):
+                    settings_s += "ARCHIVE_CHUNK_SIZE={0!s}\n".format(
+                        int(self.stage_config['slim_handler_chunk_size']))
+                if self.stage_config.get('slim_handler_download_concurrency'):
+                    settings_s += "ARCHIVE_DOWNLOAD_CONCURRENCY={0!s}\n".format(
+                        int(self.stage_config['slim_handler_download_concurrency']))
+
                 include = self.stage_config.get('include', [])
                 if len(include) >= 1:
                     settings_s += "INCLUDE=" + str(include) + '\n'
@@ -2389,6 +2576,21 @@ class ZappaCLI:
                     event_mapping[arn] = function
             settings_s = settings_s + "AWS_EVENT_MAPPING={0!s}\n".format(event_mapping)
 
+            # Route and process event records one at a time,
+            # reporting partial batch failures
+            if self.stage_config.get('per_record_processing', False):
+                settings_s += "PER_RECORD_PROCESSING=True\n"
+                settings_s += "PER_RECORD_MAX_WORKERS={0!s}\n".format(
+                    self.stage_config.get('per_record_max_workers', 8))
+
+            # Scheduled functions, so the handler can resolve them up front
+            scheduled_functions = []
+            for event in events:
+                function = event.get('function')
+                if function and (event.get('expression') or event.get('expressions')):
+                    scheduled_functions.append(function)
+            settings_s = settings_s + "SCHEDULED_FUNCTIONS={0!s}\n".format(scheduled_functions)
+
             # Map Lext bot events
             bot_events = self.stage_config.get('bot_events', [])
             bot_events_mapping = {}
@@ -2429,6 +2631,37 @@ class ZappaCLI:
             async_response_table = self.stage_config.get('async_response_table', '')
             settings_s += "ASYNC_RESPONSE_TABLE='{0!s}'\n".format(async_response_table)
 
+            # Write large async task payloads to S3
+            async_payload_bucket = self.stage_config.get('async_payload_bucket')
+            if async_payload_bucket:
+                settings_s += "ASYNC_PAYLOAD_BUCKET='{0!s}'\n".format(async_payload_bucket)
+                settings_s += "ASYNC_PAYLOAD_THRESHOLD={0:d}\n".format(
+                    int(self.stage_config.get('async_payload_threshold', 100000)))
+
+            # Send async tasks from a pool of background threads
+            async_sender_threads = self.stage_config.get('async_sender_threads', 0)
+            if async_sender_threads:
+                settings_s += "ASYNC_SENDER_THREADS={0:d}\n".format(int(async_sender_threads))
+                settings_s += "ASYNC_SENDER_QUEUE_SIZE={0:d}\n".format(
+                    int(self.stage_config.get('async_sender_queue_size', 100)))
+
+            # Log the modules each invocation imports, to find what to preload
+            if self.stage_config.get('import_trace', False):
+                settings_s += "IMPORT_TRACE=True\n"
+
+            # Modules to import at init, or to import lazily
+            preload_manifest = self.create_preload_manifest()
+            if preload_manifest:
+                manifest_info = zipfile.ZipInfo(PRELOAD_MANIFEST, time.localtime()[:6])
+                manifest_info.external_attr = 0o644 << 16
+                lambda_zip.writestr(manifest_info, json.dumpsJSON(preload_manifest, indent=4))
+
+            # Replace the runtime's client with the streaming runtime
+            if self.response_streaming:
+                wrapper_info = zipfile.ZipInfo(EXEC_WRAPPER, time.localtime()[:6])
+                wrapper_info.external_attr = 0o755 << 16
+                lambda_zip.writestr(wrapper_info, EXEC_WRAPPER_SCRIPT)
+
             # Lambda requires a specific chmod
             temp_settings = tempfile.NamedTemporaryFile(delete=False)
             os.chmod(temp_settings.name, 0o644)
@@ -2437,6 +2670,54 @@ class ZappaCLI:
             lambda_zip.write(temp_settings.name, 'zappa_settings.py')
             os.unlink(temp_settings.name)
 
+    def create_preload_manifest(self):
+        """
+        Return the preload manifest for the handler. With preload_trace, the
+        app's imports are timed by importing it in a subprocess, and the
+        slowest are preloaded along with the preload_modules.
+        """
+        preload = self.stage_config.get('preload_modules', [])
+        defer = self.stage_config.get('defer_modules', [])
+        trace = self.stage_config.get('preload_trace', False)
+        if not preload and not defer and not trace:
+            return None
+
+        if self.app_function:
+            modules = [self.app_function.rsplit('.', 1)[0]]
+        elif self.django_settings:
+            modules = ['django', self.django_settings]
+        else:
+            modules = []
+
+        records = []
+        if trace and modules:
+            try:
+                records = trace_imports(modules, cwd=os.getcwd())
+            except Exception as e:
+                click.echo(click.style("Warning!", fg="red", bold=True) + " Couldn't time your imports: " + str(e))
+
+        if records:
+            click.echo("Slowest imports:\n" + format_report(records, limit=10))
+        return build_manifest(
+            records,
+            preload=preload,
+            defer=defer,
+            threshold_ms=self.stage_config.get('preload_threshold_ms', 0),
+            limit=self.stage_config.get('preload_limit', PRELOAD_LIMIT),
+            # The app itself is imported anyway.
+            exclude=[module.split('.')[0] for module in modules]
+        )
+
+    def get_current_project_archive_name(self):
+        """
+        The name of the project archive on S3 which the slim handler loads.
+        """
+        if self.stage_config.get('slim_handler_lazy_load', False):
+            extension = 'zip'
+        else:
+            extension = 'tar.gz'
+        return '{0!s}_{1!s}_current_project.{2!s}'.format(self.api_stage, self.project_name, extension)
+
     def remove_local_zip(self):
         """
         Remove our local zip file.
@@ -0,0 +1,81 @@
+"""
+Shared boto3 clients for the Lambda runtime.
+
+Importing boto3 and creating its clients adds hundreds of milliseconds to a
+cold start, so boto3 is imported and clients are created on first use rather
+than at import, and then shared by the handler and async tasks for the life
+of the container. Their connection pools are sized for concurrent use from
+threads, and, where botocore supports it, TCP keep-alive is enabled so that
+idle pooled connections survive between invocations. The account id is
+memoized too.
+
+boto3 clients are thread-safe; sessions aren't, so the session is only used
+under a lock.
+"""
+import threading
+
+import botocore.config
+
+CLIENT_MAX_POOL_CONNECTIONS = 50
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_account_id = None
+
+
+def get_client_config():
+    options = {'max_pool_connections': CLIENT_MAX_POOL_CONNECTIONS}
+    # Only in newer botocore versions, like the runtime's.
+    if 'tcp_keepalive' in botocore.config.Config.OPTION_DEFAULTS:
+        options['tcp_keepalive'] = True
+    return botocore.config.Config(**options)
+
+
+def get_session():
+    """
+    Return the shared session, creating it on first use.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            import boto3
+            _session = boto3.Session()
+        return _session
+
+
+def get_client(service_name, region_name=None):
+    """
+    Return the shared client of a service, creating it on first use.
+    """
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is None:
+        session = get_session()
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = session.client(service_name, region_name=region_name, config=get_client_config())
+                _clients[key] = client
+    return client
+
+
+def get_account_id():
+    """
+    Return the id of the account the function runs in, asking STS once per container.
+    """
+    global _account_id
+    if _account_id is None:
+        _account_id = get_client('sts').get_caller_identity()['Account']
+    return _account_id
+
+
+def reset():
+    """
+    Forget the shared session, clients and account id.
+    """
+    global _session, _account_id
+    with _lock:
+        _session = None
+        _clients.clear()
+        _account_id = None
@@ -32,12 +32,13 @@ import boto3
 import botocore
 import troposphere
 import troposphere.apigateway
+import troposphere.apigatewayv2
 from botocore.exceptions import ClientError
 from tqdm import tqdm
 
 from .utilities import (add_event_source, conflicts_with_a_neighbouring_module,
                         contains_python_files_or_subdirs, copytree,
-                        get_topic_name, get_venv_from_python_version,
+                        get_queue_name, get_topic_name, get_venv_from_python_version,
                         human_size, remove_event_source)
 
 
@@ -208,6 +209,10 @@ ZIP_EXCLUDES = [
 # See: https://github.com/Miserlou/Zappa/pull/1730
 ALB_LAMBDA_ALIAS = 'current-alb-version'
 
+# The lifecycle rules expiring large async payloads, and offloaded bodies
+ASYNC_PAYLOAD_RULE_ID = 'zappa-async-payloads'
+OFFLOAD_RULE_ID = 'zappa-offload'
+
 ##
 # Classes
 ##
@@ -320,6 +325,7 @@ class Zappa:
             self.cloudwatch = self.boto_client('cloudwatch')
             self.route53 = self.boto_client('route53')
             self.sns_client = self.boto_client('sns')
+            self.sqs_client = self.boto_client('sqs')
             self.cf_client = self.boto_client('cloudformation')
             self.dynamodb_client = self.boto_client('dynamodb')
             self.cognito_client = self.boto_client('cognito-idp')
@@ -486,8 +492,8 @@ class Zappa:
 
         """
         # Validate archive_format
-        if archive_format not in ['zip', 'tarball']:
-            raise KeyError("The archive format to create a lambda package must be zip or tarball")
+        if archive_format not in ['zip', 'lazy_zip', 'tarball']:
+            raise KeyError("The archive format to create a lambda package must be zip, lazy_zip or tarball")
 
         # Pip is a weird package.
         # Calling this function in some environments without this can cause.. funkiness.
@@ -499,7 +505,7 @@ class Zappa:
         build_time = str(int(time.time()))
         cwd = os.getcwd()
         if not output:
-            if archive_format == 'zip':
+            if archive_format in ['zip', 'lazy_zip']:
                 archive_fname = prefix + '-' + build_time + '.zip'
             elif archive_format == 'tarball':
                 archive_fname = prefix + '-' + build_time + '.tar.gz'
@@ -680,6 +686,13 @@ class Zappa:
                 compression_method = zipfile.ZIP_STORED
             archivef = zipfile.ZipFile(archive_path, 'w', compression_method)
 
+        elif archive_format == 'lazy_zip':
+            # Mounted by the slim handler, which imports or copies out
+            # only the modules which are actually imported.
+            print("Packaging project as lazily loaded zip.")
+            compression_method = zipfile.ZIP_DEFLATED
+            archivef = zipfile.ZipFile(archive_path, 'w', compression_method)
+
         elif archive_format == 'tarball':
             print("Packaging project as gzipped tarball.")
             archivef = tarfile.open(archive_path, 'w|gz')
@@ -715,7 +728,7 @@ class Zappa:
                 # Related: https://github.com/Miserlou/Zappa/issues/682
                 os.chmod(os.path.join(root, filename),  0o755)
 
-                if archive_format == 'zip':
+                if archive_format in ['zip', 'lazy_zip']:
                     # Actually put the file into the proper place in the zip
                     # Related: https://github.com/Miserlou/Zappa/pull/716
                     zipi = zipfile.ZipInfo(os.path.join(root.replace(temp_project_path, '').lstrip(os.sep), filename))
@@ -747,7 +760,7 @@ class Zappa:
 
                     arcname = os.path.join(root.replace(temp_project_path, ''),
                                            os.path.join(root.replace(temp_project_path, ''), '__init__.py'))
-                    if archive_format == 'zip':
+                    if archive_format in ['zip', 'lazy_zip']:
                         archivef.write(tmp_init, arcname)
                     elif archive_format == 'tarball':
                         archivef.add(tmp_init, arcname)
@@ -1523,6 +1536,44 @@ class Zappa:
                 raise e
 
 
+    ##
+    # Function URLs
+    ##
+
+    def deploy_function_url(self, lambda_name, invoke_mode='BUFFERED', auth_type='NONE'):
+        """
+        Create or update the function's URL, returning it.
+
+        The RESPONSE_STREAM invoke mode streams the function's responses.
+        A public URL also needs a permission allowing anyone to invoke it.
+        """
+        kwargs = dict(
+            FunctionName=lambda_name,
+            AuthType=auth_type,
+            InvokeMode=invoke_mode
+        )
+        try:
+            response = self.lambda_client.update_function_url_config(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "ResourceNotFoundException":
+                raise e
+            response = self.lambda_client.create_function_url_config(**kwargs)
+
+        if auth_type == 'NONE':
+            try:
+                self.lambda_client.add_permission(
+                    FunctionName=lambda_name,
+                    StatementId='FunctionURLAllowPublicAccess',
+                    Action='lambda:InvokeFunctionUrl',
+                    Principal='*',
+                    FunctionUrlAuthType='NONE'
+                )
+            except botocore.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] != "ResourceConflictException":
+                    raise e
+
+        return response['FunctionUrl']
+
     ##
     # API Gateway
     ##
@@ -1620,6 +1671,66 @@ class Zappa:
                                     )  # pragma: no cover
         return restapi
 
+    def create_http_api_routes(self,
+                               lambda_arn,
+                               stage_name,
+                               api_name=None,
+                               cors_options=None,
+                               description=None
+                               ):
+        """
+        Create an API Gateway HTTP API for this Zappa deployment, which sends
+        every route to the Lambda with the 2.0 payload format, and deploys
+        changes to the stage automatically.
+
+        Returns the new Api CF resource.
+        """
+        api = troposphere.apigatewayv2.Api('Api')
+        api.Name = api_name or lambda_arn.split(':')[-1]
+        api.Description = description or 'Created automatically by Zappa.'
+        api.ProtocolType = 'HTTP'
+        if cors_options:
+            if cors_options is True:
+                cors_options = {}
+            api.CorsConfiguration = troposphere.apigatewayv2.Cors(
+                AllowHeaders=cors_options.get('allowed_headers', ['Content-Type', 'X-Amz-Date', 'Authorization',
+                                                                  'X-Api-Key', 'X-Amz-Security-Token']),
+                AllowMethods=cors_options.get('allowed_methods', ['DELETE', 'GET', 'HEAD', 'OPTIONS',
+                                                                  'PATCH', 'POST', 'PUT']),
+                AllowOrigins=[cors_options.get('allowed_origin', '*')]
+            )
+        self.cf_template.add_resource(api)
+        self.cf_api_resources.append(api.title)
+
+        if not self.credentials_arn:
+            self.get_credentials_arn()
+
+        integration = troposphere.apigatewayv2.Integration('Integration')
+        integration.ApiId = troposphere.Ref(api)
+        integration.IntegrationType = 'AWS_PROXY'
+        integration.IntegrationUri = lambda_arn
+        integration.IntegrationMethod = 'POST'
+        integration.PayloadFormatVersion = '2.0'
+        integration.CredentialsArn = self.credentials_arn
+        self.cf_template.add_resource(integration)
+        self.cf_api_resources.append(integration.title)
+
+        route = troposphere.apigatewayv2.Route('DefaultRoute')
+        route.ApiId = troposphere.Ref(api)
+        route.RouteKey = '$default'
+        route.Target = troposphere.Join('/', ['integrations', troposphere.Ref(integration)])
+        self.cf_template.add_resource(route)
+        self.cf_api_resources.append(route.title)
+
+        stage = troposphere.apigatewayv2.Stage('Stage')
+        stage.ApiId = troposphere.Ref(api)
+        stage.StageName = stage_name
+        stage.AutoDeploy = True
+        self.cf_template.add_resource(stage)
+        self.cf_api_resources.append(stage.title)
+
+        return api
+
     def create_authorizer(self, restapi, uri, authorizer):
         """
         Create Authorizer for API gateway
@@ -2115,11 +2226,15 @@ class Zappa:
                                 authorizer,
                                 cors_options=None,
                                 description=None,
-                                endpoint_configuration=None
+                                endpoint_configuration=None,
+                                api_version='v1',
+                                stage_name=None
                             ):
         """
         Build the entire CF stack.
         Just used for the API Gateway, but could be expanded in the future.
+
+        With api_version 'v2', an HTTP API is created rather than a REST API.
         """
 
         auth_type = "NONE"
@@ -2139,6 +2254,20 @@ class Zappa:
         self.cf_api_resources = []
         self.cf_parameters = {}
 
+        if api_version == 'v2':
+            # Ignoring them would leave the API public.
+            if api_key_required or iam_authorization or authorizer:
+                raise EnvironmentError("API keys, IAM Authorization and Authorizers aren't supported for "
+                                       "HTTP APIs by Zappa. Use a REST API (v1).")
+            self.create_http_api_routes(
+                lambda_arn,
+                stage_name=stage_name,
+                api_name=lambda_name,
+                cors_options=cors_options,
+                description=description
+            )
+            return self.cf_template
+
         restapi = self.create_api_gateway_routes(
                                             lambda_arn,
                                             api_name=lambda_name,
@@ -2775,6 +2904,8 @@ class Zappa:
                     print("Created {} event schedule for {}!".format(svc, function))
                 elif rule_response == 'failed':
                     print("Problem creating {} event schedule for {}!".format(svc, function))
+                elif rule_response == 'updated':
+                    print("Updated {} event schedule for {}!".format(svc, function))
                 elif rule_response == 'exists':
                     print("{} event schedule for {} already exists - Nothing to do here.".format(svc, function))
                 elif rule_response == 'dryrun':
@@ -2954,6 +3085,110 @@ class Zappa:
                 removed_arns.append(sub['TopicArn'])
         return removed_arns
 
+    ###
+    # Async / SQS
+    ##
+
+    def create_async_sqs_queue(self, lambda_name, lambda_arn, batch_size=10, batching_window=0,
+                               visibility_timeout=None):
+        """
+        Create the SQS-based async queue, and the event source mapping which
+        runs its messages in batches, reporting failed ones in partial batch
+        responses so that only those are retried.
+        """
+        attributes = {}
+        if visibility_timeout:
+            # Should be well over the function's timeout, or messages are run twice.
+            attributes['VisibilityTimeout'] = str(int(visibility_timeout))
+        queue_url = self.sqs_client.create_queue(
+            QueueName=get_queue_name(lambda_name),
+            Attributes=attributes
+        )['QueueUrl']
+        queue_arn = self.sqs_client.get_queue_attributes(
+            QueueUrl=queue_url,
+            AttributeNames=['QueueArn']
+        )['Attributes']['QueueArn']
+
+        mapping = {
+            'BatchSize': batch_size,
+            'MaximumBatchingWindowInSeconds': batching_window,
+            'FunctionResponseTypes': ['ReportBatchItemFailures'],
+        }
+        mappings = self.lambda_client.list_event_source_mappings(
+            EventSourceArn=queue_arn,
+            FunctionName=lambda_arn
+        )['EventSourceMappings']
+        if mappings:
+            self.lambda_client.update_event_source_mapping(UUID=mappings[0]['UUID'], **mapping)
+        else:
+            self.lambda_client.create_event_source_mapping(
+                EventSourceArn=queue_arn,
+                FunctionName=lambda_arn,
+                Enabled=True,
+                **mapping
+            )
+        return queue_arn
+
+    def remove_async_sqs_queue(self, lambda_name):
+        """
+        Remove the async SQS queue, and its event source mappings.
+        """
+        try:
+            queue_url = self.sqs_client.get_queue_url(QueueName=get_queue_name(lambda_name))['QueueUrl']
+        except botocore.exceptions.ClientError:
+            return None
+        queue_arn = self.sqs_client.get_queue_attributes(
+            QueueUrl=queue_url,
+            AttributeNames=['QueueArn']
+        )['Attributes']['QueueArn']
+        for mapping in self.lambda_client.list_event_source_mappings(EventSourceArn=queue_arn)['EventSourceMappings']:
+            self.lambda_client.delete_event_source_mapping(UUID=mapping['UUID'])
+        self.sqs_client.delete_queue(QueueUrl=queue_url)
+        return queue_arn
+
+    ###
+    # Async / S3 payloads
+    ##
+
+    def add_async_payload_expiration(self, bucket_name, days, prefix='zappa-async/'):
+        """
+        Expire the large async payloads written under the prefix of the bucket
+        after a number of days, keeping the bucket's other lifecycle rules.
+        """
+        self.add_bucket_expiration(bucket_name, ASYNC_PAYLOAD_RULE_ID, prefix, days)
+
+    def add_offload_expiration(self, bucket_name, days, prefix='zappa-offload/'):
+        """
+        Expire the offloaded response and request bodies written under the
+        prefix of the bucket after a number of days, keeping the bucket's
+        other lifecycle rules.
+        """
+        self.add_bucket_expiration(bucket_name, OFFLOAD_RULE_ID, prefix, days)
+
+    def add_bucket_expiration(self, bucket_name, rule_id, prefix, days):
+        """
+        Add or replace the lifecycle rule rule_id of the bucket, which expires
+        the objects under the prefix after a number of days.
+        """
+        try:
+            rules = self.s3_client.get_bucket_lifecycle_configuration(Bucket=bucket_name)['Rules']
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchLifecycleConfiguration':
+                raise
+            rules = []
+
+        rules = [rule for rule in rules if rule.get('ID') != rule_id]
+        rules.append({
+            'ID': rule_id,
+            'Filter': {'Prefix': prefix},
+            'Status': 'Enabled',
+            'Expiration': {'Days': days},
+        })
+        self.s3_client.put_bucket_lifecycle_configuration(
+            Bucket=bucket_name,
+            LifecycleConfiguration={'Rules': rules}
+        )
+
 
     ###
     # Async / DynamoDB
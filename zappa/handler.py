@@ -1,6 +1,6 @@
-import base64
-import boto3
+import botocore
 import collections
+import concurrent.futures
 import datetime
 import importlib
 import inspect
@@ -8,21 +8,39 @@ import json
 import logging
 import os
 import sys
+import threading
+import time
 import traceback
-import tarfile
 
 from builtins import str
-from werkzeug.wrappers import Response
 
 # This file may be copied into a project's root,
 # so handle both scenarios.
 try:
-    from zappa.middleware import ZappaWSGIMiddleware
-    from zappa.wsgi import create_wsgi_request, common_log
+    from zappa.access_log import AccessLogger
+    from zappa.archive import load_project_archive, ARCHIVE_CHUNK_SIZE, ARCHIVE_DOWNLOAD_CONCURRENCY
+    from zappa.asgi import ASGIAdapter
+    from zappa.clients import get_client
+    from zappa.metrics import MetricsRecorder
+    from zappa.middleware import ResponseCacheMiddleware, ZappaWSGIMiddleware
+    from zappa.offload import OffloadError, S3Offloader
+    from zappa.preload import PRELOAD_MANIFEST, get_new_modules, install_deferred_imports, load_manifest, preload_modules
+    from zappa.streaming import STREAMING_CONTENT_TYPE, create_prelude
+    from zappa.wsgi import create_wsgi_request, compress_response, create_lambda_response, \
+        is_base64_response, is_function_url_event, is_payload_v2, run_wsgi_app, stream_wsgi_app
     from zappa.utilities import merge_headers, parse_s3_url
 except ImportError as e:  # pragma: no cover
-    from .middleware import ZappaWSGIMiddleware
-    from .wsgi import create_wsgi_request, common_log
+    from .access_log import AccessLogger
+    from .archive import load_project_archive, ARCHIVE_CHUNK_SIZE, ARCHIVE_DOWNLOAD_CONCURRENCY
+    from .asgi import ASGIAdapter
+    from .clients import get_client
+    from .metrics import MetricsRecorder
+    from .middleware import ResponseCacheMiddleware, ZappaWSGIMiddleware
+    from .offload import OffloadError, S3Offloader
+    from .preload import PRELOAD_MANIFEST, get_new_modules, install_deferred_imports, load_manifest, preload_modules
+    from .streaming import STREAMING_CONTENT_TYPE, create_prelude
+    from .wsgi import create_wsgi_request, compress_response, create_lambda_response, \
+        is_base64_response, is_function_url_event, is_payload_v2, run_wsgi_app, stream_wsgi_app
     from .utilities import merge_headers, parse_s3_url
 
 
@@ -31,6 +49,16 @@ logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+INVALID_SIGNATURE_MESSAGE = ("Function signature is invalid. Expected a function that accepts at most "
+                             "2 arguments or varargs.")
+
+
+class RecordProcessingError(Exception):
+    """
+    A batch of records failed, after the exception handler was called for
+    the failed record, so that it isn't called again for the whole event.
+    """
+
 
 class LambdaHandler:
     """
@@ -47,8 +75,35 @@ class LambdaHandler:
     # Application
     app_module = None
     wsgi_app = None
+    asgi_app = None
+    response_cache = None
+    offloader = None
     trailing_slash = False
 
+    # Remote config files, with their ETags and parsed contents
+    remote_env_sources = None
+    remote_env_client = None
+    remote_env_etags = None
+    remote_settings = None
+    remote_env_keys = set()
+    remote_env_loaded_at = None
+    remote_env_refresh_thread = None
+
+    # Per-phase timings of the last project archive load
+    archive_timings = None
+
+    # Timings of the init and request phases
+    metrics = None
+
+    # The preload manifest packaged with the handler, and the modules
+    # imported by the end of init. See zappa.preload.
+    preload_manifest = None
+    known_modules = None
+
+    # Event functions resolved once per container,
+    # keyed by modular path. See get_routed_function.
+    routing_table = None
+
     def __new__(cls, settings_name="zappa_settings", session=None):
         """Singleton instance to avoid repeat setup"""
         if LambdaHandler.__instance is None:
@@ -60,6 +115,10 @@ class LambdaHandler:
 
         # We haven't cached our settings yet, load the settings and app.
         if not self.settings:
+            # Time the init phases, until the settings say whether to
+            self.metrics = MetricsRecorder()
+            self.metrics.start()
+
             # Loading settings from a python module
             self.settings = importlib.import_module(settings_name)
             self.settings_name = settings_name
@@ -70,11 +129,28 @@ class LambdaHandler:
                 level = logging.getLevelName(self.settings.LOG_LEVEL)
                 logger.setLevel(level)
 
-            remote_env = getattr(self.settings, 'REMOTE_ENV', None)
-            remote_bucket, remote_file = parse_s3_url(remote_env)
+            self.metrics.lap('init.settings')
+            self.metrics.enabled = getattr(self.settings, 'METRICS', False)
+            self.metrics.namespace = getattr(self.settings, 'METRICS_NAMESPACE', self.metrics.namespace)
+            self.access_logger = AccessLogger(
+                format=getattr(self.settings, 'ACCESS_LOG_FORMAT', 'common'),
+                sample_rates=getattr(self.settings, 'ACCESS_LOG_SAMPLE_RATES', None)
+            )
 
-            if remote_bucket and remote_file:
-                self.load_remote_settings(remote_bucket, remote_file)
+            # Several remote config files can be given, merged in order
+            remote_env = getattr(self.settings, 'REMOTE_ENV', None)
+            if not isinstance(remote_env, (list, tuple)):
+                remote_env = [remote_env]
+            self.remote_env_sources = []
+            self.remote_settings = {}
+            self.remote_env_etags = {}
+            for remote_url in remote_env:
+                remote_bucket, remote_file = parse_s3_url(remote_url)
+                if remote_bucket and remote_file:
+                    self.remote_env_sources.append((remote_bucket, remote_file))
+                    self.load_remote_settings(remote_bucket, remote_file)
+            self.remote_env_loaded_at = time.time()
+            self.metrics.lap('init.remote_settings')
 
             # Let the system know that this will be a Lambda/Zappa/Stack
             os.environ["SERVERTYPE"] = "AWS Lambda"
@@ -95,7 +171,7 @@ class LambdaHandler:
             project_archive_path = getattr(self.settings, 'ARCHIVE_PATH', None)
             if project_archive_path:
                 self.load_remote_project_archive(project_archive_path)
-
+            self.metrics.lap('init.project_archive')
 
             # Load compiled library to the PythonPath
             # checks if we are the slim_handler since this is not needed otherwise
@@ -112,6 +188,14 @@ class LambdaHandler:
                             print("Failed to find library: {}...right filename?".format(library))
                 except ImportError:
                     print ("Failed to import cytpes library")
+            self.metrics.lap('init.libraries')
+
+            # Import the modules the app imports on its first requests, and defer
+            # those it rarely uses, as measured when the package was built.
+            self.preload_manifest = load_manifest(
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), PRELOAD_MANIFEST))
+            if self.preload_manifest and self.preload_manifest.get('defer'):
+                install_deferred_imports(self.preload_manifest['defer'])
 
             # This is a non-WSGI application
             # https://github.com/Miserlou/Zappa/pull/748
@@ -146,27 +230,69 @@ class LambdaHandler:
                 wsgi_app_function = get_django_wsgi(self.settings.DJANGO_SETTINGS)
                 self.trailing_slash = True
 
-            self.wsgi_app = ZappaWSGIMiddleware(wsgi_app_function)
+            # ASGI apps run on an event loop kept for the life of the container.
+            if getattr(self.settings, 'ASGI', False) and wsgi_app_function:
+                self.asgi_app = ASGIAdapter(wsgi_app_function, lifespan=getattr(self.settings, 'ASGI_LIFESPAN', True))
+            else:
+                self.wsgi_app = ZappaWSGIMiddleware(wsgi_app_function)
+            self.metrics.lap('init.app')
+
+            if self.preload_manifest and self.preload_manifest.get('preload'):
+                preload_modules(self.preload_manifest['preload'])
+                self.metrics.lap('init.preload')
+
+            # Serve repeat GET and HEAD requests from this container's memory.
+            if getattr(self.settings, 'RESPONSE_CACHE', False) and wsgi_app_function and not self.asgi_app:
+                self.response_cache = ResponseCacheMiddleware(
+                    self.wsgi_app,
+                    max_entries=self.settings.RESPONSE_CACHE_MAX_ENTRIES,
+                    max_bytes=self.settings.RESPONSE_CACHE_MAX_BYTES,
+                    key_headers=self.settings.RESPONSE_CACHE_KEY_HEADERS
+                )
+                self.wsgi_app = self.response_cache
+
+            # Offload request and response bodies too large for Lambda to S3.
+            if getattr(self.settings, 'OFFLOAD_BUCKET', None):
+                self.offloader = S3Offloader(
+                    self.settings.OFFLOAD_BUCKET,
+                    prefix=self.settings.OFFLOAD_PREFIX,
+                    threshold=self.settings.OFFLOAD_THRESHOLD,
+                    expires_in=self.settings.OFFLOAD_EXPIRES_IN,
+                    status_code=self.settings.OFFLOAD_STATUS_CODE,
+                    envelope=self.settings.OFFLOAD_ENVELOPE,
+                    boto_session=self.session
+                )
+
+            # Resolve the configured event functions up front,
+            # rather than on every invocation.
+            self.routing_table = {}
+            self.build_routing_table()
+            self.metrics.lap('init.routing')
+            self.metrics.finish('init.total')
+
+            if getattr(self.settings, 'IMPORT_TRACE', False):
+                self.known_modules = set(sys.modules)
 
     def load_remote_project_archive(self, project_zip_path):
         """
         Puts the project files from S3 in /tmp and adds to path
         """
         project_folder = '/tmp/{0!s}'.format(self.settings.PROJECT_NAME)
-        if not os.path.isdir(project_folder):
-            # The project folder doesn't exist in this cold lambda, get it from S3
-            if not self.session:
-                boto_session = boto3.Session()
-            else:
-                boto_session = self.session
-
-            # Download zip file from S3
-            remote_bucket, remote_file = parse_s3_url(project_zip_path)
-            s3 = boto_session.resource('s3')
-            archive_on_s3 = s3.Object(remote_bucket, remote_file).get()
-
-            with tarfile.open(fileobj=archive_on_s3['Body'], mode="r|gz") as t:
-                t.extractall(project_folder)
+        s3_client = self.session.client('s3') if self.session else get_client('s3')
+
+        # Download and extract the archive from S3, unless this
+        # container already holds the same build.
+        # A zip (lazy_zip) is mounted rather than extracted.
+        remote_bucket, remote_file = parse_s3_url(project_zip_path)
+        self.archive_timings = load_project_archive(
+            s3_client,
+            remote_bucket,
+            remote_file,
+            project_folder,
+            lazy=remote_file.endswith('.zip'),
+            chunk_size=getattr(self.settings, 'ARCHIVE_CHUNK_SIZE', ARCHIVE_CHUNK_SIZE),
+            concurrency=getattr(self.settings, 'ARCHIVE_DOWNLOAD_CONCURRENCY', ARCHIVE_DOWNLOAD_CONCURRENCY)
+        )
 
         # Add to project path
         sys.path.insert(0, project_folder)
@@ -182,35 +308,78 @@ class LambdaHandler:
         key->value pair as environment variables. Helpful for keeping
         sensitiZve or stage-specific configuration variables in s3 instead of
         version control.
+
+        The file's ETag is kept, so that reloading an unchanged file
+        only costs a 304 response.
         """
-        if not self.session:
-            boto_session = boto3.Session()
-        else:
-            boto_session = self.session
+        settings_dict = self.fetch_remote_settings(remote_bucket, remote_file)
+        if settings_dict is None:
+            return
+
+        self.remote_settings[(remote_bucket, remote_file)] = settings_dict
+        self.apply_remote_settings()
+
+    def fetch_remote_settings(self, remote_bucket, remote_file):
+        """
+        Fetch and parse a remote config file, returning None if it is
+        unchanged since the last fetch, or can't be loaded.
+        """
+        if self.remote_env_client is None:
+            self.remote_env_client = self.session.client('s3') if self.session else get_client('s3')
+
+        kwargs = {'Bucket': remote_bucket, 'Key': remote_file}
+        etag = self.remote_env_etags.get((remote_bucket, remote_file))
+        if etag:
+            kwargs['IfNoneMatch'] = etag
 
-        s3 = boto_session.resource('s3')
         try:
-            remote_env_object = s3.Object(remote_bucket, remote_file).get()
+            remote_env_object = self.remote_env_client.get_object(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ['304', 'NotModified']:
+                return None
+            print('Could not load remote settings file.', e)
+            return None
         except Exception as e:  # pragma: no cover
             # catch everything aws might decide to raise
             print('Could not load remote settings file.', e)
-            return
+            return None
 
         try:
             content = remote_env_object['Body'].read()
         except Exception as e:  # pragma: no cover
             # catch everything aws might decide to raise
             print('Exception while reading remote settings file.', e)
-            return
+            return None
 
         try:
             settings_dict = json.loads(content)
         except (ValueError, TypeError):  # pragma: no cover
             print('Failed to parse remote settings!')
-            return
+            return None
+
+        if remote_env_object.get('ETag'):
+            self.remote_env_etags[(remote_bucket, remote_file)] = remote_env_object['ETag']
+        return settings_dict
+
+    def apply_remote_settings(self):
+        """
+        Merge the remote config files in order, later files taking precedence,
+        and set them as environment variables, unsetting any variables which
+        the files no longer have.
+        """
+        merged = {}
+        for source in self.remote_env_sources:
+            merged.update(self.remote_settings.get(source, {}))
+
+        # Locally defined env vars take precedence
+        for key in getattr(self.settings, 'ENVIRONMENT_VARIABLES', {}):
+            merged.pop(key, None)
+
+        for key in self.remote_env_keys - set(merged):
+            os.environ.pop(key, None)
 
         # add each key-value to environment - overwrites existing keys!
-        for key, value in settings_dict.items():
+        for key, value in merged.items():
             if self.settings.LOG_LEVEL == "DEBUG":
                 print('Adding {} -> {} to environment'.format(
                     key,
@@ -223,6 +392,28 @@ class LambdaHandler:
             except Exception:
                 if self.settings.LOG_LEVEL == "DEBUG":
                     print("Environment variable keys must be non-unicode!")
+        self.remote_env_keys = set(str(key) for key in merged)
+
+    def refresh_remote_settings(self):
+        """
+        Once the remote config is older than REMOTE_ENV_TTL, reload it in a
+        background thread, so that requests are never held up by S3.
+        """
+        ttl = getattr(self.settings, 'REMOTE_ENV_TTL', None)
+        if not ttl or not self.remote_env_sources or time.time() - self.remote_env_loaded_at < ttl:
+            return False
+        if self.remote_env_refresh_thread and self.remote_env_refresh_thread.is_alive():
+            return False
+
+        def refresh():
+            for remote_bucket, remote_file in self.remote_env_sources:
+                self.load_remote_settings(remote_bucket, remote_file)
+            self.remote_env_loaded_at = time.time()
+
+        self.remote_env_refresh_thread = threading.Thread(target=refresh)
+        self.remote_env_refresh_thread.daemon = True
+        self.remote_env_refresh_thread.start()
+        return True
 
     @staticmethod
     def import_module_and_get_function(whole_function):
@@ -235,26 +426,117 @@ class LambdaHandler:
         app_function = getattr(app_module, function)
         return app_function
 
+    def build_routing_table(self):
+        """
+        Resolve every function named in the settings, along with its
+        call signature, so that event invocations don't have to import
+        and inspect it again.
+
+        A function which can't be resolved here is left out, and will be
+        resolved (and raise) on first use instead.
+        """
+        function_paths = set()
+        for mapping_name in ['AWS_EVENT_MAPPING', 'AWS_BOT_EVENT_MAPPING', 'COGNITO_TRIGGER_MAPPING']:
+            function_paths.update((getattr(self.settings, mapping_name, None) or {}).values())
+        for setting_name in ['AUTHORIZER_FUNCTION', 'EXCEPTION_HANDLER']:
+            function_paths.add(getattr(self.settings, setting_name, None))
+        function_paths.update(getattr(self.settings, 'SCHEDULED_FUNCTIONS', None) or [])
+
+        for whole_function in function_paths:
+            if not whole_function or '.' not in whole_function:
+                continue
+            try:
+                self.get_routed_function(whole_function)
+            except Exception as e:
+                logger.warning('Could not resolve function {}: {}'.format(whole_function, e))
+
+        return self.routing_table
+
+    def get_routed_function(self, whole_function):
+        """
+        Given a modular path to a function, return the function and the
+        number of arguments to call it with, importing and inspecting it
+        only the first time it is seen in this container.
+        """
+        route = self.routing_table.get(whole_function)
+        if route is None:
+            app_function = self.import_module_and_get_function(whole_function)
+            try:
+                arity = self.get_function_arity(app_function)
+            except (RuntimeError, TypeError):
+                # Not an event function, e.g. the exception handler.
+                arity = None
+            route = (app_function, arity)
+            self.routing_table[whole_function] = route
+        return route
+
+    def run_routed_function(self, whole_function, event, context):
+        """
+        Given a modular path to a function and event context,
+        execute it through the routing table, returning any result.
+        """
+        app_function, arity = self.get_routed_function(whole_function)
+        return self.call_function(app_function, arity, event, context)
+
     @classmethod
     def lambda_handler(cls, event, context):  # pragma: no cover
         handler = cls()
         exception_handler = handler.settings.EXCEPTION_HANDLER
         try:
             return handler.handler(event, context)
+        except RecordProcessingError:
+            raise
         except Exception as ex:
-            exception_processed = cls._process_exception(exception_handler=exception_handler,
-                                                         event=event, context=context, exception=ex)
+            exception_processed = handler._process_exception(exception_handler=exception_handler,
+                                                             event=event, context=context, exception=ex)
             if not exception_processed:
                 # Only re-raise exception if handler directed so. Allows handler to control if lambda has to retry
                 # an event execution in case of failure.
                 raise
+        finally:
+            handler.finish_invocation()
 
     @classmethod
-    def _process_exception(cls, exception_handler, event, context, exception):
+    def lambda_handler_stream(cls, event, context):  # pragma: no cover
+        """
+        The entry point of the streaming runtime: returns the content type
+        of the response, and an iterator over its chunks.
+        """
+        return cls().stream(event, context)
+
+    def finish_invocation(self):
+        """
+        Send the invocation's pending async tasks, write its access log and
+        metrics (with its response cache counts), and log the modules it imported.
+        """
+        # Only if the app uses async tasks, so that the others don't import it.
+        asynchronous = sys.modules.get('zappa.asynchronous')
+        if asynchronous is not None:
+            asynchronous.flush()
+        self.access_logger.flush()
+        if self.response_cache is not None:
+            for name, count in self.response_cache.take_stats().items():
+                self.metrics.count('response_cache.' + name, count)
+        self.metrics.flush()
+        if self.known_modules is not None:
+            self.log_new_imports()
+
+    def log_new_imports(self):
+        """
+        Log the modules imported since init or the last invocation,
+        which are candidates for the preload_modules setting.
+        """
+        new_modules = get_new_modules(self.known_modules)
+        if new_modules:
+            print(json.dumps({'zappa_new_imports': new_modules}))
+            self.known_modules.update(sys.modules)
+        return new_modules
+
+    def _process_exception(self, exception_handler, event, context, exception):
         exception_processed = False
         if exception_handler:
             try:
-                handler_function = cls.import_module_and_get_function(exception_handler)
+                handler_function, _ = self.get_routed_function(exception_handler)
                 exception_processed = handler_function(exception, event, context)
             except Exception as cex:
                 logger.error(msg='Failed to process exception via custom handler.')
@@ -262,28 +544,43 @@ class LambdaHandler:
         return exception_processed
 
     @staticmethod
-    def run_function(app_function, event, context):
+    def get_function_arity(app_function):
         """
-        Given a function and event context,
-        detect signature and execute, returning any result.
+        Given a function, detect its signature and return
+        how many of (event, context) it should be called with.
         """
         # getargspec does not support python 3 method with type hints
         # Related issue: https://github.com/Miserlou/Zappa/issues/1452
-        if hasattr(inspect, "getfullargspec"):  # Python 3
-            args, varargs, keywords, defaults, _, _, _ = inspect.getfullargspec(app_function)
-        else:  # Python 2
-            args, varargs, keywords, defaults = inspect.getargspec(app_function)
+        args, varargs, keywords, defaults, _, _, _ = inspect.getfullargspec(app_function)
         num_args = len(args)
-        if num_args == 0:
-            result = app_function(event, context) if varargs else app_function()
-        elif num_args == 1:
-            result = app_function(event, context) if varargs else app_function(event)
-        elif num_args == 2:
-            result = app_function(event, context)
-        else:
-            raise RuntimeError("Function signature is invalid. Expected a function that accepts at most "
-                               "2 arguments or varargs.")
-        return result
+        if num_args > 2:
+            raise RuntimeError(INVALID_SIGNATURE_MESSAGE)
+        if varargs:
+            return 2
+        return num_args
+
+    @staticmethod
+    def call_function(app_function, arity, event, context):
+        """
+        Given a function, its arity and event context,
+        execute it, returning any result.
+        """
+        if arity is None:
+            raise RuntimeError(INVALID_SIGNATURE_MESSAGE)
+        if arity == 2:
+            return app_function(event, context)
+        elif arity == 1:
+            return app_function(event)
+        return app_function()
+
+    @staticmethod
+    def run_function(app_function, event, context):
+        """
+        Given a function and event context,
+        detect signature and execute, returning any result.
+        """
+        arity = LambdaHandler.get_function_arity(app_function)
+        return LambdaHandler.call_function(app_function, arity, event, context)
 
     def get_function_for_aws_event(self, record):
         """
@@ -307,6 +604,10 @@ class LambdaHandler:
         elif 'dynamodb' in record or 'kinesis' in record:
             arn = record.get('eventSourceARN')
         elif 'eventSource' in record and record.get('eventSource') == 'aws:sqs':
+            # Async tasks are marked, so that their queue needn't be mapped.
+            command = record.get('messageAttributes', {}).get('zappa_command', {}).get('stringValue')
+            if command == 'zappa.asynchronous.route_sqs_task':
+                return command
             arn = record.get('eventSourceARN')
         elif 's3' in record:
             arn = record['s3']['bucket']['arn']
@@ -316,6 +617,99 @@ class LambdaHandler:
 
         return None
 
+    @staticmethod
+    def get_record_identifier(record):
+        """
+        Get the identifier Lambda expects in a partial batch response for
+        this record, or None if its event source doesn't support one.
+        """
+        if record.get('eventSource') == 'aws:sqs':
+            return record.get('messageId')
+        elif 'kinesis' in record:
+            return record['kinesis'].get('sequenceNumber')
+        elif 'dynamodb' in record:
+            return record['dynamodb'].get('SequenceNumber')
+        return None
+
+    @staticmethod
+    def get_record_ordering_key(record):
+        """
+        Get the key within which records must be processed in order:
+        the partition key for Kinesis, the item key for DynamoDB streams
+        and the message group for FIFO SQS queues.
+
+        Returns None if the record can be processed independently.
+        """
+        if record.get('eventSource') == 'aws:sqs':
+            return record.get('attributes', {}).get('MessageGroupId')
+        elif 'kinesis' in record:
+            return record['kinesis'].get('partitionKey')
+        elif 'dynamodb' in record:
+            return json.dumps(record['dynamodb'].get('Keys'), sort_keys=True)
+        return None
+
+    def process_records(self, records, context):
+        """
+        Route each record to its own function, processing independent
+        records concurrently, and report the records which failed
+        as a partial batch response so that only those are retried.
+
+        Each function is called with an event holding only its record.
+        """
+        groups = collections.OrderedDict()
+        for index, record in enumerate(records):
+            ordering_key = self.get_record_ordering_key(record)
+            if ordering_key is None:
+                ordering_key = index
+            groups.setdefault(ordering_key, []).append(record)
+
+        max_workers = getattr(self.settings, 'PER_RECORD_MAX_WORKERS', 8)
+        if len(groups) > 1 and max_workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(groups))) as executor:
+                results = list(executor.map(lambda group: self.process_record_group(group, context),
+                                            groups.values()))
+        else:
+            results = [self.process_record_group(group, context) for group in groups.values()]
+
+        batch_item_failures = []
+        for failed_records, exception in results:
+            for record in failed_records:
+                identifier = self.get_record_identifier(record)
+                if identifier is None:
+                    # This event source can't retry single records,
+                    # so fail the whole batch like we used to.
+                    raise RecordProcessingError(str(exception)) from exception
+                batch_item_failures.append({'itemIdentifier': identifier})
+
+        return {'batchItemFailures': batch_item_failures}
+
+    def process_record_group(self, records, context):
+        """
+        Process an ordered group of records. Once a record fails, it and the
+        records after it are returned as failed, to keep them in order.
+
+        Returns a (failed_records, exception) tuple.
+        """
+        for index, record in enumerate(records):
+            whole_function = self.get_function_for_aws_event(record)
+            if not whole_function:
+                logger.error("Cannot find a function to process the triggered event.")
+                continue
+
+            event = {'Records': [record]}
+            try:
+                result = self.run_routed_function(whole_function, event, context)
+                logger.debug(result)
+            except Exception as e:
+                exception_handler = getattr(self.settings, 'EXCEPTION_HANDLER', None)
+                if self._process_exception(exception_handler=exception_handler,
+                                           event=event, context=context, exception=e):
+                    continue
+                logger.exception('Failed to process record with {}.'.format(whole_function))
+                return records[index:], e
+
+        return [], None
+
     def get_function_from_bot_intent_trigger(self, event):
         """
         For the given event build ARN and return the configured function
@@ -335,6 +729,111 @@ class LambdaHandler:
         print("get_function_for_cognito_trigger", self.settings.COGNITO_TRIGGER_MAPPING, trigger, self.settings.COGNITO_TRIGGER_MAPPING.get(trigger))
         return self.settings.COGNITO_TRIGGER_MAPPING.get(trigger)
 
+    def create_web_environ(self, event, context, is_v2=False):
+        """
+        Given an HTTP request event from a REST API, an ALB, an HTTP API or a
+        Function URL, create the WSGI environ of the request.
+
+        Returns the environ, and whether the request came from an ALB.
+        """
+        settings = self.settings
+        script_name = ''
+        is_elb_context = False
+        headers = merge_headers(event)
+        if event.get('requestContext', None) and event['requestContext'].get('elb', None):
+            # Related: https://github.com/Miserlou/Zappa/issues/1715
+            # inputs/outputs for lambda loadbalancer
+            # https://docs.aws.amazon.com/elasticloadbalancing/latest/application/lambda-functions.html
+            is_elb_context = True
+            # host is lower-case when forwarded from ELB
+            host = headers.get('host')
+            # TODO: pathParameters is a first-class citizen in apigateway but not available without
+            # some parsing work for ELB (is this parameter used for anything?)
+            event['pathParameters'] = ''
+        elif not is_v2:
+            if headers:
+                host = headers.get('Host')
+            else:
+                host = None
+            logger.debug('host found: [{}]'.format(host))
+
+            if host:
+                if 'amazonaws.com' in host:
+                    logger.debug('amazonaws found in host')
+                    # The path provided in th event doesn't include the
+                    # stage, so we must tell Flask to include the API
+                    # stage in the url it calculates. See https://github.com/Miserlou/Zappa/issues/1014
+                    script_name = '/' + settings.API_STAGE
+            else:
+                # This is a test request sent from the AWS console
+                if settings.DOMAIN:
+                    # Assume the requests received will be on the specified
+                    # domain. No special handling is required
+                    pass
+                else:
+                    # Assume the requests received will be to the
+                    # amazonaws.com endpoint, so tell Flask to include the
+                    # API stage
+                    script_name = '/' + settings.API_STAGE
+
+        base_path = getattr(settings, 'BASE_PATH', None)
+        self.metrics.lap('request.event_parse')
+
+        # Create the environment for WSGI and handle the request
+        environ = create_wsgi_request(
+            event,
+            script_name=script_name,
+            base_path=base_path,
+            trailing_slash=self.trailing_slash,
+            binary_support=settings.BINARY_SUPPORT,
+            context_header_mappings=settings.CONTEXT_HEADER_MAPPINGS,
+            headers=headers
+        )
+
+        # We are always on https on Lambda, so tell our wsgi app that.
+        environ['HTTPS'] = 'on'
+        environ['wsgi.url_scheme'] = 'https'
+        environ['lambda.context'] = context
+        environ['lambda.event'] = event
+
+        self.metrics.lap('request.create_wsgi_request')
+
+        return environ, is_elb_context
+
+    def get_error_response(self, event, context, exception):  # pragma: no cover
+        """
+        Return a 500 response for an exception raised while servicing a web request.
+        Must be called while the exception is being handled.
+        """
+        settings = self.settings
+
+        # Print statements are visible in the logs either way
+        print(exception)
+        exc_info = sys.exc_info()
+        message = ('An uncaught exception happened while servicing this request. '
+                   'You can investigate this with the `zappa tail` command.')
+
+        # If we didn't even build an app_module, just raise.
+        if not settings.DJANGO_SETTINGS:
+            try:
+                self.app_module
+            except NameError as ne:
+                message = 'Failed to import module: {}'.format(ne.message)
+
+        # Call exception handler for unhandled exceptions
+        exception_handler = self.settings.EXCEPTION_HANDLER
+        self._process_exception(exception_handler=exception_handler,
+                                event=event, context=context, exception=exception)
+
+        # Return this unspecified exception as a 500, using template that API Gateway expects.
+        content = collections.OrderedDict()
+        content['statusCode'] = 500
+        body = {'message': message}
+        if settings.DEBUG:  # only include traceback if debug is on.
+            body['traceback'] = traceback.format_exception(*exc_info)  # traceback as a list for readability.
+        content['body'] = json.dumps(str(body), sort_keys=True, indent=4)
+        return content
+
     def handler(self, event, context):
         """
         An AWS Lambda function which parses specific API Gateway input into a
@@ -343,11 +842,15 @@ class LambdaHandler:
 
         """
         settings = self.settings
+        self.metrics.start()
 
         # If in DEBUG mode, log all raw incoming events.
         if settings.DEBUG:
             logger.debug('Zappa Event: {}'.format(event))
 
+        # Reload stale remote config, without waiting for it
+        self.refresh_remote_settings()
+
         # Set any API Gateway defined Stage Variables
         # as env vars
         if event.get('stageVariables'):
@@ -362,10 +865,8 @@ class LambdaHandler:
 
             # This is a scheduled function.
             if '.' in whole_function:
-                app_function = self.import_module_and_get_function(whole_function)
-
                 # Execute the function!
-                return self.run_function(app_function, event, context)
+                return self.run_routed_function(whole_function, event, context)
 
             # Else, let this execute as it were.
 
@@ -373,8 +874,7 @@ class LambdaHandler:
         elif event.get('command', None):
 
             whole_function = event['command']
-            app_function = self.import_module_and_get_function(whole_function)
-            result = self.run_function(app_function, event, context)
+            result = self.run_routed_function(whole_function, event, context)
             print("Result of %s:" % whole_function)
             print(result)
             return result
@@ -412,11 +912,13 @@ class LambdaHandler:
         elif event.get('Records', None):
 
             records = event.get('Records')
+            if getattr(settings, 'PER_RECORD_PROCESSING', False):
+                return self.process_records(records, context)
+
             result = None
             whole_function = self.get_function_for_aws_event(records[0])
             if whole_function:
-                app_function = self.import_module_and_get_function(whole_function)
-                result = self.run_function(app_function, event, context)
+                result = self.run_routed_function(whole_function, event, context)
                 logger.debug(result)
             else:
                 logger.error("Cannot find a function to process the triggered event.")
@@ -427,8 +929,7 @@ class LambdaHandler:
             result = None
             whole_function = self.get_function_from_bot_intent_trigger(event)
             if whole_function:
-                app_function = self.import_module_and_get_function(whole_function)
-                result = self.run_function(app_function, event, context)
+                result = self.run_routed_function(whole_function, event, context)
                 logger.debug(result)
             else:
                 logger.error("Cannot find a function to process the triggered event.")
@@ -438,8 +939,7 @@ class LambdaHandler:
         elif event.get('type') == 'TOKEN':
             whole_function = self.settings.AUTHORIZER_FUNCTION
             if whole_function:
-                app_function = self.import_module_and_get_function(whole_function)
-                policy = self.run_function(app_function, event, context)
+                policy = self.run_routed_function(whole_function, event, context)
                 return policy
             else:
                 logger.error("Cannot find a function to process the authorization request.")
@@ -451,8 +951,7 @@ class LambdaHandler:
             whole_function = self.get_function_for_cognito_trigger(triggerSource)
             result = event
             if whole_function:
-                app_function = self.import_module_and_get_function(whole_function)
-                result = self.run_function(app_function, event, context)
+                result = self.run_routed_function(whole_function, event, context)
                 logger.debug(result)
             else:
                 logger.error("Cannot find a function to handle cognito trigger {}".format(triggerSource))
@@ -463,9 +962,9 @@ class LambdaHandler:
         elif event.get('awslogs', None):
             result = None
             whole_function = '{}.{}'.format(settings.APP_MODULE, settings.APP_FUNCTION)
-            app_function = self.import_module_and_get_function(whole_function)
+            app_function, arity = self.get_routed_function(whole_function)
             if app_function:
-                result = self.run_function(app_function, event, context)
+                result = self.call_function(app_function, arity, event, context)
                 logger.debug("Result of %s:" % whole_function)
                 logger.debug(result)
             else:
@@ -477,132 +976,118 @@ class LambdaHandler:
             # Timing
             time_start = datetime.datetime.now()
 
-            # This is a normal HTTP request
-            if event.get('httpMethod', None):
-                script_name = ''
-                is_elb_context = False
-                headers = merge_headers(event)
-                if event.get('requestContext', None) and event['requestContext'].get('elb', None):
-                    # Related: https://github.com/Miserlou/Zappa/issues/1715
-                    # inputs/outputs for lambda loadbalancer
-                    # https://docs.aws.amazon.com/elasticloadbalancing/latest/application/lambda-functions.html
-                    is_elb_context = True
-                    # host is lower-case when forwarded from ELB
-                    host = headers.get('host')
-                    # TODO: pathParameters is a first-class citizen in apigateway but not available without
-                    # some parsing work for ELB (is this parameter used for anything?)
-                    event['pathParameters'] = ''
-                else:
-                    if headers:
-                        host = headers.get('Host')
-                    else:
-                        host = None
-                    logger.debug('host found: [{}]'.format(host))
-
-                    if host:
-                        if 'amazonaws.com' in host:
-                            logger.debug('amazonaws found in host')
-                            # The path provided in th event doesn't include the
-                            # stage, so we must tell Flask to include the API
-                            # stage in the url it calculates. See https://github.com/Miserlou/Zappa/issues/1014
-                            script_name = '/' + settings.API_STAGE
+            # This is a normal HTTP request, from a REST API or ALB,
+            # or from an HTTP API or Function URL (the 2.0 payload format)
+            is_v2 = is_payload_v2(event)
+            if event.get('httpMethod', None) or is_v2:
+                environ, is_elb_context = self.create_web_environ(event, context, is_v2)
+
+                # Execute the application
+                try:
+                    # Read a request body offloaded to S3
+                    if self.offloader:
+                        environ['zappa.offload'] = self.offloader
+                        self.offloader.resolve_request(environ)
+
+                    if self.asgi_app:
+                        response, body = self.asgi_app(environ)
                     else:
-                        # This is a test request sent from the AWS console
-                        if settings.DOMAIN:
-                            # Assume the requests received will be on the specified
-                            # domain. No special handling is required
-                            pass
-                        else:
-                            # Assume the requests received will be to the
-                            # amazonaws.com endpoint, so tell Flask to include the
-                            # API stage
-                            script_name = '/' + settings.API_STAGE
-
-                base_path = getattr(settings, 'BASE_PATH', None)
-
-                # Create the environment for WSGI and handle the request
-                environ = create_wsgi_request(
-                    event,
-                    script_name=script_name,
-                    base_path=base_path,
-                    trailing_slash=self.trailing_slash,
+                        response, body = run_wsgi_app(self.wsgi_app, environ)
+                except OffloadError as e:
+                    response, body = run_wsgi_app(e, environ)
+                self.metrics.lap('request.app')
+
+                # Compress the body, if the client accepts it, and it reaches the client
+                # as bytes: without binary support, a REST API would pass on the base64.
+                if getattr(settings, 'RESPONSE_COMPRESSION', False) and \
+                        (settings.BINARY_SUPPORT or is_elb_context or is_v2):
+                    body = compress_response(
+                        response,
+                        body,
+                        environ.get('HTTP_ACCEPT_ENCODING', ''),
+                        min_size=settings.RESPONSE_COMPRESSION_MIN_SIZE,
+                        mimetypes=settings.RESPONSE_COMPRESSION_MIMETYPES
+                    )
+
+                # Offload a body too large to return to S3, and redirect to it.
+                if self.offloader and body and self.offloader.should_offload(
+                        body, is_base64_response(response, settings.BINARY_SUPPORT or is_v2)):
+                    body = self.offloader.offload_response(response, body)
+
+                # This is the object we're going to return.
+                # Pack the WSGI response into our special dictionary.
+                zappa_returndict = create_lambda_response(
+                    response,
+                    body,
                     binary_support=settings.BINARY_SUPPORT,
-                    context_header_mappings=settings.CONTEXT_HEADER_MAPPINGS
+                    headers='headers' in event,
+                    multi_value_headers='multiValueHeaders' in event,
+                    elb=is_elb_context,
+                    payload_version='2.0' if is_v2 else '1.0'
                 )
+                self.metrics.lap('request.response')
 
-                # We are always on https on Lambda, so tell our wsgi app that.
-                environ['HTTPS'] = 'on'
-                environ['wsgi.url_scheme'] = 'https'
-                environ['lambda.context'] = context
-                environ['lambda.event'] = event
+                # Calculate the total response time, and log the request.
+                time_end = datetime.datetime.now()
+                delta = time_end - time_start
+                response_time_ms = delta.total_seconds() * 1000
+                self.access_logger.log(environ, response.status_code, len(body), response_time=response_time_ms)
 
-                # Execute the application
-                with Response.from_app(self.wsgi_app, environ) as response:
-                    # This is the object we're going to return.
-                    # Pack the WSGI response into our special dictionary.
-                    zappa_returndict = dict()
-
-                    # Issue #1715: ALB support. ALB responses must always include
-                    # base64 encoding and status description
-                    if is_elb_context:
-                        zappa_returndict.setdefault('isBase64Encoded', False)
-                        zappa_returndict.setdefault('statusDescription', response.status)
-
-                    if response.data:
-                        if settings.BINARY_SUPPORT and \
-                                not response.mimetype.startswith("text/") \
-                                and response.mimetype != "application/json":
-                            zappa_returndict['body'] = base64.b64encode(response.data).decode('utf-8')
-                            zappa_returndict["isBase64Encoded"] = True
-                        else:
-                            zappa_returndict['body'] = response.get_data(as_text=True)
-
-                    zappa_returndict['statusCode'] = response.status_code
-                    if 'headers' in event:
-                        zappa_returndict['headers'] = {}
-                        for key, value in response.headers:
-                            zappa_returndict['headers'][key] = value
-                    if 'multiValueHeaders' in event:
-                        zappa_returndict['multiValueHeaders'] = {}
-                        for key, value in response.headers:
-                            zappa_returndict['multiValueHeaders'][key] = response.headers.getlist(key)
-
-                    # Calculate the total response time,
-                    # and log it in the Common Log format.
-                    time_end = datetime.datetime.now()
-                    delta = time_end - time_start
-                    response_time_ms = delta.total_seconds() * 1000
-                    response.content = response.data
-                    common_log(environ, response, response_time=response_time_ms)
-
-                    return zappa_returndict
+                return zappa_returndict
         except Exception as e:  # pragma: no cover
-            # Print statements are visible in the logs either way
-            print(e)
-            exc_info = sys.exc_info()
-            message = ('An uncaught exception happened while servicing this request. '
-                       'You can investigate this with the `zappa tail` command.')
-
-            # If we didn't even build an app_module, just raise.
-            if not settings.DJANGO_SETTINGS:
-                try:
-                    self.app_module
-                except NameError as ne:
-                    message = 'Failed to import module: {}'.format(ne.message)
-
-            # Call exception handler for unhandled exceptions
-            exception_handler = self.settings.EXCEPTION_HANDLER
-            self._process_exception(exception_handler=exception_handler,
-                                    event=event, context=context, exception=e)
-
-            # Return this unspecified exception as a 500, using template that API Gateway expects.
-            content = collections.OrderedDict()
-            content['statusCode'] = 500
-            body = {'message': message}
-            if settings.DEBUG:  # only include traceback if debug is on.
-                body['traceback'] = traceback.format_exception(*exc_info)  # traceback as a list for readability.
-            content['body'] = json.dumps(str(body), sort_keys=True, indent=4)
-            return content
+            return self.get_error_response(event, context, e)
+
+    def stream(self, event, context):
+        """
+        Handle an invocation for the streaming runtime, returning the content
+        type of the response and an iterator over its chunks.
+
+        Function URL requests are answered with a streamed HTTP response, whose
+        body is forwarded as the app produces it. Other events, including API
+        Gateway and ALB requests, which need the usual proxy response, are
+        handled as usual, and their result is returned as JSON.
+        """
+        if not is_function_url_event(event):
+            result = self.lambda_handler(event, context)
+            return 'application/json', [json.dumps(result, default=str).encode('utf-8')]
+        return STREAMING_CONTENT_TYPE, self.stream_web_response(event, context)
+
+    def stream_web_response(self, event, context):
+        """
+        Run the app for a web request, yielding the prelude of its response,
+        then the chunks of its body as the app produces them.
+
+        Streamed responses aren't compressed or cached.
+        """
+        self.metrics.start()
+        self.refresh_remote_settings()
+        time_start = datetime.datetime.now()
+        try:
+            try:
+                environ, _ = self.create_web_environ(event, context, is_payload_v2(event))
+                if self.asgi_app:
+                    response, chunks = self.asgi_app.stream(environ)
+                else:
+                    response, chunks = stream_wsgi_app(self.wsgi_app, environ)
+            except Exception as e:  # pragma: no cover
+                content = self.get_error_response(event, context, e)
+                yield create_prelude(content['statusCode'], [('Content-Type', 'application/json')])
+                yield content['body'].encode('utf-8')
+                return
+
+            # The time to the start of the response, then the time to stream its body
+            self.metrics.lap('request.app')
+            yield create_prelude(response.status_code, response.headers.to_wsgi_list())
+            size = 0
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+            self.metrics.lap('request.response')
+
+            delta = datetime.datetime.now() - time_start
+            self.access_logger.log(environ, response.status_code, size, response_time=delta.total_seconds() * 1000)
+        finally:
+            self.finish_invocation()
 
 
 def lambda_handler(event, context):  # pragma: no cover
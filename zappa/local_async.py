@@ -0,0 +1,268 @@
+"""
+The local backend of zappa.asynchronous, which runs tasks outside of Lambda
+on a pool of threads or processes, with their responses in a SQLite stand-in
+for the async response table.
+
+It's only imported when the local backend is used, so that functions running
+on Lambda never load it.
+"""
+import atexit
+import concurrent.futures
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+import botocore
+
+from . import asynchronous
+from .asynchronous import ASYNC_CLASSES, AsyncException, BackgroundSender, LambdaAsyncResponse, run_messages
+
+ASYNC_LOCAL_WORKERS = int(os.environ.get('ZAPPA_ASYNC_LOCAL_WORKERS', 4))
+ASYNC_LOCAL_STORE = os.environ.get('ZAPPA_ASYNC_LOCAL_STORE')
+ASYNC_LOCAL_QUEUE_SIZE = 1000
+
+_lock = threading.Lock()
+
+
+class LocalExecutor(BackgroundSender):
+    """
+    Runs tasks on a local pool of threads or processes.
+    """
+    failure_message = 'Async task failed: {!r}'
+
+    def __init__(self, backend='thread', workers=ASYNC_LOCAL_WORKERS, queue_size=ASYNC_LOCAL_QUEUE_SIZE):
+        if backend not in ('thread', 'process'):
+            raise AsyncException("Unknown local async backend {!r}, expected 'thread' or 'process'.".format(backend))
+        self.backend = backend
+        super().__init__(workers, queue_size)
+
+    def create_executor(self, workers):
+        if self.backend == 'process':
+            return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def flush(self, timeout=None):
+        """
+        Wait for the running tasks, and for those they dispatch in turn, like
+        a map's callback. Returns whether they were all done within the timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        flushed = set()
+        while True:
+            with self.lock:
+                pending = [future for future in self.pending if future not in flushed]
+            if not pending:
+                return True
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            done, not_done = concurrent.futures.wait(pending, remaining)
+            for future in done:
+                if future.exception() is not None:
+                    print(self.failure_message.format(future.exception()))
+            if not_done:
+                return False
+            flushed.update(done)
+
+
+_local_executor = None
+_local_executor_pid = None
+_local_table = None
+
+
+def get_local_executor():
+    """
+    Return the local executor, starting it on first use in this process.
+    """
+    global _local_executor, _local_executor_pid, ASYNC_LOCAL_STORE
+    with _lock:
+        if _local_executor is None or _local_executor_pid != os.getpid():
+            backend = asynchronous.ASYNC_LOCAL_BACKEND
+            if backend == 'process' and not ASYNC_LOCAL_STORE:
+                # The worker processes share the responses through a file,
+                # which is removed at exit since it was made here.
+                fd, ASYNC_LOCAL_STORE = tempfile.mkstemp(prefix='zappa-async-', suffix='.sqlite')
+                os.close(fd)
+                os.environ['ZAPPA_ASYNC_LOCAL_STORE'] = ASYNC_LOCAL_STORE
+                atexit.register(remove_local_store, ASYNC_LOCAL_STORE, os.getpid())
+            _local_executor = LocalExecutor(backend, ASYNC_LOCAL_WORKERS)
+            _local_executor_pid = os.getpid()
+    return _local_executor
+
+
+def remove_local_store(path, pid):
+    # Not from the processes forked from the one which made it.
+    if os.getpid() != pid:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def get_local_table():
+    """
+    Return the local async response table, opening it on first use.
+    """
+    global _local_table
+    with _lock:
+        if _local_table is None or _local_table.path != (ASYNC_LOCAL_STORE or ':memory:'):
+            _local_table = LocalResponseTable(ASYNC_LOCAL_STORE or ':memory:')
+    return _local_table
+
+
+def run_local_message(payload):
+    return run_messages(json.loads(payload))
+
+
+class LocalAsyncResponse(LambdaAsyncResponse):
+    """
+    Run a task on the local executor, once its message has been checked
+    as if it were sent through the service.
+    """
+    def __init__(self, lambda_function_name=None, aws_region=None, capture_response=False, service='lambda', **kwargs):
+        self.lambda_function_name = lambda_function_name
+        self.aws_region = aws_region
+        self.payload_limit = ASYNC_CLASSES[service].payload_limit
+        # Responses are always captured, since there's nowhere else to see them.
+        self.capture_response = True
+        self.response_id = str(uuid.uuid4())
+        self.task_future = None
+
+    def get_batch_key(self):
+        return (type(self), self.payload_limit)
+
+    def check_payload(self, message):
+        # Large arguments are passed as they are, rather than through S3.
+        return message
+
+    def _send(self, message):
+        message['command'] = 'zappa.asynchronous.route_lambda_task'
+        payload = json.dumps(message)
+        if len(payload.encode('utf-8')) > self.payload_limit and not asynchronous.ASYNC_PAYLOAD_BUCKET:
+            raise AsyncException("Payload too large for async call: {}".format(message.get('task_path', 'batch')))
+        self.task_future = get_local_executor().submit(run_local_message, payload)
+        self.response = {'StatusCode': 202}
+        self.sent = True
+
+
+def check_condition(item, condition, values):
+    """
+    Check a 'name = :value', 'name <> :value' or 'attribute_exists(name)'
+    condition on an item.
+    """
+    match = re.match(r'attribute_exists\((\w+)\)$', condition)
+    if match:
+        return match.group(1) in item
+    name, operator, value = condition.split(' ')
+    if operator == '=':
+        return item.get(name) == values[value]
+    if operator != '<>':
+        raise AsyncException('Unsupported condition: {}'.format(condition))
+    return item.get(name) != values[value]
+
+
+def apply_update(item, expression, values, names=None):
+    """
+    Apply a DynamoDB update expression of 'SET name = :value, ...' and
+    'ADD name :value, ...' clauses to an item, where ADD is to a number or set.
+    """
+    names = names or {}
+    for action, assignments in re.findall(r'(SET|ADD) (.*?)(?= SET | ADD |$)', expression):
+        for assignment in assignments.split(', '):
+            if action == 'SET':
+                name, value = assignment.split(' = ')
+                item[names.get(name, name)] = values[value]
+                continue
+            name, value = assignment.split(' ')
+            name = names.get(name, name)
+            (value_type, added), = values[value].items()
+            if value_type == 'N':
+                item[name] = {'N': str(int(item.get(name, {'N': '0'})['N']) + int(added))}
+            else:
+                current = item.get(name, {value_type: []})[value_type]
+                item[name] = {value_type: current + [v for v in added if v not in current]}
+    return item
+
+
+class LocalResponseTable:
+    """
+    A stand-in for the async response table in SQLite, which takes the
+    DynamoDB calls this module makes. Updates are applied in a transaction,
+    so that processes sharing a file see them atomically.
+    """
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+    def get_connection(self):
+        # Connections aren't shared with forked processes.
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS responses (id TEXT PRIMARY KEY, item TEXT)')
+            self.pid = os.getpid()
+        return self.connection
+
+    def load(self, response_id):
+        row = self.get_connection().execute('SELECT item FROM responses WHERE id = ?', (response_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def store(self, item):
+        self.get_connection().execute('INSERT OR REPLACE INTO responses VALUES (?, ?)',
+                                      (item['id']['S'], json.dumps(item)))
+
+    def put_item(self, TableName, Item):
+        with self.lock:
+            self.store(Item)
+        return {}
+
+    def get_item(self, TableName, Key):
+        with self.lock:
+            item = self.load(Key['id']['S'])
+        return {'Item': item} if item else {}
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        with self.lock:
+            for table_name, request in RequestItems.items():
+                items = [self.load(key['id']['S']) for key in request['Keys']]
+                responses[table_name] = [item for item in items if item]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues,
+                    ConditionExpression=None, ExpressionAttributeNames=None, ReturnValues=None):
+        """
+        Apply an update, with an optional condition, as apply_update does.
+        """
+        with self.lock:
+            connection = self.get_connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                item = self.load(Key['id']['S']) or {'id': Key['id']}
+                if ConditionExpression and not check_condition(item, ConditionExpression,
+                                                               ExpressionAttributeValues):
+                    raise botocore.exceptions.ClientError(
+                        {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ConditionExpression}},
+                        'UpdateItem')
+                apply_update(item, UpdateExpression, ExpressionAttributeValues, ExpressionAttributeNames)
+                self.store(item)
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        return {'Attributes': item}
+
+
+def flush(timeout=None):
+    """
+    Wait for the tasks this process is running locally.
+    Returns whether they were all done within the timeout.
+    """
+    if _local_executor is None or _local_executor_pid != os.getpid():
+        return True
+    return _local_executor.flush(timeout)
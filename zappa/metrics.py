@@ -0,0 +1,128 @@
+"""
+Phase timings for the Lambda handler, emitted as CloudWatch Embedded Metric Format.
+
+The handler records how long each phase of its cold start (settings import,
+remote settings, project archive, libraries, app import) and of each request
+takes, and writes them once per invocation as a single EMF JSON line, which
+CloudWatch turns into metrics without any API calls. Other sinks can be
+registered with `add_sink`.
+"""
+import json
+import os
+import sys
+import time
+
+METRICS_NAMESPACE = 'Zappa'
+
+# Callables given each EMF document, besides stdout
+SINKS = []
+
+
+def add_sink(sink):
+    """
+    Register a callable to be called with each metrics document.
+    """
+    if sink not in SINKS:
+        SINKS.append(sink)
+
+
+def remove_sink(sink):
+    if sink in SINKS:
+        SINKS.remove(sink)
+
+
+def stdout_sink(document):
+    sys.stdout.write(json.dumps(document) + '\n')
+    sys.stdout.flush()
+
+
+class MetricsRecorder:
+    """
+    Records phases as laps: `lap(name)` records the time since the previous lap.
+
+    Init phases are kept until the first flush, so that they are reported
+    with the invocation which paid for them. Counts, like those of the response
+    cache, are recorded with `count(name, value)`. When disabled, laps, counts
+    and flushes do nothing.
+    """
+    def __init__(self, enabled=True, namespace=METRICS_NAMESPACE, emit=True):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.emit = emit
+        self.timings = {}
+        self.counts = {}
+        self.cold_start = True
+        self.started_at = None
+        self.last_lap = None
+
+    def start(self):
+        if self.enabled:
+            self.started_at = self.last_lap = time.perf_counter()
+
+    def lap(self, name):
+        if not self.enabled or self.last_lap is None:
+            return
+        now = time.perf_counter()
+        self.timings[name] = self.timings.get(name, 0.0) + (now - self.last_lap) * 1000
+        self.last_lap = now
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def finish(self, name):
+        """
+        Record the time since start() as the total of the phases.
+        """
+        if self.enabled and self.started_at is not None:
+            self.timings[name] = (time.perf_counter() - self.started_at) * 1000
+
+    def get_document(self, dimensions=None):
+        """
+        Return the recorded timings as an EMF document, in milliseconds,
+        along with the recorded counts.
+        """
+        timings = self.timings
+        counts = self.counts
+        dimensions = dimensions or {}
+
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [sorted(dimensions.keys())],
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in sorted(timings)] +
+                               [{'Name': name, 'Unit': 'Count'} for name in sorted(counts)],
+                }],
+            },
+            'ColdStart': self.cold_start,
+        }
+        document.update(dimensions)
+        document.update(timings)
+        document.update(counts)
+        return document
+
+    def flush(self, total_name='request.total', dimensions=None):
+        """
+        Emit the timings recorded since the last flush.
+        """
+        if not self.enabled or self.started_at is None:
+            return None
+
+        if dimensions is None:
+            dimensions = {'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')}
+        self.finish(total_name)
+        document = self.get_document(dimensions)
+        self.timings = {}
+        self.counts = {}
+        self.cold_start = False
+        self.started_at = self.last_lap = None
+
+        sinks = [stdout_sink] + SINKS if self.emit else list(SINKS)
+        for sink in sinks:
+            try:
+                sink(document)
+            except Exception as e:  # pragma: no cover
+                print('Failed to emit metrics: {}'.format(e))
+        return document
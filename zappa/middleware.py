@@ -1,5 +1,17 @@
+import collections
+import threading
+import time
+
+from werkzeug.datastructures import Headers, ResponseCacheControl
+from werkzeug.http import parse_cache_control_header, parse_list_header, unquote_etag
 from werkzeug.wsgi import ClosingIterator
 
+RESPONSE_CACHE_MAX_ENTRIES = 256
+RESPONSE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Status codes which are cacheable by default (RFC 7231, 6.1)
+CACHEABLE_STATUS_CODES = [200, 203, 204, 300, 301, 404, 405, 410, 414, 501]
+
 
 def all_casings(input_string):
     """
@@ -56,3 +68,243 @@ class ZappaWSGIMiddleware:
 
         # Return the response as a WSGI-safe iterator
         return ClosingIterator(response)
+
+
+CachedResponse = collections.namedtuple(
+    'CachedResponse', ['status', 'headers', 'body', 'vary', 'etag', 'stored_at', 'max_age'])
+
+
+class ResponseCacheMiddleware:
+    """
+    Serves repeat GET and HEAD requests from a bounded LRU cache held in the
+    warm container, without calling the application.
+
+    Responses are stored according to their Cache-Control max-age (or s-maxage)
+    and Vary headers. A stale response with an ETag is revalidated with a
+    conditional request, rather than fetched again. The cache is keyed on the
+    host, the path, the query string and the request headers named in
+    `key_headers`.
+
+    Requests with an Authorization header, or a Cookie unless it's one of the
+    `key_headers`, always reach the application, and responses setting cookies
+    are only stored if they're explicitly public.
+
+    Hit, miss, revalidation, store and eviction counts are kept in `stats`.
+    The handler reports the counts of each invocation with its metrics.
+    """
+    def __init__(self, application, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES, key_headers=None):
+        self.application = application
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.key_headers = [header.lower() for header in key_headers or []]
+
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = collections.Counter(hits=0, misses=0, revalidations=0, stores=0, evictions=0)
+        self.reported_stats = collections.Counter()
+
+    def record(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def take_stats(self):
+        """
+        Return the counts since the previous call.
+        """
+        with self.lock:
+            stats = collections.Counter({name: count - self.reported_stats[name]
+                                         for name, count in self.stats.items()})
+            self.reported_stats = self.stats.copy()
+        return stats
+
+    @staticmethod
+    def get_request_header(environ, name):
+        key = name.upper().replace('-', '_')
+        if key in ['CONTENT_TYPE', 'CONTENT_LENGTH']:
+            return environ.get(key)
+        return environ.get('HTTP_' + key)
+
+    def get_cache_key(self, environ):
+        return (
+            environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+            environ.get('QUERY_STRING', ''),
+            environ.get('HTTP_HOST') or environ.get('SERVER_NAME', ''),
+            tuple(self.get_request_header(environ, header) for header in self.key_headers)
+        )
+
+    def get(self, key, environ):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            # A response varying on other request headers than this one's is a miss.
+            for header, value in entry.vary:
+                if self.get_request_header(environ, header) != value:
+                    return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        size = len(entry.body)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = entry
+            self.size += size
+            self.stats['stores'] += 1
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+                self.stats['evictions'] += 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def call_application(self, environ):
+        """
+        Run the application, returning its status, headers and whole body.
+        """
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return lambda data: response.append(data)
+
+        app_iter = self.application(environ, start_response)
+        try:
+            chunks = response[2:] + list(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        body = b''.join(chunk.encode('utf-8') if isinstance(chunk, str) else chunk for chunk in chunks)
+        return response[0], response[1], body
+
+    def make_entry(self, environ, status, headers, body):
+        """
+        Return the response as a cache entry, or None if it must not be stored.
+        """
+        if int(status.split(None, 1)[0]) not in CACHEABLE_STATUS_CODES:
+            return None
+
+        headers = Headers(headers)
+        cache_control = parse_cache_control_header(headers.get('Cache-Control'), cls=ResponseCacheControl)
+        if cache_control.no_store or cache_control.private:
+            return None
+        # Another user's cookies must not be served from the cache.
+        if 'Set-Cookie' in headers and not cache_control.public:
+            return None
+
+        vary = [header.strip().lower() for header in parse_list_header(headers.get('Vary', ''))]
+        if '*' in vary:
+            return None
+
+        max_age = cache_control.s_maxage
+        if max_age is None:
+            max_age = cache_control.max_age
+        if cache_control.no_cache:
+            max_age = 0
+        etag = headers.get('ETag')
+        if not max_age and not etag:
+            return None
+
+        return CachedResponse(
+            status=status,
+            headers=headers.to_wsgi_list(),
+            body=body,
+            vary=tuple((header, self.get_request_header(environ, header)) for header in vary),
+            etag=etag,
+            stored_at=time.time(),
+            max_age=max_age or 0
+        )
+
+    def revalidate(self, key, environ, entry):
+        """
+        Ask the application whether the stale entry is still current,
+        updating the cache with the answer.
+        """
+        conditional = dict(environ)
+        conditional['HTTP_IF_NONE_MATCH'] = entry.etag
+        conditional.pop('HTTP_IF_MODIFIED_SINCE', None)
+        status, headers, body = self.call_application(conditional)
+
+        if status.startswith('304'):
+            self.record('revalidations')
+            # The 304's caching headers replace the stored ones.
+            headers = Headers(headers)
+            refreshed = Headers(entry.headers)
+            for name in ['Cache-Control', 'Expires', 'ETag', 'Vary']:
+                if name in headers:
+                    refreshed[name] = headers[name]
+            status, headers, body = entry.status, refreshed.to_wsgi_list(), entry.body
+        else:
+            self.record('misses')
+
+        fresh = self.make_entry(environ, status, headers, body)
+        if fresh is None:
+            with self.lock:
+                self.discard(key)
+        else:
+            self.put(key, fresh)
+        return status, headers, body
+
+    def respond(self, environ, start_response, status, headers, body, age=None):
+        headers = Headers(headers)
+        if age is not None:
+            headers['Age'] = str(age)
+        if_none_match = self.get_request_header(environ, 'If-None-Match')
+        etag = headers.get('ETag')
+        if if_none_match and etag and status.startswith('200'):
+            if if_none_match.strip() == '*' or unquote_etag(etag)[0] in \
+                    [unquote_etag(tag.strip())[0] for tag in if_none_match.split(',')]:
+                status, body = '304 Not Modified', b''
+                headers.remove('Content-Length')
+        start_response(status, headers.to_wsgi_list())
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return [b'']
+        return [body]
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method not in ['GET', 'HEAD'] or self.get_request_header(environ, 'Authorization'):
+            return self.application(environ, start_response)
+        # Responses to a user's cookies may be theirs only, unless keyed on them.
+        if self.get_request_header(environ, 'Cookie') and 'cookie' not in self.key_headers:
+            return self.application(environ, start_response)
+        request_cache_control = parse_cache_control_header(self.get_request_header(environ, 'Cache-Control'))
+        if request_cache_control.no_store:
+            return self.application(environ, start_response)
+
+        key = self.get_cache_key(environ)
+        entry = None if request_cache_control.no_cache else self.get(key, environ)
+
+        if entry is not None:
+            age = int(time.time() - entry.stored_at)
+            if age < entry.max_age:
+                self.record('hits')
+                return self.respond(environ, start_response, entry.status, entry.headers, entry.body, age=age)
+            if entry.etag and method == 'GET':
+                status, headers, body = self.revalidate(key, environ, entry)
+                return self.respond(environ, start_response, status, headers, body)
+
+        self.record('misses')
+        # A HEAD response has no body to store.
+        if method == 'HEAD':
+            return self.application(environ, start_response)
+
+        # The application answers conditional requests itself.
+        status, headers, body = self.call_application(environ)
+        entry = self.make_entry(environ, status, headers, body)
+        if entry is not None:
+            self.put(key, entry)
+        start_response(status, headers)
+        return [body]
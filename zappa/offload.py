@@ -0,0 +1,222 @@
+"""
+Offloading of request and response bodies too large for Lambda to S3.
+
+A synchronous invocation's payload is limited to about 6 MB. With the
+`offload_bucket` setting, a response body whose serialized size passes the
+threshold is uploaded to the bucket, with a multipart upload when large, and
+the client is redirected to a short-lived presigned URL of it, or given that
+URL in a JSON envelope.
+
+Large request bodies take the same route the other way. The app gives the
+client an upload from `environ['zappa.offload'].create_upload()`; the client
+PUTs the body to the upload's presigned URL, then sends its request without a
+body and with the upload's key in the X-Zappa-Offload-Key header. The handler
+reads the body from the bucket, and deletes it, before the app sees the request.
+
+On deploy and update, the bucket gets a lifecycle rule which expires objects
+under the prefix after `offload_expiration_days` (1 by default), for the
+responses and the uploads which are never read.
+"""
+import concurrent.futures
+import json
+import logging
+import math
+import uuid
+
+import botocore
+
+from werkzeug.exceptions import BadRequest
+
+try:
+    from zappa.clients import get_client
+    from zappa.wsgi import RequestBodyStream
+except ImportError:  # pragma: no cover
+    from .clients import get_client
+    from .wsgi import RequestBodyStream
+
+logger = logging.getLogger(__name__)
+
+OFFLOAD_PREFIX = 'zappa-offload/'
+OFFLOAD_THRESHOLD = 5 * 1000 * 1000
+OFFLOAD_EXPIRES_IN = 300
+OFFLOAD_STATUS_CODE = 303
+OFFLOAD_PART_SIZE = 8 * 1024 * 1024
+OFFLOAD_UPLOAD_CONCURRENCY = 4
+OFFLOAD_KEY_HEADER = 'X-Zappa-Offload-Key'
+
+# The response headers which describe the offloaded body, rather than the redirect
+BODY_HEADERS = ['Content-Type', 'Content-Length', 'Content-Encoding', 'Content-MD5', 'ETag']
+
+
+class OffloadError(BadRequest):
+    """
+    A request refers to an offloaded body which can't be read.
+    """
+
+
+def get_serialized_size(size, base64_encoded=False):
+    """
+    Return the size of a body of size bytes once serialized into the Lambda's result.
+    """
+    return 4 * int(math.ceil(size / 3.0)) if base64_encoded else size
+
+
+def upload_body(s3_client, bucket, key, body, part_size=OFFLOAD_PART_SIZE,
+                concurrency=OFFLOAD_UPLOAD_CONCURRENCY, **kwargs):
+    """
+    Upload a body to S3, as a multipart upload of parts uploaded in parallel
+    if it's larger than part_size. The kwargs are passed on to S3.
+    """
+    if len(body) <= part_size:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body, **kwargs)
+        return
+
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key, **kwargs)['UploadId']
+    view = memoryview(body)
+
+    def upload_part(number):
+        start = (number - 1) * part_size
+        response = s3_client.upload_part(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=view[start:start + part_size].tobytes()
+        )
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            parts = list(executor.map(upload_part, range(1, int(math.ceil(len(body) / float(part_size))) + 1)))
+        s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+class S3Offloader:
+    """
+    Offloads response bodies to, and reads request bodies from, an S3 bucket.
+
+    Responses are offloaded under `<prefix>responses/`, and request bodies are
+    only read from under `<prefix>uploads/`, so a client can't make the
+    function read any other object. Uploads are deleted once read, and the
+    lifecycle rule added on deploy expires everything else under the prefix.
+    """
+    def __init__(self, bucket, prefix=OFFLOAD_PREFIX, threshold=OFFLOAD_THRESHOLD,
+                 expires_in=OFFLOAD_EXPIRES_IN, status_code=OFFLOAD_STATUS_CODE, envelope=False,
+                 s3_client=None, boto_session=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.threshold = threshold
+        self.expires_in = expires_in
+        self.status_code = status_code
+        self.envelope = envelope
+        self.boto_session = boto_session
+        self._s3_client = s3_client
+
+    @property
+    def s3_client(self):
+        # Created on first use, so that functions which never offload don't pay for it.
+        if self._s3_client is None:
+            self._s3_client = self.boto_session.client('s3') if self.boto_session else get_client('s3')
+        return self._s3_client
+
+    def get_key(self, kind):
+        return '{}{}/{}'.format(self.prefix, kind, uuid.uuid4().hex)
+
+    def should_offload(self, body, base64_encoded=False):
+        return get_serialized_size(len(body), base64_encoded) > self.threshold
+
+    def offload_response(self, response, body):
+        """
+        Upload the body of a response, and turn the response into a redirect
+        to a presigned URL of it, or a JSON envelope holding that URL.
+
+        Returns the new body of the response.
+        """
+        key = self.get_key('responses')
+        kwargs = {'ContentType': response.headers.get('Content-Type', 'application/octet-stream')}
+        if 'Content-Encoding' in response.headers:
+            kwargs['ContentEncoding'] = response.headers['Content-Encoding']
+        if 'Content-Disposition' in response.headers:
+            kwargs['ContentDisposition'] = response.headers.pop('Content-Disposition')
+        upload_body(self.s3_client, self.bucket, key, body, **kwargs)
+
+        url = self.s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': key},
+            ExpiresIn=self.expires_in
+        )
+        logger.info('Offloaded a response of {} bytes to s3://{}/{}'.format(len(body), self.bucket, key))
+
+        for header in BODY_HEADERS:
+            response.headers.pop(header, None)
+        if not self.envelope:
+            response.status_code = self.status_code
+            response.headers['Location'] = url
+            response.headers['Content-Length'] = '0'
+            return b''
+
+        envelope = json.dumps({
+            'offloaded': True,
+            'url': url,
+            'expires_in': self.expires_in,
+            'content_type': kwargs['ContentType'],
+            'size': len(body),
+        }).encode('utf-8')
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['Content-Length'] = str(len(envelope))
+        return envelope
+
+    def create_upload(self, content_type=None):
+        """
+        Create an upload for a request body too large to send inline:
+        the body is PUT to the upload's url, and the request is then sent
+        with the upload's key in the X-Zappa-Offload-Key header.
+        """
+        key = self.get_key('uploads')
+        params = {'Bucket': self.bucket, 'Key': key}
+        if content_type:
+            params['ContentType'] = content_type
+        return {
+            'key': key,
+            'url': self.s3_client.generate_presigned_url('put_object', Params=params, ExpiresIn=self.expires_in),
+            'method': 'PUT',
+            'header': OFFLOAD_KEY_HEADER,
+            'expires_in': self.expires_in,
+        }
+
+    def resolve_request(self, environ):
+        """
+        Replace the body of a request with the upload named by its
+        X-Zappa-Offload-Key header, if it has one. Returns whether it did.
+        """
+        key = environ.get('HTTP_X_ZAPPA_OFFLOAD_KEY')
+        if not key:
+            return False
+        if not key.startswith(self.prefix + 'uploads/') or '..' in key:
+            raise OffloadError('Invalid {} header.'.format(OFFLOAD_KEY_HEADER))
+
+        try:
+            obj = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            logger.warning('Failed to read the offloaded request body {}: {}'.format(key, e))
+            raise OffloadError('No upload found for the {} header.'.format(OFFLOAD_KEY_HEADER))
+        body = obj['Body'].read()
+        try:
+            self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            # The lifecycle rule expires it anyway.
+            logger.warning('Failed to delete the offloaded request body {}: {}'.format(key, e))
+
+        environ['wsgi.input'] = RequestBodyStream(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        if 'CONTENT_TYPE' not in environ and obj.get('ContentType'):
+            environ['CONTENT_TYPE'] = obj['ContentType']
+        return True
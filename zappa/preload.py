@@ -0,0 +1,198 @@
+"""
+Import tracing and the preload manifest.
+
+With the `preload_trace` setting, the app's imports are timed at build time,
+giving a ranked report of the slowest imports, and the slowest top-level
+modules are put in the preload manifest written into the handler package.
+This imports the app module in a subprocess of the build, on every package,
+so it's opt-in. The `preload_modules` setting adds to the measured modules.
+
+At init, the handler imports the manifest's `preload` modules, which the app
+would otherwise import during its first requests, and installs a finder which
+imports the manifest's `defer` modules lazily, on first attribute access.
+"""
+import collections
+import importlib
+import importlib.util
+import json
+import logging
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+PRELOAD_MANIFEST = 'zappa_preload.json'
+PRELOAD_LIMIT = 10
+
+ImportRecord = collections.namedtuple('ImportRecord', ['name', 'self_us', 'cumulative_us', 'depth'])
+
+
+def parse_importtime(output):
+    """
+    Parse the stderr of `python -X importtime` into a list of ImportRecords,
+    in the order the imports completed.
+    """
+    records = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            # The header line
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        records.append(ImportRecord(name.strip(), self_us, cumulative_us, depth))
+    return records
+
+
+def trace_imports(modules, python=None, cwd=None, env=None):
+    """
+    Import the modules in a fresh interpreter with `-X importtime`,
+    returning the ImportRecords of everything they imported.
+    """
+    code = '\n'.join('import {}'.format(module) for module in modules)
+    process = subprocess.run(
+        [python or sys.executable, '-X', 'importtime', '-c', code],
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    records = parse_importtime(process.stderr)
+    if process.returncode != 0:
+        errors = process.stderr.strip().splitlines() or ['exit code {}'.format(process.returncode)]
+        raise RuntimeError('Failed to import {}: {}'.format(', '.join(modules), errors[-1]))
+    return records
+
+
+def format_report(records, limit=25):
+    """
+    Rank the imports by their own import time, slowest first.
+    """
+    lines = ['{0:>10} {1:>10}  {2}'.format('self (ms)', 'cumul (ms)', 'module')]
+    for record in sorted(records, key=lambda r: r.self_us, reverse=True)[:limit]:
+        lines.append('{0:>10.1f} {1:>10.1f}  {2}'.format(
+            record.self_us / 1000.0, record.cumulative_us / 1000.0, record.name))
+    return '\n'.join(lines)
+
+
+def build_manifest(records, preload=None, defer=None, threshold_ms=0, limit=PRELOAD_LIMIT, exclude=None):
+    """
+    Build a preload manifest from the traced imports.
+
+    The top-level modules which took at least threshold_ms to import are
+    preloaded, slowest first, up to limit of them, leaving out the deferred
+    and excluded ones. The requested preload modules are always preloaded,
+    ahead of those. The slowest imports are recorded for reference.
+    """
+    skipped = set(defer or []) | set(exclude or [])
+    cumulative = {}
+    for record in records:
+        if '.' in record.name or record.name.startswith('_') or record.name in skipped:
+            continue
+        cumulative[record.name] = max(record.cumulative_us, cumulative.get(record.name, 0))
+    measured = sorted((module for module, us in cumulative.items() if us / 1000.0 >= threshold_ms),
+                      key=lambda module: cumulative[module], reverse=True)[:limit]
+    preload = list(preload or [])
+    preload += [module for module in measured if module not in preload]
+
+    return collections.OrderedDict([
+        ('preload', preload),
+        ('defer', list(defer or [])),
+        ('imports', [
+            collections.OrderedDict([
+                ('name', record.name),
+                ('self_ms', round(record.self_us / 1000.0, 3)),
+                ('cumulative_ms', round(record.cumulative_us / 1000.0, 3)),
+            ]) for record in sorted(records, key=lambda r: r.self_us, reverse=True)[:50]
+        ]),
+    ])
+
+
+def load_manifest(path):
+    """
+    Return the preload manifest at path, or None if there isn't one.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+    except ValueError as e:
+        logger.warning('Ignoring invalid preload manifest {}: {}'.format(path, e))
+        return None
+
+
+def preload_modules(modules):
+    """
+    Import the modules, returning the time in seconds each took.
+    Modules which fail to import are logged and skipped.
+    """
+    timings = collections.OrderedDict()
+    for module in modules:
+        start = time.time()
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            logger.warning('Failed to preload {}: {}'.format(module, e))
+            continue
+        timings[module] = time.time() - start
+    return timings
+
+
+class DeferredImportFinder:
+    """
+    A meta path finder which makes the given modules lazy: they are
+    executed on their first attribute access, rather than when imported.
+    """
+    def __init__(self, modules):
+        self.modules = set(modules)
+        self.finding = False
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname not in self.modules or self.finding:
+            return None
+
+        # Find the module the regular way, then wrap its loader.
+        self.finding = True
+        try:
+            spec = importlib.util.find_spec(fullname)
+        finally:
+            self.finding = False
+        if spec is None or spec.loader is None or not hasattr(spec.loader, 'exec_module'):
+            return None
+        spec.loader = importlib.util.LazyLoader(spec.loader)
+        return spec
+
+    def invalidate_caches(self):
+        pass
+
+
+def install_deferred_imports(modules):
+    """
+    Install a finder deferring the modules, unless one is installed.
+    """
+    for finder in sys.meta_path:
+        if isinstance(finder, DeferredImportFinder):
+            finder.modules.update(modules)
+            return finder
+
+    finder = DeferredImportFinder(modules)
+    sys.meta_path.insert(0, finder)
+    return finder
+
+
+def get_new_modules(known_modules):
+    """
+    Return the modules imported since known_modules was taken,
+    leaving out those whose parent package was also newly imported.
+    """
+    new_modules = set(name for name in sys.modules if name not in known_modules)
+    return sorted(name for name in new_modules if name.rpartition('.')[0] not in new_modules)
@@ -0,0 +1,423 @@
+"""
+Lambda response streaming.
+
+Lambda's Python runtime buffers a function's result, so a response can only be
+streamed by a runtime client which talks to the Lambda Runtime API itself.
+With the `response_streaming` setting, the package gets an exec wrapper which
+replaces the Python runtime's client with the StreamingRuntime below, and the
+function is given a Function URL with the RESPONSE_STREAM invoke mode. Exec
+wrappers are only run by the python3.8 and later runtimes.
+
+The streaming runtime always dispatches to Zappa's handler, so it can't be
+used with a custom `lambda_handler`, which the CLI refuses.
+
+Only Function URL requests are streamed. Every other event, including API
+Gateway and ALB requests, is answered with a whole JSON result, as the Python
+runtime's client would.
+
+A streamed HTTP response starts with a JSON prelude holding its status code,
+headers and cookies, followed by eight NUL bytes, after which its body is
+forwarded as the app produces it: WSGI iterables chunk by chunk, and ASGI
+`http.response.body` messages as they are sent.
+
+LocalRuntimeAPI serves the Runtime API on localhost, recording the chunks of
+each streamed response as they arrive, so the runtime can be run offline.
+"""
+import base64
+import http.client
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+RUNTIME_API_VERSION = '2018-06-01'
+STREAMING_CONTENT_TYPE = 'application/vnd.awslambda.http-integration-response'
+PRELUDE_DELIMITER = b'\x00' * 8
+
+# Runs the streaming runtime in place of the Python runtime's client.
+# Lambda calls it with the runtime's command, starting with the interpreter.
+EXEC_WRAPPER = 'zappa_streaming'
+EXEC_WRAPPER_SCRIPT = """#!/bin/sh
+cd "$LAMBDA_TASK_ROOT" && exec "$1" -m zappa.streaming
+"""
+
+
+def create_prelude(status_code, headers):
+    """
+    Given a status code and a list of (name, value) headers,
+    return the prelude of a streamed HTTP response.
+    """
+    prelude_headers = {}
+    cookies = []
+    for name, value in headers:
+        if name.lower() == 'set-cookie':
+            cookies.append(value)
+        elif name in prelude_headers:
+            prelude_headers[name] += ', ' + value
+        else:
+            prelude_headers[name] = value
+
+    prelude = {'statusCode': status_code, 'headers': prelude_headers}
+    if cookies:
+        prelude['cookies'] = cookies
+    return json.dumps(prelude).encode('utf-8') + PRELUDE_DELIMITER
+
+
+def parse_prelude(data):
+    """
+    Split a streamed HTTP response into its prelude, as a dict, and its body.
+    """
+    prelude, delimiter, body = data.partition(PRELUDE_DELIMITER)
+    if not delimiter:
+        raise ValueError('The response has no prelude.')
+    return json.loads(prelude.decode('utf-8')), body
+
+
+def get_error_payload(exc_info):
+    exc_type, exc_value, exc_traceback = exc_info
+    return {
+        'errorMessage': str(exc_value),
+        'errorType': exc_type.__name__,
+        'stackTrace': traceback.format_tb(exc_traceback),
+    }
+
+
+class LambdaContext:
+    """
+    The context of an invocation, from the Runtime API's headers and the environment.
+    """
+    def __init__(self, request_id, headers):
+        self.aws_request_id = request_id
+        self.invoked_function_arn = headers.get('Lambda-Runtime-Invoked-Function-Arn')
+        self.deadline_ms = int(headers.get('Lambda-Runtime-Deadline-Ms') or 0)
+        self.identity = json.loads(headers.get('Lambda-Runtime-Cognito-Identity') or 'null')
+        self.client_context = json.loads(headers.get('Lambda-Runtime-Client-Context') or 'null')
+        self.function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+        self.function_version = os.environ.get('AWS_LAMBDA_FUNCTION_VERSION')
+        self.memory_limit_in_mb = os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE')
+        self.log_group_name = os.environ.get('AWS_LAMBDA_LOG_GROUP_NAME')
+        self.log_stream_name = os.environ.get('AWS_LAMBDA_LOG_STREAM_NAME')
+
+    def get_remaining_time_in_millis(self):
+        return max(self.deadline_ms - int(time.time() * 1000), 0)
+
+
+class StreamingRuntime:
+    """
+    A Lambda Runtime API client which streams responses.
+
+    The handler is called with each event and its context, and returns the
+    content type of the response and an iterator over its chunks.
+    """
+    def __init__(self, handler, runtime_api=None):
+        self.handler = handler
+        self.runtime_api = runtime_api or os.environ['AWS_LAMBDA_RUNTIME_API']
+
+    def get_path(self, *parts):
+        return '/'.join(('', RUNTIME_API_VERSION, 'runtime') + parts)
+
+    def get_next_invocation(self):
+        """
+        Wait for the next invocation, returning its request id, event and context.
+        """
+        connection = http.client.HTTPConnection(self.runtime_api)
+        try:
+            connection.request('GET', self.get_path('invocation', 'next'))
+            response = connection.getresponse()
+            body = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError('Failed to get the next invocation: {} {}'.format(response.status, body))
+
+        request_id = response.getheader('Lambda-Runtime-Aws-Request-Id')
+        trace_id = response.getheader('Lambda-Runtime-Trace-Id')
+        if trace_id:
+            os.environ['_X_AMZN_TRACE_ID'] = trace_id
+        return request_id, json.loads(body.decode('utf-8')), LambdaContext(request_id, response.headers)
+
+    def stream_response(self, request_id, content_type, chunks):
+        """
+        Send the chunks of a response as they are produced. An error raised
+        while producing them is reported in the trailers of the response.
+        """
+        connection = http.client.HTTPConnection(self.runtime_api)
+        try:
+            connection.putrequest('POST', self.get_path('invocation', request_id, 'response'))
+            connection.putheader('Content-Type', content_type)
+            connection.putheader('Lambda-Runtime-Function-Response-Mode', 'streaming')
+            connection.putheader('Transfer-Encoding', 'chunked')
+            connection.putheader('Trailer', 'Lambda-Runtime-Function-Error-Type, Lambda-Runtime-Function-Error-Body')
+            connection.endheaders()
+
+            trailers = b''
+            try:
+                for chunk in chunks:
+                    if chunk:
+                        connection.send(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            except Exception:
+                logger.exception('Failed to stream the response of {}.'.format(request_id))
+                payload = get_error_payload(sys.exc_info())
+                trailers = 'Lambda-Runtime-Function-Error-Type: {}\r\nLambda-Runtime-Function-Error-Body: {}\r\n'.format(
+                    payload['errorType'],
+                    base64.b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
+                ).encode('latin-1')
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+            connection.send(b'0\r\n' + trailers + b'\r\n')
+            connection.getresponse().read()
+        finally:
+            connection.close()
+
+    def post_response(self, request_id, content_type, body):
+        """
+        Send a whole, buffered response, as the Python runtime's client does.
+        """
+        connection = http.client.HTTPConnection(self.runtime_api)
+        try:
+            connection.request('POST', self.get_path('invocation', request_id, 'response'), body=body, headers={
+                'Content-Type': content_type,
+            })
+            connection.getresponse().read()
+        finally:
+            connection.close()
+
+    def post_error(self, path, exc_info):
+        payload = get_error_payload(exc_info)
+        connection = http.client.HTTPConnection(self.runtime_api)
+        try:
+            connection.request('POST', path, body=json.dumps(payload), headers={
+                'Content-Type': 'application/json',
+                'Lambda-Runtime-Function-Error-Type': payload['errorType'],
+            })
+            connection.getresponse().read()
+        finally:
+            connection.close()
+
+    def post_init_error(self, exc_info):
+        self.post_error(self.get_path('init', 'error'), exc_info)
+
+    def post_invocation_error(self, request_id, exc_info):
+        self.post_error(self.get_path('invocation', request_id, 'error'), exc_info)
+
+    def run(self, max_invocations=None):
+        """
+        Handle invocations, forever or until max_invocations were handled.
+        """
+        invocations = 0
+        while max_invocations is None or invocations < max_invocations:
+            request_id, event, context = self.get_next_invocation()
+            try:
+                content_type, chunks = self.handler(event, context)
+                # The results of other events than streamed requests are sent whole,
+                # for API Gateway, ALB and others which invoke the function buffered.
+                if content_type == 'application/json':
+                    body = b''.join(chunks)
+            except Exception:
+                logger.exception('Failed to handle {}.'.format(request_id))
+                self.post_invocation_error(request_id, sys.exc_info())
+            else:
+                if content_type == 'application/json':
+                    self.post_response(request_id, content_type, body)
+                else:
+                    self.stream_response(request_id, content_type, chunks)
+            invocations += 1
+
+
+class LocalInvocation:
+    """
+    An invocation of the local Runtime API, and the response it received.
+    """
+    def __init__(self, event, request_id=None):
+        self.event = event
+        self.request_id = request_id or str(uuid.uuid4())
+        self.content_type = None
+        self.chunks = []
+        self.trailers = {}
+        self.error = None
+        self.done = threading.Event()
+        self.received = threading.Condition()
+
+    @property
+    def body(self):
+        return b''.join(self.chunks)
+
+    def get_response(self):
+        """
+        Return the prelude and the body of a streamed HTTP response.
+        """
+        return parse_prelude(self.body)
+
+    def add_chunk(self, chunk):
+        with self.received:
+            self.chunks.append(chunk)
+            self.received.notify_all()
+
+    def wait_for_chunks(self, count, timeout=None):
+        """
+        Wait until count chunks were received, returning whether they were.
+        """
+        with self.received:
+            return self.received.wait_for(lambda: len(self.chunks) >= count, timeout)
+
+
+class LocalRuntimeAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_empty_response(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        runtime_api = self.server.runtime_api
+        if self.path != '/{}/runtime/invocation/next'.format(RUNTIME_API_VERSION):
+            return self.send_empty_response(404)
+
+        invocation = runtime_api.queue.get()
+        if invocation is None:
+            return self.send_empty_response(503)
+
+        body = json.dumps(invocation.event).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Lambda-Runtime-Aws-Request-Id', invocation.request_id)
+        self.send_header('Lambda-Runtime-Deadline-Ms', str(int((time.time() + runtime_api.timeout) * 1000)))
+        self.send_header('Lambda-Runtime-Invoked-Function-Arn', runtime_api.function_arn)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        runtime_api = self.server.runtime_api
+        parts = self.path.split('/')[3:]
+        if parts == ['init', 'error']:
+            runtime_api.init_error = self.read_body()
+            return self.send_empty_response(202)
+        if len(parts) != 3 or parts[0] != 'invocation' or parts[1] not in runtime_api.invocations:
+            return self.send_empty_response(404)
+
+        invocation = runtime_api.invocations[parts[1]]
+        if parts[2] == 'error':
+            invocation.error = json.loads(self.read_body().decode('utf-8'))
+        else:
+            invocation.content_type = self.headers.get('Content-Type')
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                self.read_chunks(invocation)
+            else:
+                invocation.add_chunk(self.read_body())
+
+            error_body = invocation.trailers.get('Lambda-Runtime-Function-Error-Body')
+            if error_body:
+                invocation.error = json.loads(base64.b64decode(error_body).decode('utf-8'))
+
+        self.send_empty_response(202)
+        invocation.done.set()
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def read_chunks(self, invocation):
+        while True:
+            size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            if not size:
+                break
+            invocation.add_chunk(self.rfile.read(size))
+            self.rfile.readline()
+
+        while True:
+            line = self.rfile.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            invocation.trailers[name.strip()] = value.strip()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class LocalRuntimeAPI:
+    """
+    A local Lambda Runtime API, for running a runtime client offline.
+
+        with LocalRuntimeAPI() as runtime_api:
+            runtime = StreamingRuntime(handler, runtime_api.address)
+            threading.Thread(target=runtime.run, args=(1,)).start()
+            invocation = runtime_api.invoke(event)
+    """
+    def __init__(self, host='127.0.0.1', port=0, timeout=30,
+                 function_arn='arn:aws:lambda:us-east-1:123456789012:function:local'):
+        self.timeout = timeout
+        self.function_arn = function_arn
+        self.queue = queue.Queue()
+        self.invocations = {}
+        self.init_error = None
+        self.server = ThreadingHTTPServer((host, port), LocalRuntimeAPIHandler)
+        self.server.runtime_api = self
+        self.thread = None
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return '{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # Release any runtime waiting for an invocation
+        self.queue.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def invoke(self, event, wait=True):
+        """
+        Queue an invocation, waiting for its response unless wait is False.
+        """
+        invocation = LocalInvocation(event)
+        self.invocations[invocation.request_id] = invocation
+        self.queue.put(invocation)
+        if wait and not invocation.done.wait(self.timeout):
+            raise RuntimeError('Invocation {} timed out.'.format(invocation.request_id))
+        return invocation
+
+
+def main():  # pragma: no cover
+    runtime = StreamingRuntime(None)
+    try:
+        from zappa.handler import LambdaHandler
+        LambdaHandler()
+    except Exception:
+        logger.exception('Failed to initialize the handler.')
+        runtime.post_init_error(sys.exc_info())
+        sys.exit(1)
+
+    runtime.handler = LambdaHandler.lambda_handler_stream
+    runtime.run()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
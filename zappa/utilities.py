@@ -198,6 +198,10 @@ def get_topic_name(lambda_name):
     """ Topic name generation """
     return '%s-zappa-async' % lambda_name
 
+def get_queue_name(lambda_name):
+    """ Queue name generation """
+    return '%s-zappa-async' % lambda_name
+
 ##
 # Event sources / Kappa
 ##
@@ -230,8 +234,24 @@ def get_event_source(event_source, lambda_arn, target_function, boto_session, dr
         def __init__(self):
             return
 
+    class MappingOptionsMixin:
+        @property
+        def mapping_options(self):
+            # Only pass these when configured, for older botocore versions.
+            options = {}
+            if self._config.get('function_response_types'):
+                # e.g. ['ReportBatchItemFailures'] with per_record_processing
+                options['FunctionResponseTypes'] = self._config['function_response_types']
+            return options
+
+        def needs_update(self, mapping):
+            """
+            Whether an existing mapping is missing any of the configured options.
+            """
+            return any(mapping.get(key) != value for key, value in self.mapping_options.items())
+
     # Mostly adapted from kappa - will probably be replaced by kappa support
-    class SqsEventSource(kappa.event_source.base.EventSource):
+    class SqsEventSource(MappingOptionsMixin, kappa.event_source.base.EventSource):
 
         def __init__(self, context, config):
             super().__init__(context, config)
@@ -256,7 +276,8 @@ def get_event_source(event_source, lambda_arn, target_function, boto_session, dr
                     FunctionName=function.name,
                     EventSourceArn=self.arn,
                     BatchSize=self.batch_size,
-                    Enabled=self.enabled
+                    Enabled=self.enabled,
+                    **self.mapping_options
                     )
                 LOG.debug(response)
             except Exception:
@@ -293,9 +314,11 @@ def get_event_source(event_source, lambda_arn, target_function, boto_session, dr
                 try:
                     response = self._lambda.call(
                         'update_event_source_mapping',
+                        UUID=uuid,
                         BatchSize=self.batch_size,
                         Enabled=self.enabled,
-                        FunctionName=function.arn)
+                        FunctionName=function.arn,
+                        **self.mapping_options)
                     LOG.debug(response)
                 except Exception:
                     LOG.exception('Unable to update event source')
@@ -327,6 +350,44 @@ def get_event_source(event_source, lambda_arn, target_function, boto_session, dr
                 LOG.debug('No UUID for event source %s', self.arn)
             return response
 
+    class ExtendedKinesisEventSource(MappingOptionsMixin, kappa.event_source.kinesis.KinesisEventSource):
+        # kappa can't pass FunctionResponseTypes, which partial batch responses need.
+
+        def add(self, function):
+            try:
+                response = self._lambda.call(
+                    'create_event_source_mapping',
+                    FunctionName=function.name,
+                    EventSourceArn=self.arn,
+                    BatchSize=self.batch_size,
+                    StartingPosition=self.starting_position,
+                    Enabled=self.enabled,
+                    **self.mapping_options
+                    )
+                kappa.event_source.kinesis.LOG.debug(response)
+            except Exception:
+                kappa.event_source.kinesis.LOG.exception('Unable to add event source')
+
+        def update(self, function):
+            response = None
+            uuid = self._get_uuid(function)
+            if uuid:
+                try:
+                    response = self._lambda.call(
+                        'update_event_source_mapping',
+                        UUID=uuid,
+                        BatchSize=self.batch_size,
+                        Enabled=self.enabled,
+                        FunctionName=function.arn,
+                        **self.mapping_options)
+                    kappa.event_source.kinesis.LOG.debug(response)
+                except Exception:
+                    kappa.event_source.kinesis.LOG.exception('Unable to update event source')
+            return response
+
+    class ExtendedDynamoDBStreamEventSource(ExtendedKinesisEventSource):
+        pass
+
     class ExtendedSnsEventSource(kappa.event_source.sns.SNSEventSource):
         @property
         def filters(self):
@@ -352,8 +413,8 @@ def get_event_source(event_source, lambda_arn, target_function, boto_session, dr
                 self.add_filters(function)
 
     event_source_map = {
-        'dynamodb': kappa.event_source.dynamodb_stream.DynamoDBStreamEventSource,
-        'kinesis': kappa.event_source.kinesis.KinesisEventSource,
+        'dynamodb': ExtendedDynamoDBStreamEventSource,
+        'kinesis': ExtendedKinesisEventSource,
         's3': kappa.event_source.s3.S3EventSource,
         'sns': ExtendedSnsEventSource,
         'sqs': SqsEventSource,
@@ -410,9 +471,14 @@ def add_event_source(event_source, lambda_arn, target_function, boto_session, dr
     event_source_obj, ctx, funk = get_event_source(event_source, lambda_arn, target_function, boto_session, dry=False)
     # TODO: Detect changes in config and refine exists algorithm
     if not dry:
-        if not event_source_obj.status(funk):
+        status = event_source_obj.status(funk)
+        if not status:
             event_source_obj.add(funk)
             return 'successful' if event_source_obj.status(funk) else 'failed'
+        elif hasattr(event_source_obj, 'needs_update') and event_source_obj.needs_update(status):
+            # e.g. a mapping created before per_record_processing was turned on
+            event_source_obj.update(funk)
+            return 'updated'
         else:
             return 'exists'
 
@@ -1,13 +1,23 @@
 import base64
+import binascii
+import fnmatch
+import gzip
+import io
+import itertools
 import logging
 import six
 import sys
 
 from requestlogger import ApacheFormatter
 from werkzeug import urls
+from werkzeug.test import run_wsgi_app as werkzeug_run_wsgi_app
+from werkzeug.wrappers import Response
 from urllib.parse import urlencode
 
-from .utilities import merge_headers, titlecase_keys
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
 
 BINARY_METHODS = [
                     "POST",
@@ -18,6 +28,146 @@ BINARY_METHODS = [
                     "OPTIONS"
                 ]
 
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_MIMETYPES = [
+    "text/*",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+]
+
+# Memoized translations of header names to their WSGI environ keys,
+# bounded since header names are client supplied.
+WSGI_HEADER_KEYS = {}
+WSGI_HEADER_KEYS_MAX = 1024
+
+
+def decode_body(body, base64_encoded=False):
+    """
+    Given the body of an event, return it as bytes, copying it once:
+    base64 is decoded straight from the event's string.
+    """
+    if not body:
+        return b''
+    if base64_encoded:
+        return binascii.a2b_base64(body)
+    if isinstance(body, six.string_types):
+        return body.encode("utf-8")
+    return body
+
+
+class RequestBodyStream(io.RawIOBase):
+    """
+    A readable, seekable stream over a request body, which reads through
+    a memoryview of the body rather than from a copy of it.
+    """
+    def __init__(self, body=b''):
+        self.body = body
+        self.view = memoryview(body)
+        self.position = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def getbuffer(self):
+        return self.view
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = max(offset, 0)
+        return self.position
+
+    def get_end(self, size):
+        if size is None or size < 0:
+            return len(self.view)
+        return min(self.position + size, len(self.view))
+
+    def read(self, size=-1):
+        start, self.position = self.position, max(self.get_end(size), self.position)
+        return self.view[start:self.position].tobytes()
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer):
+        start, self.position = self.position, max(self.get_end(len(buffer)), self.position)
+        count = self.position - start
+        memoryview(buffer).cast('B')[:count] = self.view[start:self.position]
+        return count
+
+    def readline(self, size=-1):
+        end = self.get_end(size)
+        newline = self.body.find(b'\n', self.position, end)
+        return self.read((newline + 1 if newline != -1 else end) - self.position)
+
+
+def get_wsgi_header_key(name):
+    """
+    Translate a header name to its WSGI environ key, e.g. content-type => HTTP_CONTENT_TYPE.
+    """
+    try:
+        return WSGI_HEADER_KEYS[name]
+    except KeyError:
+        # Header names are made canonical first
+        # https://github.com/Miserlou/Zappa/issues/1188
+        key = 'HTTP_' + name.title().upper().replace('-', '_')
+        if len(WSGI_HEADER_KEYS) < WSGI_HEADER_KEYS_MAX:
+            WSGI_HEADER_KEYS[name] = key
+        return key
+
+
+def get_wsgi_headers(event_info, headers=None):
+    """
+    Given an event, or the headers the handler already merged from it,
+    return its headers as WSGI environ keys and values, in a single pass.
+
+    Values of multiValueHeaders are joined, and take precedence over headers.
+    """
+    keys = WSGI_HEADER_KEYS
+    wsgi_headers = {}
+    if headers is not None:
+        for name, value in headers.items():
+            wsgi_headers[keys.get(name) or get_wsgi_header_key(name)] = str(value)
+        return wsgi_headers
+
+    multi_headers = event_info.get('multiValueHeaders') or {}
+    for name, values in multi_headers.items():
+        wsgi_headers[keys.get(name) or get_wsgi_header_key(name)] = ', '.join(values)
+    # Allow for the AGW console 'Test' button to work (Pull #735)
+    for name, value in (event_info.get('headers') or {}).items():
+        if name not in multi_headers:
+            wsgi_headers[keys.get(name) or get_wsgi_header_key(name)] = str(value)
+    return wsgi_headers
+
+
+def is_payload_v2(event):
+    """
+    Whether the event is in the 2.0 payload format,
+    sent by HTTP APIs and Lambda Function URLs.
+    """
+    return event.get('version') == '2.0' and 'http' in (event.get('requestContext') or {})
+
+
+def is_function_url_event(event):
+    """
+    Whether the event was sent by a Lambda Function URL, rather than an HTTP API.
+    """
+    domain_name = (event.get('requestContext') or {}).get('domainName') or ''
+    return is_payload_v2(event) and '.lambda-url.' in domain_name
+
 
 def create_wsgi_request(event_info,
                         server_name='zappa',
@@ -26,13 +176,25 @@ def create_wsgi_request(event_info,
                         binary_support=False,
                         base_path=None,
                         context_header_mappings={},
+                        headers=None,
                         ):
         """
         Given some event_info via API Gateway,
         create and return a valid WSGI request environ.
+
+        The headers may be given if they were already merged from the event.
+        Events in the 2.0 payload format, from HTTP APIs and Function URLs,
+        are supported too.
         """
-        method = event_info['httpMethod']
-        headers = merge_headers(event_info) or {} # Allow for the AGW console 'Test' button to work (Pull #735)
+        request_context = event_info.get('requestContext') or {}
+        is_v2 = is_payload_v2(event_info)
+        if is_v2:
+            method = request_context['http']['method']
+        else:
+            method = event_info['httpMethod']
+        wsgi_headers = get_wsgi_headers(event_info, headers)
+        if is_v2 and event_info.get('cookies'):
+            wsgi_headers['HTTP_COOKIE'] = '; '.join(event_info['cookies'])
 
         """
         API Gateway and ALB both started allowing for multi-value querystring
@@ -45,7 +207,10 @@ def create_wsgi_request(event_info,
         we have to check for the existence of one and then fall back to the
         other.
         """
-        if 'multiValueQueryStringParameters' in event_info:
+        if is_v2:
+            # Passed through as sent, rather than decoded and encoded again
+            query_string = event_info.get('rawQueryString', '')
+        elif 'multiValueQueryStringParameters' in event_info:
             query = event_info['multiValueQueryStringParameters']
             query_string = urlencode(query, doseq=True) if query else ''
         else:
@@ -63,11 +228,17 @@ def create_wsgi_request(event_info,
                     else:
                         header_val = header_val[part]
                 if header_val is not None:
-                    headers[key] = header_val
+                    wsgi_headers[get_wsgi_header_key(key)] = str(header_val)
 
         # Extract remote user from context if Authorizer is enabled
         remote_user = None
-        if event_info['requestContext'].get('authorizer'):
+        authorizer = request_context.get('authorizer')
+        if is_v2:
+            if authorizer and authorizer.get('jwt'):
+                remote_user = authorizer['jwt'].get('claims', {}).get('sub')
+            elif authorizer and authorizer.get('iam'):
+                remote_user = authorizer['iam'].get('userArn')
+        elif event_info['requestContext'].get('authorizer'):
             remote_user = event_info['requestContext']['authorizer'].get('principalId')
         elif event_info['requestContext'].get('identity'):
             remote_user = event_info['requestContext']['identity'].get('userArn')
@@ -77,36 +248,32 @@ def create_wsgi_request(event_info,
         #           https://github.com/Miserlou/Zappa/issues/696
         #           https://github.com/Miserlou/Zappa/issues/836
         #           https://en.wikipedia.org/wiki/Hypertext_Transfer_Protocol#Summary_table
-        if binary_support and (method in BINARY_METHODS):
-            if event_info.get('isBase64Encoded', False):
-                encoded_body = event_info['body']
-                body = base64.b64decode(encoded_body)
-            else:
-                body = event_info['body']
-                if isinstance(body, six.string_types):
-                    body = body.encode("utf-8")
-
+        base64_encoded = event_info.get('isBase64Encoded', False) and \
+            ((binary_support and (method in BINARY_METHODS)) or is_v2)
+        body = decode_body(event_info.get('body'), base64_encoded)
+
+        if is_v2:
+            path = urls.url_unquote(event_info['rawPath'])
+            # The path of a named stage starts with the stage
+            stage_path = '/' + request_context.get('stage', '$default')
+            if not base_path and (path == stage_path or path.startswith(stage_path + '/')):
+                script_name = stage_path
+                path = path[len(stage_path):]
         else:
-            body = event_info['body']
-            if isinstance(body, six.string_types):
-                body = body.encode("utf-8")
-
-        # Make header names canonical, e.g. content-type => Content-Type
-        # https://github.com/Miserlou/Zappa/issues/1188
-        headers = titlecase_keys(headers)
-
-        path = urls.url_unquote(event_info['path'])
+            path = urls.url_unquote(event_info['path'])
         if base_path:
             script_name = '/' + base_path
 
             if path.startswith(script_name):
                 path = path[len(script_name):]
 
-        x_forwarded_for = headers.get('X-Forwarded-For', '')
-        if ',' in x_forwarded_for:
+        x_forwarded_for = wsgi_headers.get('HTTP_X_FORWARDED_FOR', '')
+        if is_v2 and request_context['http'].get('sourceIp'):
+            remote_addr = request_context['http']['sourceIp']
+        elif ',' in x_forwarded_for:
             # The last one is the cloudfront proxy ip. The second to last is the real client ip.
             # Everything else is user supplied and untrustworthy.
-            remote_addr = x_forwarded_for.split(', ')[-2]
+            remote_addr = x_forwarded_for.rsplit(',', 2)[-2].strip()
         else:
             remote_addr = x_forwarded_for or '127.0.0.1'
 
@@ -117,11 +284,12 @@ def create_wsgi_request(event_info,
             'REQUEST_METHOD': method,
             'SCRIPT_NAME': get_wsgi_string(str(script_name)) if script_name else '',
             'SERVER_NAME': str(server_name),
-            'SERVER_PORT': headers.get('X-Forwarded-Port', '80'),
-            'SERVER_PROTOCOL': str('HTTP/1.1'),
+            'SERVER_PORT': wsgi_headers.get('HTTP_X_FORWARDED_PORT', '80'),
+            'SERVER_PROTOCOL': str(request_context['http'].get('protocol', 'HTTP/1.1')) if is_v2 else str('HTTP/1.1'),
             'wsgi.version': (1, 0),
-            'wsgi.url_scheme': headers.get('X-Forwarded-Proto', 'http'),
-            'wsgi.input': body,
+            'wsgi.url_scheme': wsgi_headers.get('HTTP_X_FORWARDED_PROTO', 'http'),
+            'wsgi.input': RequestBodyStream(body),
+            'wsgi.input_terminated': True,
             'wsgi.errors': sys.stderr,
             'wsgi.multiprocess': False,
             'wsgi.multithread': False,
@@ -129,20 +297,12 @@ def create_wsgi_request(event_info,
         }
 
         # Input processing
-        if method in ["POST", "PUT", "PATCH", "DELETE"]:
-            if 'Content-Type' in headers:
-                environ['CONTENT_TYPE'] = headers['Content-Type']
-
-            # This must be Bytes or None
-            environ['wsgi.input'] = six.BytesIO(body)
-            if body:
-                environ['CONTENT_LENGTH'] = str(len(body))
-            else:
-                environ['CONTENT_LENGTH'] = '0'
+        if method in ["POST", "PUT", "PATCH", "DELETE"] or body:
+            if 'HTTP_CONTENT_TYPE' in wsgi_headers:
+                environ['CONTENT_TYPE'] = wsgi_headers['HTTP_CONTENT_TYPE']
+            environ['CONTENT_LENGTH'] = str(len(body))
 
-        for header in headers:
-            wsgi_name = "HTTP_" + header.upper().replace('-', '_')
-            environ[wsgi_name] = str(headers[header])
+        environ.update(wsgi_headers)
 
         if script_name:
             environ['SCRIPT_NAME'] = script_name
@@ -154,12 +314,201 @@ def create_wsgi_request(event_info,
         if remote_user:
             environ['REMOTE_USER'] = remote_user
 
-        if event_info['requestContext'].get('authorizer'):
-            environ['API_GATEWAY_AUTHORIZER'] = event_info['requestContext']['authorizer']
+        if request_context.get('authorizer'):
+            environ['API_GATEWAY_AUTHORIZER'] = request_context['authorizer']
 
         return environ
 
 
+def run_wsgi_app(app, environ):
+    """
+    Given a WSGI app and environ, run the app, consuming its
+    response iterable exactly once into a single buffer.
+
+    Returns the response, and its body as bytes.
+    """
+    app_iter, status, headers = werkzeug_run_wsgi_app(app, environ)
+    try:
+        chunks = [chunk.encode('utf-8') if isinstance(chunk, str) else chunk for chunk in app_iter]
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+    # Joining a single chunk doesn't copy it.
+    body = b''.join(chunks)
+    return Response([body], status=status, headers=headers), body
+
+
+def stream_wsgi_app(app, environ):
+    """
+    Given a WSGI app and environ, run the app without buffering its response.
+
+    Returns the response, without its body, and an iterator over the chunks
+    of the body as bytes, which closes the app's iterable when exhausted.
+    """
+    response = []
+    buffer = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info is not None and response:
+            six.reraise(*exc_info)
+        response[:] = [status, headers]
+        return buffer.append
+
+    app_rv = app(environ, start_response)
+    app_iter = iter(app_rv)
+
+    # Unlike werkzeug's run_wsgi_app, only iterate
+    # the app until it has started its response.
+    try:
+        while not response:
+            buffer.append(next(app_iter))
+    except StopIteration:
+        raise RuntimeError('WSGI app returned without starting its response.')
+
+    def iter_chunks():
+        try:
+            for chunk in itertools.chain(buffer, app_iter):
+                yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+        finally:
+            if hasattr(app_rv, 'close'):
+                app_rv.close()
+
+    status, headers = response
+    return Response(status=status, headers=headers), iter_chunks()
+
+
+def is_base64_response(response, binary_support=False):
+    """
+    Return whether the body of the response is base64 encoded in the Lambda's result.
+    """
+    # A compressed body is always binary.
+    return 'Content-Encoding' in response.headers or binary_support and \
+        not response.mimetype.startswith("text/") \
+        and response.mimetype != "application/json"
+
+
+def create_lambda_response(response, body, binary_support=False, headers=True,
+                           multi_value_headers=False, elb=False, payload_version='1.0'):
+    """
+    Given a response and its body, pack it into the dictionary
+    API Gateway and ALB expect as a Lambda's result.
+
+    The 2.0 payload format (HTTP APIs and Function URLs) has its
+    Set-Cookie headers in a list of cookies, and always supports binary bodies.
+    """
+    returndict = dict()
+    if payload_version == '2.0':
+        binary_support = True
+        returndict['isBase64Encoded'] = False
+
+    # Issue #1715: ALB support. ALB responses must always include
+    # base64 encoding and status description
+    if elb:
+        returndict['isBase64Encoded'] = False
+        returndict['statusDescription'] = response.status
+
+    if body:
+        if is_base64_response(response, binary_support):
+            returndict['body'] = base64.b64encode(body).decode('ascii')
+            returndict["isBase64Encoded"] = True
+        else:
+            returndict['body'] = body.decode(response.charset)
+
+    returndict['statusCode'] = response.status_code
+
+    if payload_version == '2.0':
+        single_headers = {}
+        cookies = []
+        for key, value in response.headers:
+            if key.lower() == 'set-cookie':
+                cookies.append(value)
+            elif key in single_headers:
+                single_headers[key] += ', ' + value
+            else:
+                single_headers[key] = value
+        returndict['headers'] = single_headers
+        if cookies:
+            returndict['cookies'] = cookies
+        return returndict
+
+    # Build both header styles in a single pass
+    if headers or multi_value_headers:
+        single_headers = {}
+        multi_headers = {}
+        for key, value in response.headers:
+            single_headers[key] = value
+            multi_headers.setdefault(key, []).append(value)
+        if headers:
+            returndict['headers'] = single_headers
+        if multi_value_headers:
+            returndict['multiValueHeaders'] = multi_headers
+
+    return returndict
+
+
+def get_accepted_encoding(accept_encoding):
+    """
+    Given an Accept-Encoding header, return the preferred encoding
+    we can compress with, or None.
+    """
+    available = ['br', 'gzip'] if brotli else ['gzip']
+    accepted = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    best = None
+    for encoding in available:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > 0 and (best is None or quality > accepted.get(best, accepted.get('*', 0.0))):
+            best = encoding
+    return best
+
+
+def compress_response(response, body, accept_encoding, min_size=COMPRESSION_MIN_SIZE,
+                      mimetypes=COMPRESSION_MIMETYPES):
+    """
+    Given a response and its body, compress the body with gzip or brotli
+    if the client accepts it, and the body is large enough and of an
+    allowed mimetype. The response's headers are updated to match.
+
+    Returns the (possibly) compressed body.
+    """
+    if not body or len(body) < min_size or response.status_code in [204, 304] \
+            or 'Content-Encoding' in response.headers:
+        return body
+    if not any(fnmatch.fnmatch(response.mimetype, mimetype) for mimetype in mimetypes):
+        return body
+
+    # Caches must key this response on the encoding, whether or not we compress.
+    vary = response.headers.get('Vary')
+    if not vary:
+        response.headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower() and vary.strip() != '*':
+        response.headers['Vary'] = vary + ', Accept-Encoding'
+
+    encoding = get_accepted_encoding(accept_encoding or '')
+    if encoding == 'br':
+        body = brotli.compress(body, quality=4)
+    elif encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=5)
+    else:
+        return body
+
+    response.headers['Content-Encoding'] = encoding
+    if 'Content-Length' in response.headers:
+        response.headers['Content-Length'] = str(len(body))
+    return body
+
+
 def common_log(environ, response, response_time=None):
     """
     Given the WSGI environ and the response,